@@ -0,0 +1,48 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait after the latest item of an album before handling it
+ALBUM_WINDOW = 1.0
+# Items collected into one group at most before it is handled
+MAX_GROUP_SIZE = 100
+
+class AlbumBuffer:
+    """
+    Collects the items of a media group, which Telegram delivers as separate updates.
+    Items are held by (chat, media_group_id) until no new item arrived for window seconds,
+    then on_album(client, messages) is called once with the whole album in message order.
+    Other bursts, like a backlog of forwarded media, can be grouped the same way under their own group_id;
+    such groups are handled early once they reach max_items.
+    """
+    def __init__(self, on_album, window=ALBUM_WINDOW, max_items=MAX_GROUP_SIZE):
+        self.on_album = on_album
+        self.window = window
+        self.max_items = max_items
+        self._albums = {}
+
+    def add(self, client, message, group_id=None):
+        key = (message.chat.id, group_id or message.media_group_id)
+        album = self._albums.get(key)
+        if album is None:
+            album = self._albums[key] = {"client": client, "messages": [], "timer": None}
+        else:
+            album["timer"].cancel()
+        album["messages"].append(message)
+        if len(album["messages"]) >= self.max_items:
+            self._flush(key)
+            return
+        album["timer"] = asyncio.get_event_loop().call_later(self.window, self._flush, key)
+
+    def _flush(self, key):
+        album = self._albums.pop(key)
+        messages = sorted(album["messages"], key=lambda message: message.id)
+        try:
+            self.on_album(album["client"], messages)
+        except Exception as e:
+            logger.error(f"Error handling album {key[1]}: {str(e)}")
+
+    def pending(self):
+        """Number of albums still being collected"""
+        return len(self._albums)
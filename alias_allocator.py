@@ -0,0 +1,124 @@
+import random
+import logging
+from array import array
+
+logger = logging.getLogger(__name__)
+
+# Emoji pool
+EMOJI_POOL = [
+    "🌀", "💫", "🌌", "🌙", "🧬", "🔥", "🔮", "🎭", "🛡", "📡",
+    "🧊", "🐚", "🕯", "🌿", "🌟", "⚡", "🌪️", "🗝️", "🌑", "🕳️"
+]
+
+# First word options (nouns and adjectives)
+FIRST_WORDS = [
+    "Nexus", "Cyber", "Shadow", "Ghost", "Zero", "Neuro", "Crypt", "Xeno", "Synth", "Rust",
+    "Drone", "Hack", "Warp", "Void", "Static", "Quantum", "Iron", "Phantom", "Obsidian", "Cipher",
+    "Lunar", "Nova", "Echo", "Crimson", "Twilight", "Oracle", "Voyager", "Specter", "Drift", "Glyph",
+    "Mystic", "Astral", "Cosmic", "Digital", "Eternal", "Fusion", "Hyper", "Infinite", "Jade", "Kinetic"
+]
+
+# Second word options (nouns)
+SECOND_WORDS = [
+    "Vortex", "Lynx", "Phreak", "Droid", "Mancer", "Glitch", "Byte", "Core", "Vault", "Nexus",
+    "Shard", "Wire", "Pulse", "Fang", "Haze", "Thorn", "Blade", "Veil", "Storm", "Raven",
+    "Serpent", "Claw", "Shade", "Infit", "Realm", "Titan", "Vertex", "Whisper", "Zenith", "Abyss",
+    "Beacon", "Cascade", "Destiny", "Echo", "Frontier", "Guardian", "Horizon", "Illusion", "Journey", "Knight"
+]
+
+# Extra words added to the pools as the name space fills up, in order
+EXPANSIONS = [
+    (
+        ["🦉", "🐺", "🦂", "🪐", "🌋", "💎", "🧿", "🎴", "🗡️", "🌠"],
+        ["Neon", "Silent", "Feral", "Solar", "Chrome", "Omega", "Rogue", "Velvet", "Arcane", "Frost",
+         "Ember", "Onyx", "Pixel", "Savage", "Primal", "Vapor", "Hollow", "Scarlet", "Ivory", "Stellar"],
+        ["Specter", "Circuit", "Cobra", "Falcon", "Matrix", "Nomad", "Oracle", "Prism", "Reaper", "Sentinel",
+         "Signal", "Talon", "Ward", "Wraith", "Viper", "Rune", "Comet", "Ember", "Mirage", "Orbit"]
+    ),
+    (
+        ["🦇", "🐉", "🦋", "🌊", "🍷", "🎲", "🕸️", "🪞", "🧪", "🛸"],
+        ["Atomic", "Binary", "Celestial", "Dusk", "Electric", "Frozen", "Gilded", "Hidden", "Lost", "Molten",
+         "Nocturnal", "Opal", "Radiant", "Sable", "Thunder", "Umbra", "Vivid", "Wild", "Azure", "Blazing"],
+        ["Anchor", "Bolt", "Crown", "Dagger", "Engine", "Flare", "Gate", "Hunter", "Index", "Jolt",
+         "Kernel", "Lantern", "Monolith", "Needle", "Outpost", "Pilot", "Quasar", "Relic", "Spire", "Tide"]
+    )
+]
+
+# Share of the name space in use at which the pools are expanded
+EXPAND_THRESHOLD = 0.75
+
+class AliasAllocator:
+    """
+    Hands out unique "<emoji> <First> <Second>" aliases.
+    Draws walk a shuffled permutation of the whole combination space, skipping aliases that are
+    already taken. Once most of the space is in use the word pools are expanded; when the extra pools
+    run out a numeric suffix opens a fresh name space. Expansion follows the number of aliases held,
+    not the draw position, so the level is rebuilt from the persisted aliases after a restart and
+    occupancy stays low enough that a draw skips only a few taken aliases.
+    """
+    def __init__(self, allocated=()):
+        self.allocated = set(allocated)
+        self.emojis = list(EMOJI_POOL)
+        self.first_words = list(FIRST_WORDS)
+        self.second_words = list(SECOND_WORDS)
+        self.expansions = list(EXPANSIONS)
+        self.suffix = 0
+        self._random = random.SystemRandom()
+        while self._crowded():
+            self._grow()
+        self._shuffle()
+
+    @property
+    def space_size(self):
+        return len(self.emojis) * len(self.first_words) * len(self.second_words)
+
+    def _crowded(self):
+        """Whether the aliases held fill the name spaces opened so far past the threshold"""
+        return len(self.allocated) >= self.space_size * (self.suffix + 1) * EXPAND_THRESHOLD
+
+    def _shuffle(self):
+        """Precompute a random permutation of the current combination space"""
+        self._permutation = array("I", range(self.space_size))
+        self._random.shuffle(self._permutation)
+        self._cursor = 0
+
+    def _grow(self):
+        """Add the next expansion to the pools, or open the next suffix once they are used up"""
+        if self.expansions:
+            emojis, first_words, second_words = self.expansions.pop(0)
+            self.emojis.extend(emojis)
+            self.first_words.extend(first_words)
+            self.second_words.extend(second_words)
+        else:
+            self.suffix += 1
+
+    def _expand(self):
+        """Grow the name space and start a new permutation over it"""
+        self._grow()
+        self._shuffle()
+        logger.info(f"Alias pools expanded to {self.space_size} combinations (suffix {self.suffix})")
+
+    def _alias_at(self, index):
+        emoji_count = len(self.emojis)
+        first_count = len(self.first_words)
+        emoji = self.emojis[index % emoji_count]
+        first_word = self.first_words[(index // emoji_count) % first_count]
+        second_word = self.second_words[index // (emoji_count * first_count)]
+        alias = f"{emoji} {first_word} {second_word}"
+        if self.suffix:
+            alias += f" {self.suffix + 1}"
+        return alias
+
+    def allocate(self):
+        """Get a new alias that no one else holds"""
+        while True:
+            # Walking off the end of the permutation means every alias in this space is taken
+            if self._crowded() or self._cursor >= len(self._permutation):
+                self._expand()
+
+            alias = self._alias_at(self._permutation[self._cursor])
+            self._cursor += 1
+            # Below the threshold at most three in four draws hit a taken alias
+            if alias not in self.allocated:
+                self.allocated.add(alias)
+                return alias
@@ -0,0 +1,64 @@
+class NGramIndex:
+    """
+    Inverted index of character n-grams for case-insensitive substring search.
+    Every gram of length 1..n is indexed, so short queries read a single posting set and longer
+    queries intersect the postings of their n-grams, smallest first, before a final substring check.
+    Lookups cost time proportional to the candidates found rather than the number of indexed texts.
+    """
+    def __init__(self, n=3):
+        self.n = n
+        self.texts = {}     # key -> lowercased text
+        self.postings = {}  # gram -> set of keys
+
+    def _grams(self, text):
+        grams = set()
+        for size in range(1, self.n + 1):
+            for i in range(len(text) - size + 1):
+                grams.add(text[i:i + size])
+        return grams
+
+    def add(self, key, text):
+        """Index a text under a key, replacing any previous text for that key"""
+        self.remove(key)
+        text = text.lower()
+        self.texts[key] = text
+        for gram in self._grams(text):
+            self.postings.setdefault(gram, set()).add(key)
+
+    def remove(self, key):
+        """Remove a key from the index"""
+        text = self.texts.pop(key, None)
+        if text is None:
+            return
+        for gram in self._grams(text):
+            keys = self.postings.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.postings[gram]
+
+    def search(self, query):
+        """Get the sorted keys whose text contains the query"""
+        query = query.lower()
+        if not query:
+            return []
+
+        if len(query) <= self.n:
+            return sorted(self.postings.get(query, ()))
+
+        posting_sets = []
+        for i in range(len(query) - self.n + 1):
+            keys = self.postings.get(query[i:i + self.n])
+            if not keys:
+                return []
+            posting_sets.append(keys)
+        posting_sets.sort(key=len)
+
+        candidates = set(posting_sets[0])
+        for keys in posting_sets[1:]:
+            candidates &= keys
+            if not candidates:
+                return []
+
+        # n-grams can all appear without the query being contiguous, so confirm each match
+        return sorted(key for key in candidates if query in self.texts[key])
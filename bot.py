@@ -1,19 +1,30 @@
+import io
 import os
 import re
 import json
 import time
 import logging
 import asyncio
+import secrets
+import uuid
 from datetime import datetime, timedelta
 from pyrogram import Client, filters, idle
-from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
-from pyrogram.errors import FloodWait, UserNotParticipant, ChatAdminRequired
+from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, InputMediaPhoto, InputMediaVideo, InputMediaAudio, InputMediaDocument
+from pyrogram.errors import FloodWait, UserNotParticipant, ChatAdminRequired, UserIsBlocked, InputUserDeactivated, PeerIdInvalid
 from dotenv import load_dotenv
-from asyncio import Queue
+from concurrent.futures import ProcessPoolExecutor
 
 # Import custom modules
-from database import Database, MEDIA_DIR
+from database import Database, MEDIA_DIR, DATA_DIR
+from outbox import Outbox, PENDING, SENDING, SENT, FAILED, text_payload, media_payload, album_payload
 import utils
+import phash
+from session_storage import SnapshotStorage
+from transfer_pool import TransferPool
+from ingest import IngestScheduler
+from fair_queue import TIERS, parse_tier_weights
+from qos import QoS
+from albums import AlbumBuffer
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -33,28 +44,84 @@ OWNER_ID = int(os.getenv("OWNER_ID", 0))  # Owner ID for admin commands
 BOT_USERNAME = os.getenv("BOT_USERNAME")
 OWNER_USERNAME = os.getenv("OWNER_USERNAME")
 
-# Initialize database
-db = Database()
+# Near-duplicate detection settings
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", 6))  # Max differing bits for a near-duplicate
+PHASH_WORKERS = int(os.getenv("PHASH_WORKERS", 2))  # Processes used for perceptual hashing
 
-# Initialize the MTProto client for handling large files
-app = Client(
-    "media_handler_session",
-    api_id=API_ID,
-    api_hash=API_HASH,
-    bot_token=BOT_TOKEN,  # Using bot token for hybrid mode
-    workdir=os.getcwd()
-)
+# Download transfer settings
+TRANSFER_SESSIONS = int(os.getenv("TRANSFER_SESSIONS", 2))  # Extra sessions dedicated to downloads (0 uses the main client)
+TRANSFER_MAX_TRANSMISSIONS = int(os.getenv("TRANSFER_MAX_TRANSMISSIONS", 4))  # Concurrent transfers per download session
+
+# Ingest lane concurrency: files up to 20 MB, up to 300 MB, and larger
+INGEST_SMALL_WORKERS = int(os.getenv("INGEST_SMALL_WORKERS", 4))
+INGEST_MEDIUM_WORKERS = int(os.getenv("INGEST_MEDIUM_WORKERS", 2))
+INGEST_HUGE_WORKERS = int(os.getenv("INGEST_HUGE_WORKERS", 1))
+
+# Share of downloads and deliveries each tier gets under load, e.g. "premium=8,active=3,inactive=1"
+TIER_WEIGHTS = parse_tier_weights(os.getenv("TIER_WEIGHTS"))
+
+# Outgoing rate budget and the isolation of interactive commands from bulk work
+SEND_RATE = float(os.getenv("SEND_RATE", 25))  # Messages per second across all sends
+INTERACTIVE_RESERVE = float(os.getenv("INTERACTIVE_RESERVE", 0.3))  # Share of the send burst kept for interactive replies
+BULK_HANDLER_CONCURRENCY = int(os.getenv("BULK_HANDLER_CONCURRENCY", 8))  # Users whose uploads, relays and broadcasts are handled at once
+
+# Interactive commands get a reserved share of the send rate and are never stuck behind bulk work
+qos = QoS(rate=SEND_RATE, burst=SEND_RATE, interactive_reserve=INTERACTIVE_RESERVE, bulk_concurrency=BULK_HANDLER_CONCURRENCY)
+
+# Built by create_app(), so importing this module doesn't open the database or create clients
+db = None
+outbox = None
+phash_pool = None
+app = None
+transfer_pool = None
+ingest = None
+album_buffer = None
+forward_buffer = None
 
 # Constants
 MAX_SYNC_NORMAL = 20  # Maximum media files a normal user can sync
 REQUIRED_UPLOADS = 30  # Required uploads to become active
 ACTIVITY_PERIOD = 86400  # 24 hours in seconds
 MAX_FILE_SIZE = 2 * 1024 * 1024 * 1024  # 2GB in bytes
+MAX_TOP_USERS = 25  # Largest /top N that can be requested
+SEARCH_PAGE_SIZE = 10  # Users shown per /search results page
+MAX_SEARCH_SESSIONS = 200  # Recent /search queries kept for the page buttons
+MAX_KEYS_PER_BATCH = 500  # Maximum keys generated by a single /getkey
+REPORTS_PAGE_SIZE = 10  # Reported media per /reports page
+REPORT_EDIT_INTERVAL = 10  # Minimum seconds between edits of an admin report notification
+DIRTY_FLUSH_INTERVAL = 5  # Seconds between writes of deferred database changes
+ALBUM_WINDOW = 1.0  # Seconds to wait for more items of an album before handling it
+FORWARD_BATCH_WINDOW = 2.0  # Seconds to wait for more forwarded media before storing a backlog together
+
+# Outbox delivery settings
+OUTBOX_BATCH_SIZE = 50  # Messages claimed per dispatcher round
+OUTBOX_CONCURRENCY = 4  # Recipients served in parallel
+OUTBOX_SEND_DELAY = 0.1  # Pause between sends to the same recipient
+OUTBOX_MAX_ATTEMPTS = 5  # Attempts before a message is given up on
+OUTBOX_BASE_DELAY = 2  # Retry delay in seconds, doubled after every failed attempt
+OUTBOX_MAX_DELAY = 3600  # Longest retry delay in seconds
+OUTBOX_IDLE_INTERVAL = 1  # Seconds to wait when nothing is due
+OUTBOX_POLL_INTERVAL = 3  # Seconds between progress checks of a batch
+OUTBOX_RETENTION = 86400  # Seconds delivered messages are kept before being purged
+DEADLETTERS_PAGE_SIZE = 20  # Unreachable users per /deadletters page
+
+# Send errors that won't go away by retrying, mapped to the reason recorded for the recipient
+PERMANENT_SEND_ERRORS = (
+    (UserIsBlocked, "blocked"),
+    (InputUserDeactivated, "deactivated"),
+    (PeerIdInvalid, "peer_invalid")
+)
+# Returned by deliver_outbox_message when the recipient can't be reached at all
+RECIPIENT_UNREACHABLE = object()
+
+# Recent /search queries by token, referenced from the page buttons
+search_sessions = {}
+# Media whose admin report notification is being sent or updated, and when it was last edited
+pending_report_notifications = set()
+report_edit_times = {}
 
-# Global media processing queues - one per user
-user_media_queues = {}
-# Flag to track if the media processor is running for each user
-user_media_processors = {}
+# In-flight downloads keyed by file_unique_id, so concurrent uploads of the same content share one transfer
+inflight_downloads = {}
 
 # Helper functions
 # Custom filter for admin checks
@@ -89,8 +156,27 @@ def is_premium(user_id):
     # Explicitly check if user exists, has premium field, and premium is True
     return user is not None and "premium" in user and user["premium"] is True
 
+def get_user_tier(user_id):
+    """Get the scheduling tier of a user: premium (and admins), active, or inactive"""
+    if is_admin(user_id) or is_premium(user_id):
+        return "premium"
+    user = db.get_user(str(user_id))
+    return "active" if user and user["active"] else "inactive"
+
 # Message handlers
-@app.on_message(filters.command("start"))
+# Run before every other handler: anyone who contacts the bot can receive messages again
+@Client.on_message(filters.private, group=-1)
+async def mark_reachable_on_message(client: Client, message: Message):
+    if message.from_user and not db.is_reachable(message.from_user.id):
+        db.clear_unreachable(message.from_user.id)
+
+@Client.on_callback_query(group=-1)
+async def mark_reachable_on_callback(client: Client, callback_query: CallbackQuery):
+    if not db.is_reachable(callback_query.from_user.id):
+        db.clear_unreachable(callback_query.from_user.id)
+
+@Client.on_message(filters.command("start"))
+@qos.interactive
 async def start_command(client: Client, message: Message):
     """Handle the /start command with optional access key"""
     user_id = message.from_user.id
@@ -133,10 +219,9 @@ async def start_command(client: Client, message: Message):
     if len(command_parts) > 1:
         access_key = command_parts[1].strip().upper()
         
-        # Validate access key
-        if db.is_key_valid(access_key):
-            # Register user
-            db.add_user(str(user_id), username, user_name, access_key)
+        # Register user; the key is checked and redeemed in one step so concurrent
+        # registrations can't use a key more times than allowed
+        if db.add_user(str(user_id), username, user_name, access_key):
             user = db.get_user(str(user_id))
             
             # Send welcome message
@@ -146,15 +231,14 @@ async def start_command(client: Client, message: Message):
             
             # Send admin notification
             if OWNER_ID:
-                await client.send_message(
-                    OWNER_ID,
+                outbox.enqueue(OWNER_ID, text_payload(
                     f"🆕 **New User Joined**\n\n"
                     f"👤 User: {user_name} (@{username if username else 'No username'})\n"
                     f"🆔 ID: `{user_id}`\n"
                     f"🔑 Key: `{access_key}`\n"
                     f"🎭 Alias: {user['alias']}\n"
                     f"✨ Premium: {'Yes' if user['premium'] else 'No'}"
-                )
+                ))
         else:
             # Invalid key
             access_denied = utils.get_access_denied_message()
@@ -166,7 +250,8 @@ async def start_command(client: Client, message: Message):
         keyboard = utils.get_access_denied_keyboard()
         await message.reply(welcome_msg, reply_markup=keyboard)
 
-@app.on_message(filters.command("help"))
+@Client.on_message(filters.command("help"))
+@qos.interactive
 async def help_command(client: Client, message: Message):
     """Handle the /help command"""
     user_id = message.from_user.id
@@ -188,6 +273,7 @@ async def help_command(client: Client, message: Message):
         "🧲 /syncmedia - Get new media from vault\n"
         "📊 /mystats - Check your activity stats\n"
         "🚨 /report - Report content issues (reply to message)\n"
+        "🏆 /top [N] [today|week] - View top contributors\n"
         "🔗 /link - Access the community link\n"
         "📌 /showpin - View the pinned message\n"
         "🚪 /logout - Exit the bot and remove your data\n\n"
@@ -202,7 +288,7 @@ async def help_command(client: Client, message: Message):
     if admin_status:
         help_text += (
             "⚙️ **Admin Commands:**\n"
-            "🔑 /getkey [uses] [premium] - Generate access key\n"
+            "🔑 /getkey [uses] [premium] [count] - Generate access keys\n"
             "🚫 /ban <user_id> - Ban a user\n"
             "✅ /unban <user_id> - Unban a user\n"
             "⭐ /upgrade <user_id> - Upgrade user to premium\n"
@@ -217,11 +303,15 @@ async def help_command(client: Client, message: Message):
             "👤 /demote <user_id> - Demote admin to user\n"
             "📊 /status - View bot statistics\n"
             "🔒 /disablekey <key> - Disable an access key\n"
+            "🚨 /reports - Review reported media\n"
+            "📭 /deadletters - Users messages can't be delivered to\n"
+            "🚦 /queues - Queue depth, wait times and command latency\n"
         )
     
     await message.reply(help_text)
 
-@app.on_message(filters.command("report"))
+@Client.on_message(filters.command("report"))
+@qos.interactive
 async def report_command(client: Client, message: Message):
     """Handle the /report command to report inappropriate content"""
     user_id = message.from_user.id
@@ -257,11 +347,7 @@ async def report_command(client: Client, message: Message):
     file_id = getattr(replied_msg, media_type).file_id
     
     # Find media in database
-    media_id = None
-    for mid, media_data in db.media.items():
-        if media_data["file_id"] == file_id:
-            media_id = mid
-            break
+    media_id = db.find_media_by_file_id(file_id)
     
     if not media_id:
         await message.reply(
@@ -272,18 +358,7 @@ async def report_command(client: Client, message: Message):
         return
     
     # Add report to database
-    db.media[media_id]["reported"] = True
-    reporter_info = {
-        "user_id": str(user_id),
-        "time": time.time(),
-        "alias": db.get_user(user_id)["alias"]
-    }
-    
-    if "reports" not in db.media[media_id]:
-        db.media[media_id]["reports"] = []
-    
-    db.media[media_id]["reports"].append(reporter_info)
-    db._save_json(db.media_file, db.media)
+    db.report_media(media_id, user_id, db.get_user(str(user_id))["alias"])
     
     # Send confirmation to user
     report_msg = utils.get_report_message(media_id)
@@ -291,15 +366,62 @@ async def report_command(client: Client, message: Message):
     
     # Notify admin
     if OWNER_ID:
-        admin_report = utils.get_admin_report_message(
-            media_id,
-            user_id,
-            db.get_user(str(user_id))["alias"]
-        )
-        keyboard = utils.get_report_keyboard(media_id, user_id)
-        await client.send_message(OWNER_ID, admin_report, reply_markup=keyboard)
+        asyncio.create_task(notify_admin_of_report(client, media_id))
+
+async def notify_admin_of_report(client, media_id):
+    """
+    Keep one admin notification per reported media item up to date.
+    The first report sends the notification; later reports edit its counter, at most once
+    every REPORT_EDIT_INTERVAL seconds, so a burst of reports becomes a handful of edits.
+    """
+    # A running notifier picks up new reports by itself
+    if media_id in pending_report_notifications:
+        return
+    pending_report_notifications.add(media_id)
+    
+    try:
+        shown_count = 0
+        while True:
+            media_data = db.get_media(media_id)
+            if not media_data or not media_data.get("reported") or not media_data.get("reports"):
+                return
+            
+            report_count = len(media_data["reports"])
+            if report_count == shown_count:
+                return
+            
+            latest_report = media_data["reports"][-1]
+            admin_report = utils.get_admin_report_message(
+                media_id,
+                latest_report["user_id"],
+                latest_report["alias"],
+                report_count
+            )
+            keyboard = utils.get_report_keyboard(media_id, latest_report["user_id"])
+            
+            message_id = media_data.get("report_message_id")
+            if message_id is None:
+                sent = await client.send_message(OWNER_ID, admin_report, reply_markup=keyboard)
+                db.set_report_message(media_id, sent.id)
+            else:
+                wait = report_edit_times.get(media_id, 0) + REPORT_EDIT_INTERVAL - time.time()
+                if wait > 0:
+                    # Let more reports arrive, then show them all in one edit
+                    await asyncio.sleep(wait)
+                    continue
+                await client.edit_message_text(OWNER_ID, message_id, admin_report, reply_markup=keyboard)
+            
+            report_edit_times[media_id] = time.time()
+            shown_count = report_count
+    except FloodWait as e:
+        logger.warning(f"Flood wait while notifying admin of report on {media_id}: {e.value}s")
+    except Exception as e:
+        logger.error(f"Error notifying admin of report on {media_id}: {str(e)}")
+    finally:
+        pending_report_notifications.discard(media_id)
 
-@app.on_message(filters.command("mystats"))
+@Client.on_message(filters.command("mystats"))
+@qos.interactive
 async def mystats_command(client: Client, message: Message):
     """Handle the /mystats command"""
     user_id = message.from_user.id
@@ -320,7 +442,8 @@ async def mystats_command(client: Client, message: Message):
     
     await message.reply(stats_msg)
 
-@app.on_message(filters.command("syncmedia"))
+@Client.on_message(filters.command("syncmedia"))
+@qos.interactive
 async def syncmedia_command(client: Client, message: Message):
     """Handle the /syncmedia command with support for concurrent operations"""
     user_id = message.from_user.id
@@ -333,12 +456,12 @@ async def syncmedia_command(client: Client, message: Message):
     # Send an immediate acknowledgment to the user
     ack_msg = await message.reply("🔄 Processing your sync request...")
     
-    # Create a task to process the sync request asynchronously
-    # This allows the bot to handle other commands while processing sync requests
-    asyncio.create_task(process_sync_request(client, message, user_id, ack_msg))
+    # Process the request on the user's lane, so a second /syncmedia or a replace_sync click
+    # waits for it instead of racing on pending_sync; only the confirmed fan-out runs as its own task
+    await process_sync_request(client, message, user_id, ack_msg)
 
 async def process_sync_request(client: Client, message: Message, user_id, ack_msg):
-    """Process sync media request asynchronously to allow concurrent operations"""
+    """Process a sync media request and ask the user to confirm it"""
     try:
         # Check if user is active or premium
         user = db.get_user(str(user_id))
@@ -521,9 +644,10 @@ async def process_sync_request(client: Client, message: Message, user_id, ack_ms
 
 
 
-@app.on_message(filters.command("top"))
+@Client.on_message(filters.command("top"))
+@qos.interactive
 async def top_command(client: Client, message: Message):
-    """Handle the /top command to show top 5 contributors"""
+    """Handle the /top command to show top contributors, optionally for today or this week"""
     user_id = message.from_user.id
     
     # Check if user is authorized
@@ -531,14 +655,24 @@ async def top_command(client: Client, message: Message):
         await utils.handle_unauthorized_access(message)
         return
     
-    # Get top 5 users by upload count
-    top_users = db.get_top_users(limit=5)
+    # Parse optional count and period: /top [N] [today|week]
+    limit = 5
+    period = None
+    for arg in message.text.split()[1:]:
+        if arg.isdigit():
+            limit = max(1, min(int(arg), MAX_TOP_USERS))
+        elif arg.lower() in ("today", "week"):
+            period = arg.lower()
+    
+    # Get top users by upload count from the maintained leaderboard
+    top_users = db.get_top_users(limit=limit, period=period)
     
     # Generate and send top users message
-    top_users_msg = utils.get_top_users_message(top_users)
+    top_users_msg = utils.get_top_users_message(top_users, limit, period)
     await message.reply(top_users_msg)
 
-@app.on_message(filters.command("link"))
+@Client.on_message(filters.command("link"))
+@qos.interactive
 async def link_command(client: Client, message: Message):
     """Handle the /link command to show community link"""
     user_id = message.from_user.id
@@ -549,10 +683,11 @@ async def link_command(client: Client, message: Message):
         return
     
     # Show the current link
-    link_msg = utils.get_link_message()
+    link_msg = utils.get_link_message(db.get_community_link(), db.get_community_link_name())
     await message.reply(link_msg)
 
-@app.on_message(filters.command("set_link"))
+@Client.on_message(filters.command("set_link"))
+@qos.interactive
 async def set_link_command(client: Client, message: Message):
     """Handle the /set_link command to set community link with custom name"""
     user_id = message.from_user.id
@@ -599,10 +734,11 @@ async def set_link_command(client: Client, message: Message):
     )
     
     # For regular users or admins without a new link, show the current link
-    link_msg = utils.get_link_message()
+    link_msg = utils.get_link_message(db.get_community_link(), db.get_community_link_name())
     await message.reply(link_msg)
 
-@app.on_message(filters.command("logout"))
+@Client.on_message(filters.command("logout"))
+@qos.interactive
 async def logout_command(client: Client, message: Message):
     """Handle the /logout command to exit the bot"""
     user_id = message.from_user.id
@@ -630,7 +766,8 @@ async def logout_command(client: Client, message: Message):
         reply_markup=keyboard
     )
 
-@app.on_message(filters.command("admin"))
+@Client.on_message(filters.command("admin"))
+@qos.interactive
 async def admin_command(client: Client, message: Message):
     """Handle the /admin command to promote a user to admin"""
     user_id = message.from_user.id
@@ -665,7 +802,8 @@ async def admin_command(client: Client, message: Message):
     admin_msg = utils.get_admin_message(target_user_id, success)
     await message.reply(admin_msg)
 
-@app.on_message(filters.command("demote"))
+@Client.on_message(filters.command("demote"))
+@qos.interactive
 async def demote_command(client: Client, message: Message):
     """Handle the /demote command to demote an admin to regular user"""
     user_id = message.from_user.id
@@ -700,7 +838,8 @@ async def demote_command(client: Client, message: Message):
     demote_msg = utils.get_demote_message(target_user_id, success)
     await message.reply(demote_msg)
 
-@app.on_message(filters.command("ghost"))
+@Client.on_message(filters.command("ghost"))
+@qos.interactive
 async def ghost_command(client: Client, message: Message):
     """Handle the /ghost command to hide a user from top users list"""
     user_id = message.from_user.id
@@ -735,7 +874,8 @@ async def ghost_command(client: Client, message: Message):
     ghost_msg = utils.get_ghost_message(target_user_id, success)
     await message.reply(ghost_msg)
 
-@app.on_message(filters.command("unghost"))
+@Client.on_message(filters.command("unghost"))
+@qos.interactive
 async def unghost_command(client: Client, message: Message):
     """Handle the /unghost command to make a user visible in top users list"""
     user_id = message.from_user.id
@@ -770,7 +910,8 @@ async def unghost_command(client: Client, message: Message):
     unghost_msg = utils.get_unghost_message(target_user_id, success)
     await message.reply(unghost_msg)
 
-@app.on_message(filters.command("pin"))
+@Client.on_message(filters.command("pin"))
+@qos.interactive
 async def pin_command(client: Client, message: Message):
     """Handle the /pin command to pin a message and store it for all users"""
     user_id = message.from_user.id
@@ -843,7 +984,8 @@ async def pin_command(client: Client, message: Message):
                     "👉 Or reply to a message with /pin to pin it"
                 )
 
-@app.on_message(filters.command("image"))
+@Client.on_message(filters.command("image"))
+@qos.interactive
 async def image_command(client: Client, message: Message):
     """Handle the /image command for admins to upload an image"""
     user_id = message.from_user.id
@@ -864,6 +1006,8 @@ async def image_command(client: Client, message: Message):
         download_path = os.path.join(MEDIA_DIR, f"admin_image_{int(time.time())}.jpg")
         await client.download_media(message, file_name=download_path)
         
+        db.store.account_file(download_path)
+        
         # Add to database
         media_id = db.add_media(
             user_id=str(user_id),
@@ -887,15 +1031,17 @@ async def image_command(client: Client, message: Message):
 
 
 # Admin commands
-@app.on_message(filters.command("getkey") & filters.create(is_admin_filter))
+@Client.on_message(filters.command("getkey") & filters.create(is_admin_filter))
+@qos.interactive
 async def getkey_command(client: Client, message: Message):
-    """Generate a new access key"""
+    """Generate one or more access keys"""
     # Parse command arguments
     command_parts = message.text.split()
     
     # Default values
     uses = 1
     key_type = "normal"
+    count = 1
     
     # Parse uses if provided
     if len(command_parts) > 1 and command_parts[1].isdigit():
@@ -905,12 +1051,33 @@ async def getkey_command(client: Client, message: Message):
     if len(command_parts) > 2 and command_parts[2].lower() == "premium":
         key_type = "premium"
     
-    # Generate key
-    key = db.create_key(key_type, uses)
+    # Parse number of keys if provided
+    if len(command_parts) > 3 and command_parts[3].isdigit():
+        count = max(1, min(int(command_parts[3]), MAX_KEYS_PER_BATCH))
+    
+    # Generate keys with a single save
+    keys = db.create_keys(key_type, uses, count)
+    
+    if count > 1:
+        # Send the batch as a text file of keys and join links
+        lines = [f"{key}  https://t.me/{BOT_USERNAME}?start={key}" for key in keys]
+        document = io.BytesIO("\n".join(lines).encode("utf-8"))
+        document.name = f"{key_type}_keys_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+        await message.reply_document(
+            document,
+            caption=(
+                f"🔑 **{count} Access Keys Generated** 🔑\n\n"
+                f"📋 Type: {key_type.upper()}\n"
+                f"🔢 Max Uses: {uses} each\n\n"
+                f"⏱️ Keys valid for 24 hours\n"
+                f"🌟 Share with trusted users only"
+            )
+        )
+        return
     
     # Create custom join link with key embedded
-    bot_username = (await app.get_me()).username
-    join_link = f"https://t.me/{bot_username}?start={key}"
+    key = keys[0]
+    join_link = f"https://t.me/{BOT_USERNAME}?start={key}"
     
     await message.reply(
         f"🔑 **New Access Key Generated** 🔑\n\n"
@@ -922,7 +1089,8 @@ async def getkey_command(client: Client, message: Message):
         f"🌟 Share with trusted users only"
     )
 
-@app.on_message(filters.command("ban") & filters.create(is_admin_filter))
+@Client.on_message(filters.command("ban") & filters.create(is_admin_filter))
+@qos.interactive
 async def ban_command(client: Client, message: Message):
     """Ban a user"""
     # Parse command arguments
@@ -944,7 +1112,8 @@ async def ban_command(client: Client, message: Message):
     else:
         await message.reply(f"⚠️ **Ban Failed** ⚠️\n\n❌ Could not ban user {user_id}.\n📋 Possible reasons:\n• User may not exist\n• User is already banned")
 
-@app.on_message(filters.command("unban") & filters.create(is_admin_filter))
+@Client.on_message(filters.command("unban") & filters.create(is_admin_filter))
+@qos.interactive
 async def unban_command(client: Client, message: Message):
     """Unban a user"""
     # Parse command arguments
@@ -966,7 +1135,8 @@ async def unban_command(client: Client, message: Message):
     else:
         await message.reply(f"⚠️ **Unban Failed** ⚠️\n\n❌ Could not unban user {user_id}.\n📋 Possible reasons:\n• User may not exist\n• User is not currently banned")
 
-@app.on_message(filters.command("upgrade") & filters.create(is_admin_filter))
+@Client.on_message(filters.command("upgrade") & filters.create(is_admin_filter))
+@qos.interactive
 async def upgrade_command(client: Client, message: Message):
     """Upgrade a user to premium"""
     # Parse command arguments
@@ -988,9 +1158,7 @@ async def upgrade_command(client: Client, message: Message):
         
         # Notify user
         try:
-            user = db.get_user(str(user_id))
-            await client.send_message(
-                user_id,
+            outbox.enqueue(user_id, text_payload(
                 "🎉 **Congratulations!** 🎉\n\n"
                 "💎 You have been upgraded to **PREMIUM** status! 💎\n\n"
                 "✨ Your Premium Benefits:\n"
@@ -1001,13 +1169,14 @@ async def upgrade_command(client: Client, message: Message):
                 "• 🔔 Priority support\n"
                 "• 🚀 Faster download speeds\n\n"
                 "🎁 Enjoy your premium experience in the Media Vault!"
-            )
+            ))
         except Exception as e:
             logger.error(f"Error notifying user {user_id} about upgrade: {str(e)}")
     else:
         await message.reply(f"⚠️ **Upgrade Failed** ⚠️\n\n❌ Could not upgrade user {user_id}.\n📋 Possible reasons:\n• User may not exist\n• User is already a premium member")
 
-@app.on_message(filters.command("reset") & filters.create(is_admin_filter))
+@Client.on_message(filters.command("reset") & filters.create(is_admin_filter))
+@qos.interactive
 async def reset_command(client: Client, message: Message):
     """Reset a user's activity timer"""
     # Parse command arguments
@@ -1036,17 +1205,15 @@ async def reset_command(client: Client, message: Message):
     else:
         await message.reply(f"⚠️ **Reset Failed** ⚠️\n\n❌ Could not reset user {user_id}'s activity timer.\n📋 Possible reason:\n• User may not exist in the database")
 
-@app.on_message(filters.command("status") & filters.create(is_admin_filter))
+@Client.on_message(filters.command("status") & filters.create(is_admin_filter))
+@qos.interactive
 async def status_command(client: Client, message: Message):
     """Show bot status"""
     # Get stats
     stats = db.get_stats()
     
-    # Count files in media directory
-    media_count = len([f for f in os.listdir(MEDIA_DIR) if os.path.isfile(os.path.join(MEDIA_DIR, f))])
-    
-    # Calculate total size of media directory
-    total_size = sum(os.path.getsize(os.path.join(MEDIA_DIR, f)) for f in os.listdir(MEDIA_DIR) if os.path.isfile(os.path.join(MEDIA_DIR, f)))
+    # Storage totals are answered from memory, kept current by the media store
+    storage = stats["storage"]
     
     # Calculate uptime
     uptime_seconds = time.time() - BOT_START_TIME
@@ -1055,10 +1222,7 @@ async def status_command(client: Client, message: Message):
     reported_count = db.get_reported_media_count()
     
     # Get active keys count
-    active_keys = 0
-    for key, key_data in db.keys.items():
-        if not key_data.get("disabled", False) and (key_data.get("max_uses", 0) == 0 or key_data.get("uses", 0) < key_data.get("max_uses", 0)):
-            active_keys += 1
+    active_keys = db.count_active_keys()
     
     await message.reply(
         f"📊 **Media Vault Status** 📊\n\n"
@@ -1072,7 +1236,9 @@ async def status_command(client: Client, message: Message):
         f"📁 Media Stats:\n"
         f"   • 🗃️ Total Files: {stats['total_media_count']}\n"
         f"   • 🚨 Reported Content: {reported_count}\n"
-        f"   • 💾 Media Storage: {utils.format_size(total_size)}\n"
+        f"   • 💾 Media Storage: {utils.format_size(storage['bytes'])} ({storage['files']} files)\n"
+        f"   • ♻️ Saved by Dedupe: {utils.format_size(storage['duplicate_bytes'])}\n"
+        f"   • ⏳ Downloads in Progress: {utils.format_size(storage['temp_bytes'])}\n"
         f"   • 📊 Database Size: {utils.format_size(stats['database_size'])}\n\n"
         f"🔑 Access Keys:\n"
         f"   • 🔢 Total Generated: {stats['keys_generated']}\n"
@@ -1082,7 +1248,8 @@ async def status_command(client: Client, message: Message):
         f"🌟 Media Vault Network - Premium Media Sharing"
     )
 
-@app.on_message(filters.command("disablekey") & filters.create(is_admin_filter))
+@Client.on_message(filters.command("disablekey") & filters.create(is_admin_filter))
+@qos.interactive
 async def disablekey_command(client: Client, message: Message):
     """Disable an access key"""
     # Parse command arguments
@@ -1100,7 +1267,8 @@ async def disablekey_command(client: Client, message: Message):
     else:
         await message.reply(f"⚠️ **Disable Failed** ⚠️\n\n❌ Could not disable key {key}.\n📋 Possible reasons:\n• Key may not exist in the database\n• Key may already be disabled")
 
-@app.on_message(filters.command("broadcast") & filters.create(is_admin_filter))
+@Client.on_message(filters.command("broadcast") & filters.create(is_admin_filter))
+@qos.bulk
 async def broadcast_command(client: Client, message: Message):
     """Broadcast a message to all users"""
     # Get broadcast message
@@ -1116,44 +1284,49 @@ async def broadcast_command(client: Client, message: Message):
     # Send confirmation
     await message.reply(f"📣 **Broadcast Initiated** 📣\n\n🔄 Broadcasting message to all users...\n⏳ This may take some time depending on the number of users.\n📱 Users will receive a notification.")
     
-    # Send to all users
-    success_count = 0
-    fail_count = 0
+    # Queue for all users except banned ones; the outbox paces delivery and retries failures
+    batch_id = f"broadcast_{int(time.time() * 1000)}"
+    outbox.enqueue_many(
+        [(user_id, text_payload(broadcast_text)) for user_id, user_data in db.users.items()
+         if not user_data["banned"] and db.is_reachable(user_id)],
+        batch_id
+    )
     
-    for user_id in db.users:
-        # Skip banned users
-        if db.users[user_id]["banned"]:
-            continue
+    # Report the result from a separate task, so this handler doesn't hold a bulk slot and
+    # the admin's lane until every message is delivered
+    asyncio.create_task(report_broadcast_result(message, batch_id))
+
+async def report_broadcast_result(message: Message, batch_id):
+    """Tell the admin how a broadcast went once the outbox has finished with it"""
+    try:
+        progress = await wait_for_outbox_batch(batch_id)
+        success_count = progress[SENT]
+        fail_count = progress[FAILED]
         
-        try:
-            await client.send_message(int(user_id), broadcast_text)
-            success_count += 1
-            # Add delay to avoid flood limits
-            await asyncio.sleep(0.1)
-        except Exception as e:
-            logger.error(f"Error sending broadcast to user {user_id}: {str(e)}")
-            fail_count += 1
-    
-    await message.reply(
-        f"📣 **Broadcast Complete** 📣\n\n"
-        f"✅ Successfully delivered to: {success_count} users\n"
-        f"❌ Failed to deliver to: {fail_count} users\n\n"
-        f"📊 Success rate: {success_count/(success_count+fail_count)*100:.1f}%\n"
-        f"⏱️ Completed at: {datetime.now().strftime('%H:%M:%S')}\n\n"
-        f"🔔 Users have been notified of your announcement."
-    )
+        await message.reply(
+            f"📣 **Broadcast Complete** 📣\n\n"
+            f"✅ Successfully delivered to: {success_count} users\n"
+            f"❌ Failed to deliver to: {fail_count} users\n\n"
+            f"📊 Success rate: {success_count/max(success_count+fail_count, 1)*100:.1f}%\n"
+            f"⏱️ Completed at: {datetime.now().strftime('%H:%M:%S')}\n\n"
+            f"🔔 Users have been notified of your announcement."
+        )
+    except Exception as e:
+        logger.error(f"Error reporting broadcast {batch_id}: {str(e)}")
 
-@app.on_message(filters.command("delete") & filters.create(is_admin_filter))
+@Client.on_message(filters.command("delete") & filters.create(is_admin_filter))
+@qos.interactive
 async def delete_command(client: Client, message: Message):
     """Delete a media file"""
     # Parse command arguments
     command_parts = message.text.split()
     
     if len(command_parts) < 2:
-        await message.reply("🗑️ **Delete Error** 🗑️\n\n📝 Please provide a media ID to delete.\n💡 Example: /delete 123456789_987654")
+        await message.reply("🗑️ **Delete Error** 🗑️\n\n📝 Please provide a media ID to delete.\n💡 Example: /delete media_1234")
         return
     
-    media_id = command_parts[1].strip()
+    # Accept media_<n>, the bare number, or an ID from before media numbers
+    media_id = db.resolve_media_id(command_parts[1]) or command_parts[1].strip()
     
     # Delete media
     if db.delete_media(media_id):
@@ -1161,70 +1334,20 @@ async def delete_command(client: Client, message: Message):
     else:
         await message.reply(f"⚠️ **Delete Failed** ⚠️\n\n❌ Could not delete media {media_id}.\n📋 Possible reasons:\n• Media ID may not exist\n• Media file may have already been removed")
 
-# Media processing worker function for a specific user
-async def media_processor_worker(user_id):
-    """Worker function to process media from the queue for a specific user"""
-    str_user_id = str(user_id)
-    user_media_processors[str_user_id] = True
-    
-    # Track uploads for this user
-    user_uploads = {
-        "client": None,
-        "count": 0,
-        "last_time": time.time()
-    }
-    
-    try:
-        while True:
-            # Check if queue exists for this user
-            if str_user_id not in user_media_queues or user_media_queues[str_user_id].empty():
-                # No more items in queue, exit the worker
-                break
-                
-            # Get the next media item from the user's queue
-            media_item = await user_media_queues[str_user_id].get()
-            
-            try:
-                # Process the media item
-                client = media_item["client"]
-                message = media_item["message"]
-                progress_msg = media_item["progress_msg"]
-                
-                # Store client for notifications
-                user_uploads["client"] = client
-                
-                # Process the media
-                await process_media_item(client, message, user_id, progress_msg)
-                
-                # Track this upload
-                user_uploads["count"] += 1
-                user_uploads["last_time"] = time.time()
-                
-                # Wait for 2 seconds before processing the next item
-                await asyncio.sleep(0.5)
-                
-            except Exception as e:
-                logger.error(f"Error processing media from queue for user {user_id}: {str(e)}")
-            finally:
-                # Mark the task as done
-                user_media_queues[str_user_id].task_done()
-    except Exception as e:
-        logger.error(f"Media processor worker error for user {user_id}: {str(e)}")
-    finally:
-        # Send completion notification if there were uploads
-        if user_uploads["count"] > 0 and user_uploads["client"] is not None:
-            try:
-                await user_uploads["client"].send_message(
-                    int(user_id),
-                    f"Your Media Sharing Completed Enjoy Media"
-                )
-            except Exception as notify_error:
-                logger.error(f"Error sending completion notification to user {user_id}: {str(notify_error)}")
-        
-        # Mark processor as not running
-        user_media_processors[str_user_id] = False
+# Media ingest, run in lanes by file size
+async def run_ingest_job(job):
+    """Download and store one queued media item"""
+    if "media_id" in job:
+        await resume_pending_download(job["client"], job["media_id"])
+    else:
+        await process_media_item(job["client"], job["message"], job["user_id"], job["progress_msg"])
+
+async def notify_ingest_complete(user_id, count):
+    """Tell a user once everything they sent has been processed"""
+    outbox.enqueue(user_id, text_payload("Your Media Sharing Completed Enjoy Media"))
 
-@app.on_message(filters.command("search") & filters.create(is_admin_filter))
+@Client.on_message(filters.command("search") & filters.create(is_admin_filter))
+@qos.interactive
 async def search_command(client: Client, message: Message):
     """Search for users by their alias name"""
     # Parse command arguments
@@ -1238,23 +1361,38 @@ async def search_command(client: Client, message: Message):
         )
         return
     
-    # Search for users with matching alias
-    found_users = []
-    for user_id, user_data in db.users.items():
-        if search_query.lower() in user_data["alias"].lower():
-            found_users.append((user_id, user_data))
+    # Remember the query so the page buttons can refer to it by a short token
+    search_token = secrets.token_hex(4)
+    search_sessions[search_token] = search_query
+    while len(search_sessions) > MAX_SEARCH_SESSIONS:
+        search_sessions.pop(next(iter(search_sessions)))
     
-    if not found_users:
-        await message.reply(
+    results_message, keyboard = build_search_page(search_query, search_token, 0)
+    await message.reply(results_message, reply_markup=keyboard)
+
+def build_search_page(search_query, search_token, page):
+    """Build the text and pagination keyboard for one page of alias search results"""
+    # Candidate users come from the alias n-gram index instead of scanning every user
+    found_user_ids = db.search_users_by_alias(search_query)
+    
+    if not found_user_ids:
+        return (
             f"🔍 **Search Results** 🔍\n\n"
             f"❌ No users found with alias containing '{search_query}'."
-        )
-        return
+        ), None
+    
+    total_pages = (len(found_user_ids) + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+    page = max(0, min(page, total_pages - 1))
+    page_user_ids = found_user_ids[page * SEARCH_PAGE_SIZE:(page + 1) * SEARCH_PAGE_SIZE]
     
     # Format search results
-    results_message = f"🔍 **Search Results for '{search_query}'** 🔍\n\n"
+    results_message = (
+        f"🔍 **Search Results for '{search_query}'** 🔍\n"
+        f"📄 Page {page + 1}/{total_pages} ({len(found_user_ids)} users)\n\n"
+    )
     
-    for user_id, user_data in found_users:
+    for user_id in page_user_ids:
+        user_data = db.get_user(user_id)
         username = user_data.get("username", "No username")
         first_name = user_data.get("first_name", "Unknown")
         alias = user_data.get("alias", "No alias")
@@ -1269,9 +1407,124 @@ async def search_command(client: Client, message: Message):
             f"✨ Premium: {premium}\n\n"
         )
     
-    await message.reply(results_message)
+    keyboard = utils.get_search_results_keyboard(search_token, page, page < total_pages - 1)
+    return results_message, keyboard
+
+@Client.on_message(filters.command("reports") & filters.create(is_admin_filter))
+@qos.interactive
+async def reports_command(client: Client, message: Message):
+    """Review reported media, most reported first"""
+    reports_message, keyboard = build_reports_page(0)
+    await message.reply(reports_message, reply_markup=keyboard)
+
+def build_reports_page(page):
+    """Build the text and pagination keyboard for one page of the reported media queue"""
+    total = db.get_reported_media_count()
+    if not total:
+        return (
+            "🚨 **Reported Media** 🚨\n\n"
+            "✅ No reported media waiting for review."
+        ), None
+
+    total_pages = (total + REPORTS_PAGE_SIZE - 1) // REPORTS_PAGE_SIZE
+    page = max(0, min(page, total_pages - 1))
+
+    reports_message = (
+        f"🚨 **Reported Media** 🚨\n"
+        f"📄 Page {page + 1}/{total_pages} ({total} items)\n\n"
+    )
+
+    for media_id, report_count, last_report_time in db.get_report_queue(page * REPORTS_PAGE_SIZE, REPORTS_PAGE_SIZE):
+        media_data = db.get_media(media_id)
+        reports_message += (
+            f"📂 **{media_id}** ({media_data.get('media_type', 'media')})\n"
+            f"🎭 Uploader: {media_data.get('alias', 'Unknown')}\n"
+            f"🔢 Reports: {report_count} (latest {datetime.fromtimestamp(last_report_time).strftime('%Y-%m-%d %H:%M')})\n"
+            f"🗑️ /delete {media_id}\n\n"
+        )
 
-@app.on_message(filters.command("showpin"))
+    keyboard = utils.get_reports_keyboard(page, page < total_pages - 1)
+    return reports_message, keyboard
+
+@Client.on_message(filters.command("deadletters") & filters.create(is_admin_filter))
+@qos.interactive
+async def deadletters_command(client: Client, message: Message):
+    """Show users that messages can't be delivered to, and failed deliveries by reason"""
+    command_parts = message.text.split()
+    page = int(command_parts[1]) - 1 if len(command_parts) > 1 and command_parts[1].isdigit() else 0
+    
+    unreachable = db.get_unreachable_users()
+    failure_counts = outbox.failure_counts()
+    reason_labels = {
+        "blocked": "🚫 Blocked the bot",
+        "deactivated": "💀 Account deleted",
+        "peer_invalid": "❓ Unknown peer",
+        "transient": "⏳ Retries exhausted"
+    }
+    
+    total_pages = max(1, (len(unreachable) + DEADLETTERS_PAGE_SIZE - 1) // DEADLETTERS_PAGE_SIZE)
+    page = max(0, min(page, total_pages - 1))
+    
+    deadletters_message = (
+        f"📭 **Dead Letters** 📭\n\n"
+        f"👥 Unreachable users: {len(unreachable)}\n"
+        f"📨 Failed deliveries:\n"
+    )
+    if failure_counts:
+        for reason, count in sorted(failure_counts.items(), key=lambda item: item[1], reverse=True):
+            deadletters_message += f"   • {reason_labels.get(reason, reason)}: {count}\n"
+    else:
+        deadletters_message += "   • None\n"
+    
+    if unreachable:
+        deadletters_message += f"\n📄 Page {page + 1}/{total_pages}\n\n"
+        for user_id, info in unreachable[page * DEADLETTERS_PAGE_SIZE:(page + 1) * DEADLETTERS_PAGE_SIZE]:
+            user = db.get_user(user_id)
+            deadletters_message += (
+                f"🆔 `{user_id}` {user.get('alias', 'Unknown')}\n"
+                f"   {reason_labels.get(info['reason'], info['reason'])} since "
+                f"{datetime.fromtimestamp(info['since']).strftime('%Y-%m-%d %H:%M')}\n"
+            )
+        if page < total_pages - 1:
+            deadletters_message += f"\n➡️ Next page: /deadletters {page + 2}"
+    
+    await message.reply(deadletters_message)
+
+@Client.on_message(filters.command("queues") & filters.create(is_admin_filter))
+@qos.interactive
+async def queues_command(client: Client, message: Message):
+    """Show download and delivery queue depth and wait times for each tier"""
+    tier_labels = {"premium": "💎 Premium", "active": "✅ Active", "inactive": "💤 Inactive"}
+    
+    def format_waits(percentiles):
+        if percentiles is None:
+            return "no samples"
+        waits = [percentiles[point] for point in (50, 90, 99)]
+        return " / ".join(f"{wait:.2f}s" if wait < 60 else utils.format_uptime(wait) for wait in waits)
+    
+    queues_message = "🚦 **Queues by Tier** 🚦\n\nWaits shown as p50 / p90 / p99\n"
+    for title, depth, wait_stats in (
+        ("📥 Downloads", ingest.tier_depth(), ingest.wait_stats),
+        ("📤 Deliveries", outbox.tier_depth(), outbox.wait_stats)
+    ):
+        queues_message += f"\n{title} (weights {', '.join(f'{tier}={TIER_WEIGHTS[tier]}' for tier in TIERS)}):\n"
+        for tier in TIERS:
+            queues_message += (
+                f"   • {tier_labels[tier]}: {depth.get(tier, 0)} queued, "
+                f"waits {format_waits(wait_stats.percentiles(tier))}\n"
+            )
+    
+    interactive = qos.latency.percentiles("interactive")
+    queues_message += (
+        f"\n⚡ Interactive commands (target {qos.latency_target * 1000:.0f} ms): "
+        f"{' / '.join(f'{interactive[point] * 1000:.0f} ms' for point in (50, 90, 99)) if interactive else 'no samples'}\n"
+        f"🏗️ Bulk handlers running or waiting: {qos.bulk_backlog()}\n"
+    )
+    
+    await message.reply(queues_message)
+
+@Client.on_message(filters.command("showpin"))
+@qos.interactive
 async def showpin_command(client: Client, message: Message):
     """Handle the /showpin command to show the pinned message"""
     user_id = message.from_user.id
@@ -1295,7 +1548,8 @@ async def showpin_command(client: Client, message: Message):
         await message.reply("📌 No pinned message found.")
 
 # Handle unknown commands
-@app.on_message(filters.private & filters.command([]) & ~filters.command(["start", "help", "mystats", "syncmedia", "admin", "top", "link", "logout", "report", "getkey", "broadcast", "pin", "ban", "unban", "ghost", "unghost", "search", "showpin"]))
+@Client.on_message(filters.private & filters.command([]) & ~filters.command(["start", "help", "mystats", "syncmedia", "admin", "top", "link", "logout", "report", "getkey", "broadcast", "pin", "ban", "unban", "ghost", "unghost", "search", "showpin", "reports", "deadletters", "queues"]))
+@qos.interactive
 async def unknown_command(client: Client, message: Message):
     """Handle unknown commands by directing users to /help"""
     user_id = message.from_user.id
@@ -1312,7 +1566,8 @@ async def unknown_command(client: Client, message: Message):
     )
 
 # Anonymous chat message handling
-@app.on_message(filters.private & filters.text & ~filters.via_bot & ~filters.forwarded)
+@Client.on_message(filters.private & filters.text & ~filters.via_bot & ~filters.forwarded)
+@qos.bulk
 async def handle_text_message(client: Client, message: Message):
     """Handle private text messages for anonymous chat"""
     user_id = message.from_user.id
@@ -1367,21 +1622,11 @@ async def handle_text_message(client: Client, message: Message):
         return
         
     # Get all users with active plans or premium, not just online users
-    active_users = {uid: user for uid, user in db.users.items() 
-                   if (user.get("active", False) or user.get("premium", False)) and not user.get("banned", False)}
+    active_users = db.get_fanout_recipients()
     
     # Broadcast message to all active users except sender
-    sent_count = 0
-    for active_id, active_user in active_users.items():
-        if active_id != str(user_id):  # Don't send to self
-            try:
-                await client.send_message(
-                    int(active_id),
-                    f"👤 **{user['alias']}** says:\n\n{text}"
-                )
-                sent_count += 1
-            except Exception as e:
-                logger.error(f"Error sending message to user {active_id}: {str(e)}")
+    relayed_text = text_payload(f"👤 **{user['alias']}** says:\n\n{text}")
+    outbox.enqueue_many([(active_id, relayed_text) for active_id in active_users if active_id != str(user_id)])
     
     # Don't send confirmation to sender
     pass
@@ -1393,14 +1638,19 @@ async def share_user_media_with_active_users(client: Client, user_id):
     user = db.get_user(str_user_id)
     
     # Get all active users except the current user
-    active_users = {uid: user_data for uid, user_data in db.users.items() 
-                   if (user_data.get("active", False) or user_data.get("premium", False)) 
-                   and not user_data.get("banned", False) and uid != str_user_id}
+    active_users = db.get_fanout_recipients(exclude=str_user_id)
     
     # Get all media from this user
     user_media_ids = user.get("media_ids", [])
     
-    # Share each media with active users
+    # Prepare caption with only the alias name with embedded bot link
+    new_caption = f"Shared by: <a href=\"https://telegram.me/SIN_CITY_C_BOT\">{user['alias']}</a>"
+    
+    # Media synced to each non-premium user, counting what is queued here but not yet delivered
+    synced_counts = {uid: len(user_data.get("synced_media", [])) for uid, user_data in active_users.items()}
+    
+    # Queue each media for active users; the outbox marks it synced once delivered
+    outgoing = []
     for media_id in user_media_ids:
         if media_id in db.media:
             media_data = db.media[media_id]
@@ -1409,49 +1659,54 @@ async def share_user_media_with_active_users(client: Client, user_id):
             
             # Only share if we have the necessary data
             if file_id and media_type:
-                # Prepare caption with only the alias name with embedded bot link
-                new_caption = f"Shared by: <a href=\"https://telegram.me/SIN_CITY_C_BOT\">{user['alias']}</a>"
-                
-                # Import ParseMode enum
-                from pyrogram import enums
-                
-                # Share with each active user
                 for active_id, active_user in active_users.items():
-                    try:
-                        # Check if user has synced media limit (for non-premium users)
-                        if not active_user.get("premium", False):
-                            # Get count of synced media for this user
-                            synced_media_count = len(active_user.get("synced_media", []))
-                            
-                            # If user has reached the limit of 30 media items, skip
-                            if synced_media_count >= 30:
-                                continue
-                        
-                        # Send media to active user
-                        await client.send_cached_media(
-                            chat_id=int(active_id),
-                            file_id=file_id,
-                            caption=new_caption,
-                            parse_mode=enums.ParseMode.HTML
-                        )
-                        
-                        # Add this media to user's synced media list for tracking limits
-                        if not active_user.get("premium", False):
-                            # Mark media as synced for this user
-                            db.mark_media_synced(active_id, media_id)
-                    except Exception as e:
-                        logger.error(f"Error sharing media {media_id} with user {active_id}: {str(e)}")
+                    is_premium = active_user.get("premium", False)
+                    
+                    # Non-premium users stop receiving media at the limit of 30 items
+                    if not is_premium:
+                        if synced_counts[active_id] >= 30:
+                            continue
+                        synced_counts[active_id] += 1
+                    
+                    outgoing.append((active_id, media_payload(file_id, media_type, new_caption, media_id, mark_synced=not is_premium)))
+    
+    outbox.enqueue_many(outgoing)
 
 # Media handling for anonymous chat
-@app.on_message(filters.private & (filters.video | filters.document | filters.photo | filters.animation))
+@Client.on_message(filters.private & (filters.video | filters.document | filters.photo | filters.animation))
+@qos.bulk
 async def handle_media(client: Client, message: Message):
     """Handle incoming media files up to 2GB with concurrent processing support"""
-    user_id = message.from_user.id
+    # Items of an album arrive as separate updates; collect them and handle the album as one
+    if message.media_group_id:
+        album_buffer.add(client, message)
+        return
+    
+    # A backlog of forwarded media arrives as a burst; store it in one batch
+    if message.forward_date is not None:
+        forward_buffer.add(client, message, group_id="forwarded")
+        return
+    
+    await handle_media_messages(client, [message])
+
+def handle_album(client: Client, messages):
+    """Handle a collected album on its sender's lane, in order with their other updates"""
+    qos.dispatcher.submit(messages[0].from_user.id, handle_media_messages, client, messages)
+
+def handle_forwarded_batch(client: Client, messages):
+    """Handle a burst of forwarded media on its sender's lane; the items are shared one by one"""
+    qos.dispatcher.submit(messages[0].from_user.id, handle_media_messages, client, messages, False)
+
+async def handle_media_messages(client: Client, messages, as_album=True):
+    """Store and share media from one user: a single item, an album, or a batch of forwarded items
+    Albums are shared as albums, other batches (as_album=False) item by item"""
+    first_message = messages[0]
+    user_id = first_message.from_user.id
     str_user_id = str(user_id)
     
     # Check if user is authorized
     if not is_authorized(str_user_id):
-        await utils.handle_unauthorized_access(message)
+        await utils.handle_unauthorized_access(first_message)
         return
     
     # Update user activity (marks them as online)
@@ -1461,184 +1716,246 @@ async def handle_media(client: Client, message: Message):
     user = db.get_user(str_user_id)
     
     # Check if this is a forwarded message
-    is_forwarded = message.forward_date is not None
+    is_forwarded = first_message.forward_date is not None
     
     # Don't show any processing message to users
     # Media will be processed in background silently
     # Use a dummy message object instead of sending an empty message
     progress_msg = None
     
-    # Create a queue for this user if it doesn't exist
-    if str_user_id not in user_media_queues:
-        user_media_queues[str_user_id] = Queue()
-    
-    # Add media to user's queue
-    await user_media_queues[str_user_id].put({
-        "client": client,
-        "message": message,
-        "progress_msg": progress_msg
-    })
+    # Get media type, file_id and size from the message metadata,
+    # rejecting oversized files before they count towards anything
+    accepted = []
+    for message in messages:
+        media_type = message.media.value
+        media_obj = getattr(message, media_type)
+        file_size = getattr(media_obj, "file_size", 0) or 0
+        if file_size <= MAX_FILE_SIZE:
+            accepted.append((message, media_type, media_obj, file_size))
+    
+    if len(accepted) < len(messages):
+        await first_message.reply(f"⚠️ **File Too Large** ⚠️\n\nYour file exceeds the maximum size limit of 2GB.\nPlease upload a smaller file.")
+    if not accepted:
+        return
     
-    # Start a processor for this user if not already running
-    if str_user_id not in user_media_processors or not user_media_processors[str_user_id]:
-        asyncio.create_task(media_processor_worker(user_id))
+    # Count the media towards the user's activity right away; the download fills in
+    # the stored file later, so users don't wait on big transfers to become active
+    was_active = user["active"]
+    media_ids = db.add_media_batch(str_user_id, [
+        {
+            "file_id": media_obj.file_id,
+            "file_size": file_size,
+            "media_type": media_type,
+            "caption": utils.clean_caption(message.caption),
+            "file_unique_id": media_obj.file_unique_id
+        }
+        for message, media_type, media_obj, file_size in accepted
+    ])
+    if media_ids is None:
+        return
     
-    # Count media in queue as installed so user doesn't have to wait
-    # This is done by immediately marking the media as processed for the user
-    # The actual download will happen in the background
+    # Queue the downloads in the lanes for their size, so small files overtake large ones
+    tier = get_user_tier(user_id)
+    for message, media_type, media_obj, file_size in accepted:
+        ingest.submit(str_user_id, file_size, {
+            "client": client,
+            "message": message,
+            "user_id": user_id,
+            "progress_msg": progress_msg
+        }, tier=tier)
+    
+    # Check if user became active after this media count
+    user = db.get_user(str_user_id)
+    if not was_active and user["active"] and not user["premium"]:
+        # Now share all their previously sent media with active users
+        await share_user_media_with_active_users(client, user_id)
+        # Send activation message to user
+        await first_message.reply(utils.get_activation_message())
+    
+    # If user is inactive and not premium, their media counts towards activity
+    # but isn't shared with others until they become active
+    if not was_active and not user["premium"]:
+        return
+
+    # Media is shared right away when it has a caption or is forwarded
+    if not is_forwarded and not any(message.caption for message, _, _, _ in accepted):
+        return
     
-    # If user is inactive and not premium, but the message is forwarded, count it towards activity
-    # but don't share with others until they become active
-    if not user["active"] and not user["premium"]:
-        # If it's not a forwarded message, return immediately
-        if not is_forwarded:
+    # Check captions for NSFW content and links; an album usually carries its caption on one item
+    for message, _, _, _ in accepted:
+        if not message.caption:
+            continue
+        caption = message.caption
+        
+        # Check for t.me links and usernames, but allow other links in all media
+        contains_tme_link = any('t.me' in word for word in caption.split())
+        contains_username = '@' in caption
+        
+        if contains_tme_link or contains_username:
+            # For forwarded media, remove links instead of blocking
+            if is_forwarded:
+                # Continue processing but remove the caption
+                message.caption = None
+                continue
+            await first_message.reply(
+                "⚠️ **Media Not Sent** ⚠️\n\n"
+                "Your media caption contains a t.me link or username, which is not allowed in the anonymous chat.\n"
+                "Please send media without t.me links or usernames in the caption. Regular links are allowed."
+            )
             return
         
-        # For forwarded media from inactive users, immediately count it towards activity
-        # without waiting for download to complete
-        # Get media type and file_id
-        media_type = message.media.value
-        file_id = getattr(message, media_type).file_id
+        # Enhanced NSFW word filter
+        nsfw_words = ['porn', 'sex', 'xxx', 'nude', 'naked', 'fuck', 'dick', 'pussy', 'ass', 'boobs', 'tits', 'anal', 'cum', 'blowjob', 'bdsm', 'hentai', 'fetish', 'orgasm', 'masturbate', 'dildo', 'vibrator', 'escort', 'hooker', 'whore', 'slut']
+        if any(word.lower() in caption.lower() for word in nsfw_words):
+            # For forwarded media, remove NSFW content instead of blocking
+            if is_forwarded:
+                # Continue processing but remove the caption
+                message.caption = None
+                continue
+            await first_message.reply(
+                "⚠️ **Media Not Sent** ⚠️\n\n"
+                "Your media caption contains inappropriate content that is not allowed in the anonymous chat.\n"
+                "Please keep conversations appropriate."
+            )
+            return
+    
+    # Get all users with active plans or premium, not just online users
+    active_users = db.get_fanout_recipients(exclude=str_user_id)
+    
+    # Prepare caption with only the alias name with embedded bot link
+    # Don't append the original caption as per user's request
+    new_caption = f"Shared by: <a href=\"https://telegram.me/SIN_CITY_C_BOT\">{user['alias']}</a>"
+    
+    items = [
+        {"file_id": media_obj.file_id, "media_type": media_type, "media_id": media_id}
+        for (_, media_type, media_obj, _), media_id in zip(accepted, media_ids)
+    ]
+    
+    # Queue the media for all active users except sender, as one album per recipient
+    outgoing = []
+    for active_id, active_user in active_users.items():
+        is_premium = active_user.get("premium", False)
+        
+        # Check if user has synced media limit (for non-premium users)
+        # Premium users have no limit
+        allowed = len(items) if is_premium else 30 - len(active_user.get("synced_media", []))
+        if allowed <= 0:
+            # Only send the notification once per user
+            if not active_user.get("limit_notified", False):
+                outgoing.append((active_id, text_payload("You missed this media. Upgrade to premium so you can't miss out!")))
+                # Mark user as notified
+                db.update_user(active_id, {"limit_notified": True})
+            continue
         
-        # Get file_unique_id based on media type
+        shared = items[:allowed]
+        # Albums can't hold animations, so those are sent on their own after the rest
+        album_items = [item for item in shared if item["media_type"] != "animation"] if as_album else []
+        if len(album_items) > 1:
+            outgoing.append((active_id, album_payload(album_items, new_caption, mark_synced=not is_premium)))
+            shared = [item for item in shared if item["media_type"] == "animation"]
+        for item in shared:
+            outgoing.append((active_id, media_payload(item["file_id"], item["media_type"], new_caption, item["media_id"], mark_synced=not is_premium)))
+    
+    outbox.enqueue_many(outgoing)
+
+async def compute_perceptual_hash(client: Client, message: Message, media_type, file_path):
+    """Hash a photo, or a video's thumbnail keyframe where Telegram provides one, in the process pool"""
+    if not phash.PIL_AVAILABLE:
+        return None
+    
+    try:
         if media_type == "photo":
-            # For photos, use the biggest size's file_unique_id
-            file_unique_id = message.photo.file_unique_id
+            source = file_path
+        elif media_type in ("video", "animation") and message is not None and getattr(message, media_type).thumbs:
+            # The thumbnail is tiny, so fetch it into memory instead of decoding the video
+            thumb = await client.download_media(getattr(message, media_type).thumbs[0].file_id, in_memory=True)
+            source = bytes(thumb.getbuffer())
         else:
-            # For videos/documents/audio, use their own file_unique_id
-            file_unique_id = getattr(message, media_type).file_unique_id
-        
-        # Clean caption
-        caption = utils.clean_caption(message.caption)
-        
-        # Add to database immediately without waiting for download
-        # This will count towards user's activity requirement
-        media_id = db.add_media_instant(str(user_id), file_id, None, 0, media_type, caption, file_unique_id)
+            return None
         
-        # Check if user became active after this media count
-        user = db.get_user(str(user_id))
-        if user["uploads"] >= REQUIRED_UPLOADS and not user["premium"] and user["active"]:
-            # User just became active
-            # Now share all their previously forwarded media with active users
-            await share_user_media_with_active_users(client, user_id)
-            # Send activation message to user
-            await message.reply(utils.get_activation_message())
-        
-        # Still add to queue for actual download in background
-        # but return after to prevent immediate sharing
-        
-        # Return after the media is added to the queue to prevent sharing until they're active
-        # The media will be processed in the background by the media_processor_worker
-        return
+        return await asyncio.get_event_loop().run_in_executor(phash_pool, phash.dhash, source)
+    except Exception as e:
+        logger.error(f"Error computing perceptual hash: {str(e)}")
+        return None
 
-    # Check caption for NSFW content and links if present, or if it's a forwarded message
-    if message.caption or is_forwarded:
-        if message.caption:
-            caption = message.caption
-            
-            # Check for t.me links and usernames, but allow other links in all media
-            contains_tme_link = any('t.me' in word for word in caption.split())
-            contains_username = '@' in caption
-            
-            if contains_tme_link or contains_username:
-                # For forwarded media, remove links instead of blocking
-                if is_forwarded:
-                    # Continue processing but remove the caption
-                    message.caption = None
-                else:
-                    await message.reply(
-                        "⚠️ **Media Not Sent** ⚠️\n\n"
-                        "Your media caption contains a t.me link or username, which is not allowed in the anonymous chat.\n"
-                        "Please send media without t.me links or usernames in the caption. Regular links are allowed."
-                    )
-                    return
-            
-            # Enhanced NSFW word filter
-            nsfw_words = ['porn', 'sex', 'xxx', 'nude', 'naked', 'fuck', 'dick', 'pussy', 'ass', 'boobs', 'tits', 'anal', 'cum', 'blowjob', 'bdsm', 'hentai', 'fetish', 'orgasm', 'masturbate', 'dildo', 'vibrator', 'escort', 'hooker', 'whore', 'slut']
-            if any(word.lower() in caption.lower() for word in nsfw_words):
-                # For forwarded media, remove NSFW content instead of blocking
-                if is_forwarded:
-                    # Continue processing but remove the caption
-                    message.caption = None
-                else:
-                    await message.reply(
-                        "⚠️ **Media Not Sent** ⚠️\n\n"
-                        "Your media caption contains inappropriate content that is not allowed in the anonymous chat.\n"
-                        "Please keep conversations appropriate."
-                    )
-                    return
-        
-        # Get all users with active plans or premium, not just online users
-        active_users = {uid: user for uid, user in db.users.items() 
-                       if (user.get("active", False) or user.get("premium", False)) and not user.get("banned", False)}
-        
-        # Don't send acknowledgment to the user
-        pass
-        
-        # Broadcast media to all active users except sender
-        sent_count = 0
-        for active_id, active_user in active_users.items():
-            if active_id != str(user_id):  # Don't send to self
-                try:
-                    # Check if user has synced media limit (for non-premium users)
-                    # Premium users have no limit
-                    if not active_user.get("premium", False):
-                        # Get count of synced media for this user
-                        synced_media_count = len(active_user.get("synced_media", []))
-                        
-                        # If user has reached the limit of 30 media items, skip and send notification
-                        if synced_media_count >= 30:
-                            try:
-                                # Only send the notification once per user
-                                if not active_user.get("limit_notified", False):
-                                    await client.send_message(
-                                        int(active_id),
-                                        "You missed this media. Upgrade to premium so you can't miss out!"
-                                    )
-                                    # Mark user as notified
-                                    db.update_user(active_id, {"limit_notified": True})
-                            except Exception as notify_error:
-                                logger.error(f"Error sending limit notification: {str(notify_error)}")
-                            continue
-                    
-                    # Forward the media with modified caption
-                    if message.media:
-                        # Get the appropriate media object based on media type
-                        media_type = message.media.value
-                        media_obj = getattr(message, media_type)
-                        
-                        # Prepare caption with only the alias name with embedded bot link
-                        new_caption = f"Shared by: <a href=\"https://telegram.me/SIN_CITY_C_BOT\">{user['alias']}</a>"
-                        # Don't append the original caption as per user's request
-                        
-                        # Import ParseMode enum
-                        from pyrogram import enums
-                        
-                        # Send media with new caption
-                        await client.send_cached_media(
-                            chat_id=int(active_id),
-                            file_id=media_obj.file_id,
-                            caption=new_caption,
-                            parse_mode=enums.ParseMode.HTML
-                        )
-                        sent_count += 1
-                        
-                        # Add this media to user's synced media list for tracking limits
-                        # First, we need to get the media_id for this file_id
-                        media_id = None
-                        for mid, mdata in db.media.items():
-                            if mdata.get("file_id") == media_obj.file_id:
-                                media_id = mid
-                                break
-                        
-                        if media_id and not active_user.get("premium", False):
-                            # Mark media as synced for this user
-                            db.mark_media_synced(active_id, media_id)
-                except Exception as e:
-                    logger.error(f"Error sending media to user {active_id}: {str(e)}")
-        
-        # Don't confirm to sender
-        pass
+async def single_flight_download(file_unique_id, download):
+    """Run download() once per file_unique_id; concurrent callers for the same content await the same result"""
+    if not file_unique_id:
+        return await download()
+    
+    # Attach to a download of this content that is already running
+    if file_unique_id in inflight_downloads:
+        logger.info(f"Joining in-flight download for {file_unique_id}")
+        return await asyncio.shield(inflight_downloads[file_unique_id])
+    
+    future = asyncio.get_event_loop().create_future()
+    inflight_downloads[file_unique_id] = future
+    try:
+        result = await download()
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        # Mark the exception as retrieved in case nobody else was waiting on it
+        future.exception()
+        raise
+    finally:
+        del inflight_downloads[file_unique_id]
+
+async def download_media(client: Client, user_id, file_id, file_unique_id):
+    """
+    Get a media file into the store by file_id, retrying failed transfers.
+    Returns (file_path, content_hash, file_size, stored); stored is True when the content
+    was already held and nothing was downloaded, in which case file_size is None.
+    """
+    # Unique temp file name, so concurrent downloads for the same user never share a file;
+    # the final path is derived from the content hash
+    temp_name = f"{user_id}_{uuid.uuid4().hex}"
+    
+    # Download the file without progress updates
+    # Use a try-except block with multiple retries for file operations
+    max_retries = 3
+    
+    async def download_to_store():
+        retry_count = 0
+        while True:
+            try:
+                # Stream into the sink, which hashes and counts chunks as they are written;
+                # the transfer runs on one of the download sessions, by file_id
+                async with transfer_pool.acquire(client) as transfer_client:
+                    with db.store.open_sink(temp_name) as sink:
+                        async for chunk in transfer_client.stream_media(file_id):
+                            sink.write(chunk)
+                
+                logger.info(
+                    f"Downloaded {utils.format_size(sink.size)} for user {user_id} in {sink.elapsed:.2f}s "
+                    f"({utils.format_size(sink.throughput)}/s) via {transfer_client.name}"
+                )
+                
+                # Moving into the store is an atomic rename to a content-addressed path
+                return db.store.put(sink.temp_path, sink.digest), sink.digest, sink.size
+                
+            except Exception as e:
+                retry_count += 1
+                logger.error(f"Download attempt {retry_count} failed: {str(e)}")
+                
+                # If this was the last retry and it failed, drop the partial file and raise the exception
+                if retry_count >= max_retries:
+                    db.store.discard_temp(db.store.temp_path(temp_name))
+                    raise
+                await asyncio.sleep(1)  # Wait before retrying
+    
+    # Skip the transfer entirely if we already hold this content,
+    # otherwise share a single download with concurrent uploads of it
+    stored = db.find_stored_file(file_unique_id)
+    if stored:
+        logger.info(f"Content {file_unique_id} already stored, skipping download")
+        download_path, content_hash = stored
+        return download_path, content_hash, None, True
+    
+    # The sink reports the true size, which the message metadata may not carry
+    download_path, content_hash, file_size = await single_flight_download(file_unique_id, download_to_store)
+    return download_path, content_hash, file_size, False
 
 async def process_media_item(client: Client, message: Message, user_id, progress_msg):
     """Process a single media item from the queue"""
@@ -1646,7 +1963,6 @@ async def process_media_item(client: Client, message: Message, user_id, progress
         # Determine media type
         media_type = message.media.value
         file_id = getattr(message, media_type).file_id
-        file_name = getattr(getattr(message, media_type), "file_name", None)
         
         # Get file_unique_id based on media type
         if media_type == "photo":
@@ -1660,15 +1976,15 @@ async def process_media_item(client: Client, message: Message, user_id, progress
         caption = utils.clean_caption(message.caption)
         
         # Check if we've already processed this file from this user
-        for media_id, media_data in db.media.items():
-            if media_data["file_id"] == file_id and media_data["user_id"] == str(user_id):
-                # Delete the progress message silently if it exists
-                if progress_msg is not None:
-                    try:
-                        await progress_msg.delete()
-                    except Exception:
-                        pass
-                return
+        existing_media_id = db.find_user_media(user_id, file_id)
+        if existing_media_id and not db.media[existing_media_id].get("pending_download", False):
+            # Delete the progress message silently if it exists
+            if progress_msg is not None:
+                try:
+                    await progress_msg.delete()
+                except Exception:
+                    pass
+            return
         
         # Check file size (if available)
         file_size = getattr(getattr(message, media_type), "file_size", 0)
@@ -1694,116 +2010,37 @@ async def process_media_item(client: Client, message: Message, user_id, progress
                 await progress_msg.delete()
             except Exception:
                 pass
-        start_time = asyncio.get_event_loop().time()
-        
-        # Generate a unique timestamp to prevent conflicts with concurrent uploads
-        timestamp = int(start_time * 1000)  # Millisecond precision
-        
-        # Custom file name with user ID and unique timestamp to prevent conflicts
-        custom_file_name = f"{user_id}_{timestamp}"
-        if file_name:
-            # Keep original extension if available
-            ext = os.path.splitext(file_name)[1]
-            if ext:
-                custom_file_name += ext
-        
-        # Create a unique temp file path to avoid conflicts
-        temp_file_path = os.path.join(MEDIA_DIR, f"{custom_file_name}.temp")
-        final_file_path = os.path.join(MEDIA_DIR, custom_file_name)
-        
-        # Define progress callback - but don't show progress to user
-        async def progress_callback(current, total):
-            # We're not showing progress to the user anymore, but we'll keep the callback
-            # for internal tracking purposes
-            pass
-        
-        # Download the file without progress updates
-        # Use a try-except block with multiple retries for file operations
-        max_retries = 3
-        retry_count = 0
-        download_success = False
         
-        # Import file lock mechanism
-        from file_lock import media_operation_lock
+        download_path, content_hash, downloaded_size, stored = await download_media(client, user_id, file_id, file_unique_id)
+        if downloaded_size is not None:
+            file_size = downloaded_size
         
-        # Generate a unique operation ID for this download
-        operation_id = f"download_{user_id}_{int(start_time * 1000)}"
-        
-        while retry_count < max_retries and not download_success:
-            try:
-                # First download to temp file
-                download_path = await message.download(
-                    file_name=temp_file_path,
-                    progress=progress_callback
-                )
-                
-                # Use file lock when renaming to prevent concurrent access issues
-                with media_operation_lock(operation_id, "rename"):
-                    # Rename temp file to final file
-                    if os.path.exists(temp_file_path):
-                        # If the final file already exists (unlikely but possible), remove it first
-                        if os.path.exists(final_file_path):
-                            os.remove(final_file_path)
-                        
-                        os.rename(temp_file_path, final_file_path)
-                        download_path = final_file_path
-                        download_success = True
-                
-            except Exception as e:
-                retry_count += 1
-                logger.error(f"Download attempt {retry_count} failed: {str(e)}")
-                await asyncio.sleep(1)  # Wait before retrying
-                
-                # If this was the last retry and it failed, raise the exception
-                if retry_count >= max_retries:
-                    raise
-        
-        # Calculate download time
-        download_time = asyncio.get_event_loop().time() - start_time
-        download_speed = file_size / download_time if download_time > 0 else 0
+        # Perceptual hash for near-duplicate detection (exact copies are already caught by file_unique_id)
+        perceptual_hash = None if stored else await compute_perceptual_hash(client, message, media_type, download_path)
         
         # Check if this media was already added instantly for forwarded media
-        existing_media_id = None
-        for mid, mdata in db.media.items():
-            if mdata.get("file_id") == file_id and mdata.get("user_id") == str(user_id) and mdata.get("pending_download", False):
-                existing_media_id = mid
-                break
-        
         if existing_media_id:
             # Update the existing media entry with the downloaded file path and size
-            db.media[existing_media_id]["file_path"] = download_path
-            db.media[existing_media_id]["file_size"] = file_size
-            db.media[existing_media_id]["pending_download"] = False
-            db._save_json(db.media_file, db.media)
+            db.complete_pending_download(existing_media_id, download_path, file_size, content_hash, perceptual_hash)
             media_id = existing_media_id
         else:
             # Add to database as a new entry
-            media_id = db.add_media(str(user_id), file_id, download_path, file_size, media_type, caption, file_unique_id)
+            media_id = db.add_media(str(user_id), file_id, download_path, file_size, media_type, caption, file_unique_id, content_hash, perceptual_hash)
         
-        # Check if user became active
+        # Activation was already handled when the media was registered in handle_media
         user = db.get_user(str(user_id))
-        if user["uploads"] >= REQUIRED_UPLOADS and not user["premium"] and not user["active"]:
-            # User just became active
-            # Now share all their previously forwarded media with active users
-            await share_user_media_with_active_users(client, user_id)
-            # Send activation message
-            await client.send_message(user_id, utils.get_activation_message())
-        elif user["uploads"] % REQUIRED_UPLOADS == 0 and not user["premium"] and user["active"]:
-            # User has uploaded another 30 media files, but don't send notification
-            pass
         
         # Don't send completion message - progress message already deleted
         
         # Send admin notification for large files
         if size_mb > 100 and OWNER_ID:
-            await client.send_message(
-                OWNER_ID,
+            outbox.enqueue(OWNER_ID, text_payload(
                 f"📥 **Large File Uploaded** 📥\n\n"
                 f"👤 User: {user['alias']} (ID: {user_id})\n"
                 f"📁 Size: {utils.format_size(file_size)}\n"
                 f"🔢 Media ID: {media_id}\n"
                 f"📂 Saved as: {os.path.basename(download_path)}"
-            )
+            ))
         
     except Exception as e:
         error_str = str(e)
@@ -1816,19 +2053,11 @@ async def process_media_item(client: Client, message: Message, user_id, progress
         else:
             # For other errors, show a generic message without the specific error details
             await client.send_message(user_id, "❌ Error processing your media. Please try again later.")
-        
-        # Clean up any temp files if they exist
-        try:
-            if 'temp_file_path' in locals() and os.path.exists(temp_file_path):
-                # Use file lock for cleanup to prevent concurrent access issues
-                from file_lock import media_operation_lock
-                with media_operation_lock(f"cleanup_{user_id}_{int(time.time() * 1000)}", "cleanup"):
-                    os.remove(temp_file_path)
-        except Exception as cleanup_error:
-            logger.error(f"Error cleaning up temp file: {str(cleanup_error)}")
+
 
 # Callback query handler
-@app.on_callback_query()
+@Client.on_callback_query()
+@qos.interactive
 async def handle_callback(client: Client, callback_query: CallbackQuery):
     """Handle callback queries from inline keyboards"""
     user_id = callback_query.from_user.id
@@ -1839,21 +2068,22 @@ async def handle_callback(client: Client, callback_query: CallbackQuery):
         await callback_query.answer("You are not authorized to use this bot.", show_alert=True)
         return
     
-    # Handle different callback types
+    # Handle different callback types; commands opened from a button run inline through __wrapped__,
+    # since this callback already holds the user's lane
     if data == "help":
         # Show help message
         await callback_query.message.delete()
-        await help_command(client, callback_query.message)
+        await help_command.__wrapped__(client, callback_query.message)
     
     elif data == "mystats":
         # Show user stats
         await callback_query.message.delete()
-        await mystats_command(client, callback_query.message)
+        await mystats_command.__wrapped__(client, callback_query.message)
     
     elif data == "syncmedia":
         # Start media sync
         await callback_query.message.delete()
-        await syncmedia_command(client, callback_query.message)
+        await syncmedia_command.__wrapped__(client, callback_query.message)
     
     elif data == "admin" and is_admin(str(user_id)):
         # Show admin panel
@@ -1883,17 +2113,18 @@ async def handle_callback(client: Client, callback_query: CallbackQuery):
         await callback_query.message.edit_text(
             "🔑 **Generate Key**\n\n"
             "Use the command:\n"
-            "`/getkey [uses] [premium]`\n\n"
+            "`/getkey [uses] [premium] [count]`\n\n"
             "Examples:\n"
             "`/getkey` - Generate normal key with 1 use\n"
             "`/getkey 5` - Generate normal key with 5 uses\n"
-            "`/getkey 1 premium` - Generate premium key with 1 use"
+            "`/getkey 1 premium` - Generate premium key with 1 use\n"
+            "`/getkey 1 normal 50` - Generate 50 normal keys as a file"
         )
     
     elif data == "status" and is_admin(str(user_id)):
         # Show status
         await callback_query.message.delete()
-        await status_command(client, callback_query.message)
+        await status_command.__wrapped__(client, callback_query.message)
     
     elif data == "broadcast" and is_admin(str(user_id)):
         # Broadcast dialog
@@ -1904,6 +2135,17 @@ async def handle_callback(client: Client, callback_query: CallbackQuery):
             "This will send your message to all users."
         )
     
+    elif data.startswith("search_page:") and is_admin(str(user_id)):
+        # Show another page of alias search results
+        _, search_token, page = data.split(":")
+        search_query = search_sessions.get(search_token)
+        if search_query is None:
+            await callback_query.answer("This search has expired. Please run /search again.", show_alert=True)
+            return
+        results_message, keyboard = build_search_page(search_query, search_token, int(page))
+        await callback_query.message.edit_text(results_message, reply_markup=keyboard)
+        await callback_query.answer()
+    
     elif data.startswith("delete_") and is_admin(str(user_id)):
         # Delete media
         media_id = data.replace("delete_", "")
@@ -1923,11 +2165,21 @@ async def handle_callback(client: Client, callback_query: CallbackQuery):
     elif data.startswith("dismiss_") and is_admin(str(user_id)):
         # Dismiss report
         report_id = data.replace("dismiss_", "")
+        db.dismiss_reports(report_id)
+        report_edit_times.pop(report_id, None)
         await callback_query.message.edit_text(f"✅ Report for media {report_id} has been dismissed.")
     
+    elif data.startswith("reports_page:") and is_admin(str(user_id)):
+        # Show another page of the reported media queue
+        page = int(data.split(":")[1])
+        reports_message, keyboard = build_reports_page(page)
+        await callback_query.message.edit_text(reports_message, reply_markup=keyboard)
+        await callback_query.answer()
+    
     elif data.startswith("remove_") and is_admin(str(user_id)):
         # Remove reported media
         media_id = data.replace("remove_", "")
+        report_edit_times.pop(media_id, None)
         if db.delete_media(media_id):
             await callback_query.message.edit_text(
                 f"🗑️ **Media Removed** 🗑️\n\n"
@@ -2091,7 +2343,7 @@ async def handle_callback(client: Client, callback_query: CallbackQuery):
 
 
 async def process_confirmed_sync(client, user_id, user, progress_msg):
-    """Process confirmed sync asynchronously, with chunking, retry & FloodWait handling, and full-resume semantics."""
+    """Queue a confirmed sync in the outbox and report its progress; delivery resumes after restarts"""
     try:
         if not user["active"] and not user["premium"]:
             await progress_msg.edit_text(
@@ -2100,96 +2352,52 @@ async def process_confirmed_sync(client, user_id, user, progress_msg):
             )
             return
 
-        # Keep the pending list as the source of truth for resuming
         if "pending_sync" not in user or not user["pending_sync"]:
             await progress_msg.edit_text("❌ No pending media sync found.")
             return
 
         pending = list(user["pending_sync"])
         total = len(pending)
-        sent = 0
         started_at = time.time()
+        mark_synced = not user.get("premium", False)
 
-        def _persist_remaining():
-            user["pending_sync"] = pending
-            db.update_user(str(user_id), user)
-
-        base_delay = 0.2
-
-        idx = 0
-        while idx < len(pending):
-            media = pending[idx]
+        outgoing = []
+        for media in pending:
             # Minimal caption
-            try:
-                orig_user = db.get_user(media.get("user_id", "")) if media.get("user_id") else None
-                alias = (orig_user or {}).get("alias", "Anonymous")
-                caption = f"Shared by: <a href=\"https://telegram.me/{BOT_USERNAME}\">{alias}</a>"
-            except Exception:
-                caption = None
+            orig_user = db.get_user(media.get("user_id", "")) if media.get("user_id") else None
+            alias = (orig_user or {}).get("alias", "Anonymous")
+            caption = f"Shared by: <a href=\"https://telegram.me/{BOT_USERNAME}\">{alias}</a>"
+            media_id = db.find_user_media(media.get("user_id", ""), media["file_id"])
+            outgoing.append((user_id, media_payload(media["file_id"], media["media_type"], caption, media_id, mark_synced)))
+
+        # The outbox owns delivery and retries from here, so the pending list is done with
+        batch_id = f"sync_{user_id}_{int(started_at * 1000)}"
+        outbox.enqueue_many(outgoing, batch_id)
+        user["pending_sync"] = []
+        user["sync_batch_id"] = batch_id
+        db.update_user(str(user_id), user)
 
-            max_retries = 5
-            attempt = 0
-            while True:
-                try:
-                    from pyrogram import enums
-                    if media["media_type"] == "photo":
-                        await client.send_photo(user_id, media["file_id"], caption=caption, parse_mode=enums.ParseMode.HTML)
-                    elif media["media_type"] == "video":
-                        await client.send_video(user_id, media["file_id"], caption=caption, parse_mode=enums.ParseMode.HTML)
-                    elif media["media_type"] == "document":
-                        await client.send_document(user_id, media["file_id"], caption=caption, parse_mode=enums.ParseMode.HTML)
-                    elif media["media_type"] == "audio":
-                        await client.send_audio(user_id, media["file_id"], caption=caption, parse_mode=enums.ParseMode.HTML)
-                    elif media["media_type"] == "voice":
-                        await client.send_voice(user_id, media["file_id"], caption=caption, parse_mode=enums.ParseMode.HTML)
-                    else:
-                        await client.send_cached_media(user_id, media["file_id"], caption=caption, parse_mode=enums.ParseMode.HTML)
-                    break
-                except Exception as e:
-                    from pyrogram.errors import FloodWait
-                    if isinstance(e, FloodWait):
-                        await asyncio.sleep(e.value + 1)
-                        continue
-                    attempt += 1
-                    if attempt >= max_retries:
-                        # Move to end to retry later
-                        pending.append(pending.pop(idx))
-                        _persist_remaining()
-                        await asyncio.sleep(1)
-                        break
-                    await asyncio.sleep(1)
-
-            # Success: remove and mark synced; if moved to end, skip popping here
-            if idx < len(pending) and pending[idx] is media:
-                if not user.get("premium", False):
-                    media_id = None
-                    for mid, mdata in db.media.items():
-                        if mdata.get("file_id") == media.get("file_id") and mdata.get("user_id") == media.get("user_id"):
-                            media_id = mid
-                            break
-                    if media_id:
-                        db.mark_media_synced(str(user_id), media_id)
-                pending.pop(idx)
-                sent += 1
-            else:
-                idx += 1
+        shown = {"sent": -1}
 
-            if sent % 50 == 0 or sent == total:
-                _persist_remaining()
+        async def show_progress(progress):
+            if progress[SENT] != shown["sent"]:
+                shown["sent"] = progress[SENT]
                 try:
-                    await progress_msg.edit_text(f"🧲 Syncing… {sent}/{total}")
+                    await progress_msg.edit_text(f"🧲 Syncing… {progress[SENT]}/{total}")
                 except Exception:
                     pass
-            await asyncio.sleep(base_delay)
 
-        _persist_remaining()  # should be empty now
+        progress = await wait_for_outbox_batch(batch_id, show_progress)
         elapsed = int(time.time() - started_at)
+        completion_msg = (
+            f"✅ **Sync Completed Successfully!** 🎉\n\n"
+            f"📦 **Files Synced:** {progress[SENT]}\n"
+            f"⏱️ Time: {elapsed}s"
+        )
+        if progress[FAILED]:
+            completion_msg += f"\n⚠️ Could not be delivered: {progress[FAILED]}"
         try:
-            await progress_msg.edit_text(
-                f"✅ **Sync Completed Successfully!** 🎉\n\n"
-                f"📦 **Files Synced:** {sent}\n"
-                f"⏱️ Time: {elapsed}s"
-            )
+            await progress_msg.edit_text(completion_msg)
         except Exception:
             pass
         user["sync_attempts"] = 0
@@ -2200,6 +2408,110 @@ async def process_confirmed_sync(client, user_id, user, progress_msg):
         except Exception:
             pass
 
+async def wait_for_outbox_batch(batch_id, on_progress=None):
+    """Wait until every message of an outbox batch is sent or given up on, and return the final counts"""
+    while True:
+        progress = outbox.batch_progress(batch_id)
+        if on_progress is not None:
+            await on_progress(progress)
+        if not progress[PENDING] and not progress[SENDING]:
+            return progress
+        await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+
+async def send_outbox_payload(client, recipient, payload):
+    """Send one outbox payload to a recipient"""
+    from pyrogram import enums
+    
+    if payload["kind"] == "text":
+        if payload.get("html"):
+            await client.send_message(recipient, payload["text"], parse_mode=enums.ParseMode.HTML)
+        else:
+            await client.send_message(recipient, payload["text"])
+        return
+    
+    if payload["kind"] == "album":
+        # send_media_group doesn't take animations; any still queued in an album go as documents
+        input_types = {
+            "photo": InputMediaPhoto,
+            "video": InputMediaVideo,
+            "audio": InputMediaAudio
+        }
+        media = []
+        for index, item in enumerate(payload["items"]):
+            input_type = input_types.get(item["media_type"], InputMediaDocument)
+            if index == 0:
+                media.append(input_type(item["file_id"], caption=payload.get("caption") or "", parse_mode=enums.ParseMode.HTML))
+            else:
+                media.append(input_type(item["file_id"]))
+        await client.send_media_group(recipient, media)
+        return
+    
+    media_type = payload["media_type"]
+    file_id = payload["file_id"]
+    caption = payload.get("caption")
+    if media_type == "photo":
+        await client.send_photo(recipient, file_id, caption=caption, parse_mode=enums.ParseMode.HTML)
+    elif media_type == "video":
+        await client.send_video(recipient, file_id, caption=caption, parse_mode=enums.ParseMode.HTML)
+    elif media_type == "document":
+        await client.send_document(recipient, file_id, caption=caption, parse_mode=enums.ParseMode.HTML)
+    elif media_type == "audio":
+        await client.send_audio(recipient, file_id, caption=caption, parse_mode=enums.ParseMode.HTML)
+    elif media_type == "voice":
+        await client.send_voice(recipient, file_id, caption=caption, parse_mode=enums.ParseMode.HTML)
+    else:
+        await client.send_cached_media(recipient, file_id, caption=caption, parse_mode=enums.ParseMode.HTML)
+
+def classify_send_error(error):
+    """Get why a send failed: blocked, deactivated, peer_invalid, or transient for anything worth retrying"""
+    for error_type, reason in PERMANENT_SEND_ERRORS:
+        if isinstance(error, error_type):
+            return reason
+    return "transient"
+
+async def deliver_outbox_message(client, message, claimed=()):
+    """
+    Send a claimed outbox message and record the outcome.
+    Returns None when the message is settled, the delay before it will be retried, or RECIPIENT_UNREACHABLE
+    when the recipient can't be reached; their other claimed messages are then given up on as well.
+    """
+    payload = message["payload"]
+    try:
+        await send_outbox_payload(client, message["recipient"], payload)
+    except FloodWait as e:
+        # Rate limited rather than failed, so this doesn't count as an attempt
+        outbox.retry_later(message["id"], e.value + 1, f"FloodWait {e.value}s", count_attempt=False)
+        return e.value + 1
+    except Exception as e:
+        reason = classify_send_error(e)
+        if reason != "transient":
+            # The recipient can't be reached at all: drop what is queued for them and stop fanning out to them
+            outbox.mark_failed(message["id"], str(e), reason)
+            dropped = outbox.fail_recipient(message["recipient"], reason, [later["id"] for later in claimed])
+            db.mark_unreachable(message["recipient"], reason)
+            logger.info(f"User {message['recipient']} is unreachable ({reason}), dropped {dropped} queued messages")
+            return RECIPIENT_UNREACHABLE
+        
+        attempts = message["attempts"] + 1
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            outbox.mark_failed(message["id"], str(e))
+            logger.error(f"Giving up on outbox message {message['id']} to {message['recipient']}: {str(e)}")
+            return None
+        delay = min(OUTBOX_BASE_DELAY * 2 ** (attempts - 1), OUTBOX_MAX_DELAY)
+        outbox.retry_later(message["id"], delay, str(e))
+        return delay
+    
+    outbox.mark_sent(message["id"])
+    outbox.wait_stats.record(message["tier"] or TIERS[-1], time.time() - message["next_attempt_at"])
+    
+    # Track the delivery against the recipient's sync limit
+    if payload.get("mark_synced"):
+        for item in payload["items"] if payload["kind"] == "album" else [payload]:
+            media_id = item.get("media_id") or db.find_media_by_file_id(item["file_id"])
+            if media_id:
+                db.mark_media_synced(str(message["recipient"]), media_id)
+    return None
+
 async def check_activity_task():
     """Periodically check user activity and update status"""
     while True:
@@ -2239,6 +2551,120 @@ async def cleanup_duplicates_task():
         # Wait for 1 hour before next cleanup
         await asyncio.sleep(3600)
 
+# Storage accounting reconciliation task
+async def reconcile_storage_task():
+    """Periodically recount media storage from disk to correct drift in the running totals"""
+    while True:
+        try:
+            # Walk the tree in a worker thread so the event loop keeps serving commands,
+            # then apply the counts here, where every other storage update happens
+            counts = await asyncio.get_event_loop().run_in_executor(None, db.count_storage)
+            db.reconcile_storage(counts)
+            logger.info("Reconciled media storage accounting")
+        except Exception as e:
+            logger.error(f"Error in reconcile_storage_task: {str(e)}")
+        
+        # Wait for 6 hours before next reconciliation
+        await asyncio.sleep(21600)
+
+# Key expiry task
+async def expire_keys_task():
+    """Periodically disable access keys that have passed their expiry time"""
+    while True:
+        try:
+            db.expire_keys()
+        except Exception as e:
+            logger.error(f"Error in expire_keys_task: {str(e)}")
+        
+        # Wait for 5 minutes before next sweep
+        await asyncio.sleep(300)
+
+# Deferred database write task
+async def flush_dirty_task():
+    """Periodically write database files with deferred changes"""
+    while True:
+        await asyncio.sleep(DIRTY_FLUSH_INTERVAL)
+        try:
+            db.flush_dirty()
+        except Exception as e:
+            logger.error(f"Error in flush_dirty_task: {str(e)}")
+
+# Outbox dispatcher task
+async def outbox_dispatcher_task():
+    """Deliver queued outbox messages, several recipients at a time and in order for each recipient"""
+    semaphore = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+    last_purge = 0
+    
+    async def send_to_recipient(messages):
+        async with semaphore:
+            for index, message in enumerate(messages):
+                # Bulk sends stay within their part of the rate budget; the reserved share keeps replies fast
+                await qos.acquire_send()
+                retry_delay = await deliver_outbox_message(app, message, messages[index + 1:])
+                if retry_delay is RECIPIENT_UNREACHABLE:
+                    # The rest of the group was dropped along with the recipient
+                    return
+                if retry_delay is not None:
+                    # Hold back this recipient's later messages so they keep their order
+                    for later in messages[index + 1:]:
+                        outbox.retry_later(later["id"], retry_delay, count_attempt=False)
+                    return
+                await asyncio.sleep(OUTBOX_SEND_DELAY)
+    
+    while True:
+        try:
+            # Claimed highest tier first, so premium recipients also get the first send slots
+            messages = outbox.claim(OUTBOX_BATCH_SIZE, TIER_WEIGHTS)
+            if not messages:
+                if time.time() - last_purge > 3600:
+                    outbox.purge_sent(OUTBOX_RETENTION)
+                    last_purge = time.time()
+                await asyncio.sleep(OUTBOX_IDLE_INTERVAL)
+                continue
+            
+            by_recipient = {}
+            for message in messages:
+                by_recipient.setdefault(message["recipient"], []).append(message)
+            # Let commands that are running right now reply first, once per batch
+            await qos.yield_to_interactive()
+            await asyncio.gather(*(send_to_recipient(group) for group in by_recipient.values()))
+        except Exception as e:
+            logger.error(f"Error in outbox_dispatcher_task: {str(e)}")
+            await asyncio.sleep(OUTBOX_IDLE_INTERVAL)
+
+async def resume_pending_downloads_task():
+    """Re-queue downloads of media registered before a restart, fetching them again by file_id"""
+    await asyncio.sleep(0.5)
+    try:
+        pending = db.get_pending_downloads()
+        for media_id, media_data in pending:
+            ingest.submit(media_data["user_id"], media_data.get("file_size", 0), {
+                "client": app,
+                "media_id": media_id
+            }, tier=get_user_tier(media_data["user_id"]), track=False)
+        if pending:
+            logger.info(f"Resuming {len(pending)} pending downloads")
+    except Exception as e:
+        logger.error(f"Error in resume_pending_downloads_task: {str(e)}")
+
+async def resume_pending_download(client: Client, media_id):
+    """Download a media file that was registered before a restart and attach it to its record"""
+    media_data = db.media.get(media_id)
+    if not media_data or not media_data.get("pending_download", False):
+        return
+    
+    try:
+        download_path, content_hash, file_size, stored = await download_media(
+            client, media_data["user_id"], media_data["file_id"], media_data.get("file_unique_id")
+        )
+        # Without the original message only photos can be hashed; video thumbnails come with the message
+        perceptual_hash = None
+        if not stored and media_data["media_type"] == "photo":
+            perceptual_hash = await compute_perceptual_hash(client, None, "photo", download_path)
+        db.complete_pending_download(media_id, download_path, file_size or media_data.get("file_size", 0), content_hash, perceptual_hash)
+    except Exception as e:
+        logger.error(f"Error resuming download of {media_id}: {str(e)}")
+
 # Online status checker task
 async def check_online_status_task():
     """Periodically check user online status and set inactive users to offline"""
@@ -2263,11 +2689,72 @@ async def check_online_status_task():
         # Check every minute
         await asyncio.sleep(60)
 
-# Start the bot
-if __name__ == "__main__":
-    logger.info("Starting SIN CITY Media Bot in hybrid mode...")
-    app.start()
+# Application setup
+def create_app():
+    """Build the database, clients, schedulers and buffers, register the handlers and return the client"""
+    global db, outbox, phash_pool, app, transfer_pool, ingest, album_buffer, forward_buffer
+    
+    # Initialize database
+    db = Database(phash_max_distance=PHASH_MAX_DISTANCE)
+    
+    # Durable queue for outgoing messages
+    outbox = Outbox(os.path.join(DATA_DIR, "outbox.db"), tier_for=lambda recipient: get_user_tier(recipient))
+    
+    # Process pool for CPU-bound perceptual hashing, kept off the event loop
+    phash_pool = ProcessPoolExecutor(max_workers=PHASH_WORKERS)
+    
+    # Initialize the MTProto client for handling large files
+    app = Client(
+        "media_handler_session",
+        api_id=API_ID,
+        api_hash=API_HASH,
+        bot_token=BOT_TOKEN,  # Using bot token for hybrid mode
+        workdir=os.getcwd()
+    )
     
+    # Keep the session and peer cache in memory with periodic snapshots instead of a SQLite session file,
+    # pre-loading our users as peers so fan-out can resolve them right after a restart
+    app.storage = SnapshotStorage(
+        "media_handler_session",
+        os.path.join(DATA_DIR, "session_snapshot.json"),
+        warm_peer_ids=db.users.keys()
+    )
+    
+    # Separate sessions for media downloads, so big transfers don't compete with command handling
+    transfer_pool = TransferPool(
+        "media_transfer_session",
+        API_ID,
+        API_HASH,
+        BOT_TOKEN,
+        os.getcwd(),
+        DATA_DIR,
+        size=TRANSFER_SESSIONS,
+        max_concurrent_transmissions=TRANSFER_MAX_TRANSMISSIONS
+    )
+    
+    # Media downloads, in lanes by file size
+    ingest = IngestScheduler(
+        run_ingest_job,
+        concurrency={"small": INGEST_SMALL_WORKERS, "medium": INGEST_MEDIUM_WORKERS, "huge": INGEST_HUGE_WORKERS},
+        on_user_drained=notify_ingest_complete,
+        tier_weights=TIER_WEIGHTS
+    )
+    
+    # Albums and forwarded backlogs are collected and handled as one unit
+    album_buffer = AlbumBuffer(handle_album, window=ALBUM_WINDOW)
+    forward_buffer = AlbumBuffer(handle_forwarded_batch, window=FORWARD_BATCH_WINDOW)
+    
+    # Handlers are declared with Client.on_message/on_callback_query, which only tag the functions;
+    # add them to this client in the order they are defined
+    for value in list(globals().values()):
+        if callable(value) and isinstance(getattr(value, "handlers", None), list):
+            for handler, group in value.handlers:
+                app.add_handler(handler, group)
+    
+    return app
+
+def start_background_tasks():
+    """Schedule the periodic tasks on the client's loop"""
     # Start activity checker task
     app.loop.create_task(check_activity_task())
     
@@ -2278,27 +2765,46 @@ if __name__ == "__main__":
     app.loop.create_task(cleanup_duplicates_task())
     logger.info("Duplicate media cleanup task scheduled")
     
-    # Keep the bot running
+    # Start storage accounting reconciliation task
+    app.loop.create_task(reconcile_storage_task())
+    
+    # Start access key expiry sweep
+    app.loop.create_task(expire_keys_task())
+    
+    # Start writing deferred database changes
+    app.loop.create_task(flush_dirty_task())
+    
+    # Start delivering queued outgoing messages
+    app.loop.create_task(outbox_dispatcher_task())
     
-async def resume_pending_downloads_task():
-    """Scan DB for pending downloads and re-queue them for processing after restarts or heavy loads."""
-    await asyncio.sleep(0.5)
-    try:
-        pending = []
-        for mid, m in db.media.items():
-            if m.get("pending_download", False) and m.get("user_id"):
-                pending.append((m["user_id"], m["file_id"]))
-        # Re-queue by creating dummy messages is hard offline;
-        # Best-effort: notify owner in logs and rely on future uploads.
-        if pending:
-            logging.info(f"Found {len(pending)} pending downloads to resume.")
-    except Exception as e:
-        logging.error(f"Error in resume_pending_downloads_task: {e}")
-
     # Start resume task
     app.loop.create_task(resume_pending_downloads_task())
 
-    idle()
+# Start the bot
+if __name__ == "__main__":
+    logger.info("Starting SIN CITY Media Bot in hybrid mode...")
+    create_app()
+    app.start()
+    
+    # Resolve the bot username once for building join links
+    BOT_USERNAME = app.get_me().username
     
-    # Stop the bot
-    app.stop()
\ No newline at end of file
+    try:
+        # Log in the download sessions
+        app.loop.run_until_complete(transfer_pool.start())
+        
+        start_background_tasks()
+        
+        logger.info(f"Bot ready in {time.time() - BOT_START_TIME:.2f}s")
+        
+        # Keep the bot running
+        idle()
+    finally:
+        # Close the download sessions first, so their session snapshots are written for the next start
+        app.loop.run_until_complete(transfer_pool.stop())
+        
+        # Stop the bot
+        app.stop()
+        
+        # Write pending changes and snapshot media so the next start maps it instead of parsing media.json
+        db.write_media_snapshot()
@@ -1,4 +1,5 @@
 import os
+import sys
 import json
 import time
 from datetime import datetime, timedelta
@@ -9,39 +10,74 @@ import logging
 import shutil
 import uuid
 
-logger = logging.getLogger(__name__)
+from media_store import MediaStore
+from phash import BKTree
+from leaderboard import Leaderboard, WindowedLeaderboard
+from alias_index import NGramIndex
+from alias_allocator import AliasAllocator
+from key_store import KeyStore
+from report_queue import ReportQueue
+from records import MediaRecord, to_json
+from media_ids import MediaIdAllocator, media_id_for, parse_media_number
+from media_snapshot import LazyMedia
 
-import os
+logger = logging.getLogger(__name__)
 
-# Directory to save media files
+# Directory to save media files; created by the media store when a Database is opened
 MEDIA_DIR = os.path.join(os.getcwd(), "media")
-os.makedirs(MEDIA_DIR, exist_ok=True)
 
-# Directory for data storage
+# Directory for data storage; created when a Database is opened
 DATA_DIR = os.path.join(os.getcwd(), "data")
-os.makedirs(DATA_DIR, exist_ok=True)
+
+# Maximum Hamming distance between perceptual hashes for media to count as a near-duplicate
+PHASH_MAX_DISTANCE = 6
 
 class Database:
-    def __init__(self, db_dir=DATA_DIR):
+    def __init__(self, db_dir=DATA_DIR, phash_max_distance=PHASH_MAX_DISTANCE):
         self.db_dir = db_dir
+        self.phash_max_distance = phash_max_distance
         os.makedirs(db_dir, exist_ok=True)
         
         # Database files
         self.users_file = os.path.join(db_dir, "users.json")
         self.keys_file = os.path.join(db_dir, "keys.json")
+        self.key_joins_file = os.path.join(db_dir, "key_joins.log")
         self.media_file = os.path.join(db_dir, "media.json")
         self.messages_file = os.path.join(db_dir, "messages.json")
         self.stats_file = os.path.join(db_dir, "stats.json")
+        # Binary copy of media.json that is mapped at startup instead of parsed
+        self.media_snapshot_file = os.path.join(db_dir, "media.snap")
+        
+        # Content-addressed storage for media bytes
+        self.store = MediaStore(MEDIA_DIR)
+        
+        # Files with changes waiting for the next flush_dirty(), mapped to their data
+        self._dirty = {}
         
         # Initialize database files if they don't exist
         self._init_db()
         
-        # Load data
+        # Seconds spent in each startup phase, logged once loading is done
+        self.load_timings = {}
+        phase_start = time.perf_counter()
+        
+        def phase_done(name):
+            nonlocal phase_start
+            now = time.perf_counter()
+            self.load_timings[name] = now - phase_start
+            phase_start = now
+        
+        # Load data; users and keys in full, media from the snapshot when it is current
         self.users = self._load_json(self.users_file)
-        self.keys = self._load_json(self.keys_file)
-        self.media = self._load_json(self.media_file)
+        phase_done("users")
+        self.key_store = KeyStore(self.keys_file, self.key_joins_file, self._load_json, self._save_json)
+        self.keys = self.key_store.keys
+        phase_done("keys")
+        self.media = self._load_media()
+        phase_done("media")
         self.messages = self._load_json(self.messages_file)
         self.stats = self._load_json(self.stats_file)
+        phase_done("messages and stats")
         
         # Initialize stats if empty
         if not self.stats:
@@ -56,6 +92,49 @@ class Database:
                 "keys_generated": 0
             }
             self._save_json(self.stats_file, self.stats)
+        
+        # Integer media numbers, handed out in order; media from before them is numbered now and saved on the next flush
+        media_summaries = list(self.media.summaries())
+        self.media_id_allocator = MediaIdAllocator(self.stats, self.media, media_summaries)
+        if self.media_id_allocator.backfilled:
+            self.mark_dirty(self.media_file, self.media)
+            self.mark_dirty(self.stats_file, self.stats)
+        phase_done("media ids")
+        
+        # Users that messages can't be delivered to, until they interact with the bot again
+        self.unreachable_users = {user_id for user_id, user in self.users.items() if user.get("unreachable")}
+        
+        # Build lookup indexes over media records
+        self._build_media_indexes(media_summaries)
+        phase_done("media indexes")
+        self._build_leaderboards(media_summaries)
+        self._build_alias_index()
+        
+        # Aliases already handed out, including those still shown on media of departed users
+        self.alias_allocator = AliasAllocator(
+            [user["alias"] for user in self.users.values() if user.get("alias")] +
+            [media_data["alias"] for _, media_data in media_summaries if media_data.get("alias")]
+        )
+        del media_summaries
+        phase_done("leaderboards and aliases")
+        
+        # Storage totals are kept live by the media store and persisted with the stats;
+        # the background reconciliation corrects any drift since the last save
+        saved_usage = self.stats.get("storage", {})
+        for key in ("files", "bytes", "temp_bytes"):
+            self.store.usage[key] = saved_usage.get(key, 0)
+        self.stats["storage"] = self.store.usage
+        
+        # Snapshot media loaded from JSON, so the next start can map it
+        if not self.media.is_current(self.media_file):
+            self.write_media_snapshot()
+            phase_done("media snapshot")
+        
+        logger.info(
+            f"Database loaded in {sum(self.load_timings.values()):.2f}s "
+            f"({len(self.media)} media, {self.media.materialized_count()} decoded): " +
+            ", ".join(f"{name} {seconds:.3f}s" for name, seconds in self.load_timings.items())
+        )
     
     def _init_db(self):
         """Initialize database files if they don't exist"""
@@ -83,6 +162,21 @@ class Database:
             logger.error(f"Error loading JSON from {file_path}: {str(e)}. Creating empty data.")
             return {}
     
+    def _load_media(self):
+        """
+        Map media from the snapshot if it was taken from the current media.json, or else load the JSON
+        as compact records; media IDs in the users' media lists are interned either way
+        """
+        media = LazyMedia.open(self.media_snapshot_file, self.media_file)
+        if media is None:
+            media = LazyMedia({sys.intern(media_id): MediaRecord.from_dict(media_data)
+                               for media_id, media_data in self._load_json(self.media_file).items()})
+        for user in self.users.values():
+            for field in ("media_ids", "synced_media"):
+                if field in user:
+                    user[field] = [sys.intern(media_id) for media_id in user[field]]
+        return media
+    
     def _save_json(self, file_path, data):
         """Save JSON data to file with file locking to prevent concurrent access issues"""
         from file_lock import file_lock
@@ -90,7 +184,31 @@ class Database:
         # Use file lock to prevent concurrent access issues
         with file_lock(file_path):
             with open(file_path, 'w') as f:
-                json.dump(data, f, indent=2)
+                if isinstance(data, LazyMedia):
+                    data.write_json(f)
+                else:
+                    json.dump(data, f, indent=2, default=to_json)
+        # Whatever was pending for this file has just been written
+        self._dirty.pop(file_path, None)
+    
+    def mark_dirty(self, file_path, data):
+        """Defer saving a file until the next flush, so bursts of changes cost one write"""
+        self._dirty[file_path] = data
+    
+    def flush_dirty(self):
+        """Write every file with deferred changes"""
+        for file_path, data in list(self._dirty.items()):
+            self._save_json(file_path, data)
+    
+    def write_media_snapshot(self):
+        """Write pending changes and snapshot media.json for the next start; skipped if the snapshot is current"""
+        self.flush_dirty()
+        if self.media.is_current(self.media_file):
+            return
+        try:
+            self.media.write_snapshot(self.media_snapshot_file, self.media_file)
+        except Exception as e:
+            logger.error(f"Error writing media snapshot: {str(e)}")
     
     # User management
     def add_user(self, user_id, username, first_name, access_key):
@@ -101,6 +219,10 @@ class Database:
         if user_id in self.users:
             return False
         
+        # Redeem the access key; a key used up by a concurrent registration is refused here
+        if access_key and not self.key_store.redeem(access_key, user_id):
+            return False
+        
         # Generate a random alias
         alias = self._generate_alias()
         
@@ -126,14 +248,8 @@ class Database:
             "synced_media": [],
             "last_pin_view": 0  # Timestamp when user last saw pinned message
         }
-        
-        # Update key usage
-        if access_key and access_key in self.keys:
-            if "users" not in self.keys[access_key]:
-                self.keys[access_key]["users"] = []
-            self.keys[access_key]["users"].append(user_id)
-            self.keys[access_key]["uses"] += 1
-            self._save_json(self.keys_file, self.keys)
+        self.leaderboard.set(user_id, 0)
+        self.alias_index.add(user_id, alias)
         
         # Update stats
         self.stats["total_users"] += 1
@@ -160,6 +276,8 @@ class Database:
         user_id = str(user_id)
         if user_id in self.users:
             self.users[user_id].update(data)
+            if "uploads" in data or "ghosted" in data:
+                self._sync_leaderboards(user_id)
             self._save_json(self.users_file, self.users)
             return True
             
@@ -172,6 +290,10 @@ class Database:
             
             # Remove user from database
             del self.users[user_id]
+            for board in self._all_leaderboards():
+                board.remove(user_id)
+            self.alias_index.remove(user_id)
+            self.unreachable_users.discard(user_id)
             
             # Update stats
             self.stats["total_users"] -= 1
@@ -226,197 +348,164 @@ class Database:
             return True
         return False
     
-    def add_media(self, user_id, file_id, file_path, file_size, media_type, caption=None, file_unique_id=None):
+    def add_media(self, user_id, file_id, file_path, file_size, media_type, caption=None, file_unique_id=None, content_hash=None, phash=None):
         """Add a media file to the database"""
-        user_id = str(user_id)
-        
-        # Check if user exists and is not banned
-        if user_id not in self.users or self.users[user_id]["banned"]:
-            return None
-        
-        # Check if this file_id already exists for this user
-        for media_id, media_data in self.media.items():
-            if media_data["file_id"] == file_id and media_data["user_id"] == user_id:
-                return media_id
-                
-        # Create duplicates directory if it doesn't exist
-        duplicates_dir = os.path.join(MEDIA_DIR, "duplicates")
-        os.makedirs(duplicates_dir, exist_ok=True)
-        
-        # Check if this file_unique_id already exists in the database (from any user)
-        is_duplicate = False
-        if file_unique_id:
-            for media_id, media_data in self.media.items():
-                if media_data.get("file_unique_id") == file_unique_id:
-                    is_duplicate = True
-                    break
-                
-        # Check if this is a duplicate media from another user
-        duplicate_media_id = self.check_duplicate_media(file_id, user_id, file_unique_id)
-        if duplicate_media_id:
-            # Mark the media as a duplicate and record when it was detected
-            self.media[duplicate_media_id]["has_duplicates"] = True
-            
-            # If this media doesn't have a duplicates list, create one
-            if "duplicates" not in self.media[duplicate_media_id]:
-                self.media[duplicate_media_id]["duplicates"] = []
-                
-            # Add this duplicate entry with timestamp for auto-deletion after 24 hours
-            duplicate_entry = {
-                "user_id": user_id,
-                "detected_time": time.time(),
-                "file_id": file_id
-            }
-            self.media[duplicate_media_id]["duplicates"].append(duplicate_entry)
-            
-            # Move the file to duplicates folder
-            original_filename = os.path.basename(file_path)
-            duplicate_file_path = os.path.join(duplicates_dir, f"{media_id}_{original_filename}")
-            try:
-                import shutil
-                shutil.copy2(file_path, duplicate_file_path)
-                # Update file path to point to duplicate location
-                file_path = duplicate_file_path
-            except Exception as e:
-                logger.error(f"Error copying duplicate file: {str(e)}")
-        
-        # Generate a unique media ID
-        media_id = f"media_{int(time.time())}_{random.randint(1000, 9999)}"
-        
-        # Add media to database
-        self.media[media_id] = {
-            "user_id": user_id,
+        media_ids = self.add_media_batch(user_id, [{
             "file_id": file_id,
-            "file_unique_id": file_unique_id,
             "file_path": file_path,
             "file_size": file_size,
             "media_type": media_type,
             "caption": caption,
-            "upload_time": time.time(),
-            "alias": self.users[user_id]["alias"],
-            "premium": self.users[user_id]["premium"],
-            "reported": False,
-            "reports": [],
-            "has_duplicates": False,
-            "is_duplicate": is_duplicate
-        }
-        
-        # Update user's media list
-        self.users[user_id]["media_ids"].append(media_id)
-        self.users[user_id]["uploads"] += 1
-        self.users[user_id]["last_activity"] = time.time()
-        
-        # Check if user becomes active after 30 uploads
-        if not self.users[user_id]["active"] and not self.users[user_id]["premium"] and self.users[user_id]["uploads"] >= 30:
-            self.users[user_id]["active"] = True
-            self.stats["active_users"] += 1
-            # Reset activity timer
-            self.users[user_id]["activity_timer"] = time.time() + 86400  # 24 hours from now
-            
-            # Store the actual expiration time separately (for internal use)
-            # This will be used to track the real expiration time based on upload count
-            if not "actual_expiration" in self.users[user_id]:
-                self.users[user_id]["actual_expiration"] = self.users[user_id]["activity_timer"]
-        
-        # Check if user has uploaded multiples of 30 media and extend their actual expiration time
-        # while still showing 24 hours to the user
-        if self.users[user_id]["active"] and not self.users[user_id]["premium"] and self.users[user_id]["uploads"] % 30 == 0 and self.users[user_id]["uploads"] > 30:
-            # For every 30 uploads, add 24 hours to the actual expiration time
-            # But keep the displayed activity_timer at 24 hours from now
-            self.users[user_id]["activity_timer"] = time.time() + 86400  # Always show 24 hours
-            
-            # Extend the actual expiration by 24 hours
-            if "actual_expiration" in self.users[user_id]:
-                self.users[user_id]["actual_expiration"] = max(self.users[user_id]["actual_expiration"], time.time() + 86400)
-            else:
-                self.users[user_id]["actual_expiration"] = time.time() + 86400 * 2  # 48 hours
-        
-        # Update stats
-        self.stats["total_media_count"] += 1
-        
-        # Save changes
-        self._save_json(self.media_file, self.media)
-        self._save_json(self.users_file, self.users)
-        self._save_json(self.stats_file, self.stats)
-        
-        return media_id
+            "file_unique_id": file_unique_id,
+            "content_hash": content_hash,
+            "phash": phash
+        }], pending=False)
+        return media_ids[0] if media_ids else None
     
     def add_media_instant(self, user_id, file_id, file_path, file_size, media_type, caption=None, file_unique_id=None):
         """Add a media file to the database instantly without waiting for download
-        This is used for forwarded media from inactive users to count towards activity immediately"""
+        This lets uploads count towards activity as soon as they arrive; complete_pending_download attaches the file later"""
+        media_ids = self.add_media_batch(user_id, [{
+            "file_id": file_id,
+            "file_path": file_path,
+            "file_size": file_size,
+            "media_type": media_type,
+            "caption": caption,
+            "file_unique_id": file_unique_id
+        }])
+        return media_ids[0] if media_ids else None
+    
+    def add_media_batch(self, user_id, items, pending=True):
+        """Add many media files from one user at once
+        Items are dicts with file_id, file_size, media_type and optionally file_path, caption, file_unique_id,
+        content_hash and phash. Pending items are added ahead of their downloads and checked for duplicates
+        in complete_pending_download; downloaded items (pending=False) are checked here through the indexes.
+        Activation and expiry changes are applied once and everything is saved once, so a batch of
+        100 costs about the same as a single item. Returns the media IDs in item order, or None if the user can't upload"""
         user_id = str(user_id)
         
         # Check if user exists and is not banned
         if user_id not in self.users or self.users[user_id]["banned"]:
             return None
         
-        # Check if this file_id already exists for this user
-        for media_id, media_data in self.media.items():
-            if media_data["file_id"] == file_id and media_data["user_id"] == user_id:
-                return media_id
-        
-        # Generate a unique media ID
-        media_id = f"media_{int(time.time())}_{random.randint(1000, 9999)}"
-        
-        # Add media to database with placeholder path (will be updated later)
-        self.media[media_id] = {
-            "user_id": user_id,
-            "file_id": file_id,
-            "file_unique_id": file_unique_id,
-            "file_path": file_path,  # This will be None initially
-            "file_size": file_size,  # This will be 0 initially
-            "media_type": media_type,
-            "caption": caption,
-            "upload_time": time.time(),
-            "alias": self.users[user_id]["alias"],
-            "premium": self.users[user_id]["premium"],
-            "reported": False,
-            "reports": [],
-            "has_duplicates": False,
-            "is_duplicate": False,
-            "pending_download": True  # Mark as pending download
-        }
+        user = self.users[user_id]
+        previous_uploads = user["uploads"]
+        media_ids = []
+        for item in items:
+            file_id = item["file_id"]
+            file_unique_id = item.get("file_unique_id")
+            
+            # Check if this file_id already exists for this user
+            existing_media_id = self.find_user_media(user_id, file_id)
+            if existing_media_id:
+                media_ids.append(existing_media_id)
+                continue
+            
+            is_duplicate = False
+            if not pending:
+                # Check if this file_unique_id already exists in the database (from any user)
+                is_duplicate = bool(file_unique_id and self.media_by_unique_id.get(file_unique_id))
+                
+                # Check if this is a duplicate (or a near-duplicate re-encode) of media from another user
+                duplicate_media_id = self.check_duplicate_media(
+                    file_id, user_id, file_unique_id, item.get("phash"), media_type=item["media_type"]
+                )
+                if duplicate_media_id:
+                    # Near-duplicates don't share a file_unique_id, so flag the new entry here as well
+                    is_duplicate = True
+                    self._record_duplicate(duplicate_media_id, user_id, file_id)
+            
+            # Take the next media number; its string form is the media ID
+            number = self.media_id_allocator.allocate()
+            media_id = sys.intern(media_id_for(number))
+            
+            media_data = MediaRecord({
+                "seq": number,
+                "user_id": user_id,
+                "file_id": file_id,
+                "file_unique_id": file_unique_id,
+                "file_path": item.get("file_path"),
+                "file_size": item.get("file_size", 0),
+                "media_type": item["media_type"],
+                "caption": item.get("caption"),
+                "upload_time": time.time(),
+                "alias": user["alias"],
+                "premium": user["premium"],
+                "reported": False,
+                "reports": [],
+                "has_duplicates": False,
+                "is_duplicate": is_duplicate
+            })
+            if pending:
+                # The path is filled in when the download completes
+                media_data["pending_download"] = True
+            else:
+                media_data["content_hash"] = item.get("content_hash")
+                media_data["phash"] = format(item["phash"], "016x") if item.get("phash") is not None else None
+            self.media[media_id] = media_data
+            self._index_media(media_id, media_data)
+            
+            # Update user's media list
+            user["media_ids"].append(media_id)
+            user["uploads"] += 1
+            self._record_upload(user_id, media_data["upload_time"], 1)
+            media_ids.append(media_id)
+        
+        added = user["uploads"] - previous_uploads
+        if added:
+            user["last_activity"] = time.time()
+            # Activation and expiry extensions are applied once for the whole batch
+            self._apply_upload_progress(user_id, previous_uploads)
+            
+            # Update stats
+            self.stats["total_media_count"] += added
+            
+            # Save changes
+            self._save_json(self.media_file, self.media)
+            self._save_json(self.users_file, self.users)
+            self._save_json(self.stats_file, self.stats)
         
-        # Update user's media list
-        self.users[user_id]["media_ids"].append(media_id)
-        self.users[user_id]["uploads"] += 1
-        self.users[user_id]["last_activity"] = time.time()
+        return media_ids
+    
+    def get_pending_downloads(self):
+        """Get (media_id, media_data) of media still waiting for its download, oldest first"""
+        pending = [
+            (media_id, self.media[media_id]) for media_id, media_data in self.media.summaries()
+            if media_data.get("pending_download", False)
+        ]
+        pending.sort(key=lambda entry: entry[1]["upload_time"])
+        return pending
+    
+    def _apply_upload_progress(self, user_id, previous_uploads):
+        """Activate a user or extend their time after their upload count grew from previous_uploads"""
+        user = self.users[user_id]
         
         # Check if user becomes active after 30 uploads
-        if not self.users[user_id]["active"] and not self.users[user_id]["premium"] and self.users[user_id]["uploads"] >= 30:
-            self.users[user_id]["active"] = True
+        if not user["active"] and not user["premium"] and user["uploads"] >= 30:
+            user["active"] = True
             self.stats["active_users"] += 1
             # Reset activity timer
-            self.users[user_id]["activity_timer"] = time.time() + 86400  # 24 hours from now
+            user["activity_timer"] = time.time() + 86400  # 24 hours from now
             
             # Store the actual expiration time separately (for internal use)
             # This will be used to track the real expiration time based on upload count
-            if not "actual_expiration" in self.users[user_id]:
-                self.users[user_id]["actual_expiration"] = self.users[user_id]["activity_timer"]
+            if not "actual_expiration" in user:
+                user["actual_expiration"] = user["activity_timer"]
         
-        # Check if user has uploaded multiples of 30 media and extend their actual expiration time
-        # while still showing 24 hours to the user
-        if self.users[user_id]["active"] and not self.users[user_id]["premium"] and self.users[user_id]["uploads"] % 30 == 0 and self.users[user_id]["uploads"] > 30:
+        # Check if the uploads passed a multiple of 30 media beyond the first and extend their
+        # actual expiration time while still showing 24 hours to the user
+        passed_multiple = user["uploads"] // 30 > max(previous_uploads, 30) // 30
+        if user["active"] and not user["premium"] and passed_multiple:
             # For every 30 uploads, add 24 hours to the actual expiration time
             # But keep the displayed activity_timer at 24 hours from now
-            self.users[user_id]["activity_timer"] = time.time() + 86400  # Always show 24 hours
+            user["activity_timer"] = time.time() + 86400  # Always show 24 hours
             
             # Extend the actual expiration by 24 hours
-            if "actual_expiration" in self.users[user_id]:
-                self.users[user_id]["actual_expiration"] = max(self.users[user_id]["actual_expiration"], time.time() + 86400)
+            if "actual_expiration" in user:
+                user["actual_expiration"] = max(user["actual_expiration"], time.time() + 86400)
             else:
-                self.users[user_id]["actual_expiration"] = time.time() + 86400 * 2  # 48 hours
-        
-        # Update stats
-        self.stats["total_media_count"] += 1
-        
-        # Save changes
-        self._save_json(self.media_file, self.media)
-        self._save_json(self.users_file, self.users)
-        self._save_json(self.stats_file, self.stats)
-        
-        return media_id
-        
+                user["actual_expiration"] = time.time() + 86400 * 2  # 48 hours
+    
     def delete_media(self, media_id):
         """Delete a media file from the database"""
         if media_id in self.media:
@@ -426,6 +515,7 @@ class Database:
             if user_id in self.users and media_id in self.users[user_id]["media_ids"]:
                 self.users[user_id]["media_ids"].remove(media_id)
                 self.users[user_id]["uploads"] -= 1
+                self._record_upload(user_id, self.media[media_id]["upload_time"], -1)
                 
                 # Check if user becomes inactive after deletion
                 if not self.users[user_id]["premium"] and self.users[user_id]["uploads"] < 30:
@@ -433,16 +523,11 @@ class Database:
                         self.users[user_id]["active"] = False
                         self.stats["active_users"] -= 1
             
-            # Delete the file from disk if it exists
-            file_path = self.media[media_id]["file_path"]
-            if os.path.exists(file_path):
-                try:
-                    os.remove(file_path)
-                except Exception as e:
-                    logger.error(f"Error deleting file {file_path}: {str(e)}")
-            
-            # Remove from media database
+            # Remove from media database, deleting the file once nothing else references it
+            media_data = self.media[media_id]
+            self._unindex_media(media_id, media_data)
             del self.media[media_id]
+            self._release_file(media_data.get("file_path"))
             
             # Update stats
             self.stats["total_media_count"] -= 1
@@ -474,30 +559,171 @@ class Database:
             return user_media
         return []
     
-    def check_duplicate_media(self, file_id, user_id, file_unique_id=None):
-        """Check if this file_id or file_unique_id is a duplicate of an existing media from another user"""
+    def check_duplicate_media(self, file_id, user_id, file_unique_id=None, phash=None, uploaded_before=None, media_type=None):
+        """Check if this file_id, file_unique_id or perceptual hash is a duplicate of an existing media from another user
+        If uploaded_before is given, only media uploaded before that time counts as the original.
+        Perceptual hash matches only count for media of the same media_type"""
         user_id = str(user_id)
         
-        # Create duplicates directory if it doesn't exist
-        duplicates_dir = os.path.join(MEDIA_DIR, "duplicates")
-        os.makedirs(duplicates_dir, exist_ok=True)
-        
-        # Check all media to find if this file_id or file_unique_id matches any existing media from other users
-        for media_id, media_data in self.media.items():
+        def is_original(media_id):
+            media_data = self.media[media_id]
             # Skip media from the same user
             if media_data["user_id"] == user_id:
-                continue
-                
-            # If file_id matches, it's a duplicate
-            if media_data["file_id"] == file_id:
+                return False
+            return uploaded_before is None or media_data["upload_time"] < uploaded_before
+        
+        # Look up candidates through the indexes instead of scanning all media
+        candidates = list(self.media_by_file_id.get(file_id, ()))
+        if file_unique_id:
+            candidates.extend(self.media_by_unique_id.get(file_unique_id, ()))
+        
+        for media_id in candidates:
+            if is_original(media_id):
                 return media_id
+        
+        # Fall back to the nearest visually similar media within the distance threshold
+        if phash is not None:
+            for distance, media_id in self.phash_index.search(phash, self.phash_max_distance):
+                # A video thumbnail can look like a photo, so only compare like with like
+                if self.media[media_id].get("media_type") != media_type:
+                    continue
+                if is_original(media_id):
+                    logger.info(f"Near-duplicate of {media_id} detected at distance {distance}")
+                    return media_id
                 
-            # If file_unique_id matches and it's provided, it's a duplicate
-            if file_unique_id and media_data.get("file_unique_id") == file_unique_id:
+        return None
+    
+    def _record_duplicate(self, duplicate_media_id, user_id, file_id):
+        """Note on the original media that another user uploaded a copy of it"""
+        # Mark the media as a duplicate and record when it was detected
+        self.media[duplicate_media_id]["has_duplicates"] = True
+        
+        # If this media doesn't have a duplicates list, create one
+        if "duplicates" not in self.media[duplicate_media_id]:
+            self.media[duplicate_media_id]["duplicates"] = []
+            
+        # Add this duplicate entry with timestamp for auto-deletion after 24 hours
+        duplicate_entry = {
+            "user_id": user_id,
+            "detected_time": time.time(),
+            "file_id": file_id
+        }
+        self.media[duplicate_media_id]["duplicates"].append(duplicate_entry)
+        # The duplicate keeps pointing at the stored bytes as another reference, no copy is made
+    
+    # Media indexes
+    def _build_media_indexes(self, media_summaries):
+        """Build lookup indexes and file reference counts from the loaded media's summaries"""
+        self.media_by_file_id = {}
+        self.media_by_unique_id = {}
+        # Media IDs by media number
+        self.media_by_seq = {}
+        # Number of media records referencing each stored file
+        self.file_refs = {}
+        # Perceptual hashes for near-duplicate search
+        self.phash_index = BKTree()
+        # Reported media awaiting review
+        self.report_queue = ReportQueue()
+        for media_id, media_data in media_summaries:
+            self._index_media(media_id, media_data)
+    
+    def _index_media(self, media_id, media_data):
+        """Add a media record to the lookup indexes"""
+        if "seq" in media_data:
+            self.media_by_seq[media_data["seq"]] = media_id
+        self.media_by_file_id.setdefault(media_data["file_id"], []).append(media_id)
+        if media_data.get("file_unique_id"):
+            self.media_by_unique_id.setdefault(media_data["file_unique_id"], []).append(media_id)
+        if media_data.get("file_path"):
+            self.file_refs[media_data["file_path"]] = self.file_refs.get(media_data["file_path"], 0) + 1
+            # Every reference beyond the first is storage saved by deduplication
+            if self.file_refs[media_data["file_path"]] > 1:
+                self.store.usage["duplicate_bytes"] += media_data.get("file_size") or 0
+        if media_data.get("phash"):
+            self.phash_index.add(int(media_data["phash"], 16), media_id)
+        if media_data.get("reported") and media_data.get("reports"):
+            self.report_queue.update(media_id, len(media_data["reports"]), media_data["reports"][-1]["time"])
+    
+    def _unindex_media(self, media_id, media_data):
+        """Remove a media record from the lookup indexes"""
+        self.media_by_seq.pop(media_data.get("seq"), None)
+        for index, key in ((self.media_by_file_id, media_data["file_id"]),
+                           (self.media_by_unique_id, media_data.get("file_unique_id"))):
+            media_ids = index.get(key)
+            if media_ids and media_id in media_ids:
+                media_ids.remove(media_id)
+                if not media_ids:
+                    del index[key]
+        if media_data.get("phash"):
+            self.phash_index.remove(int(media_data["phash"], 16), media_id)
+        self.report_queue.remove(media_id)
+        file_path = media_data.get("file_path")
+        if file_path in self.file_refs:
+            if self.file_refs[file_path] > 1:
+                self.store.usage["duplicate_bytes"] -= media_data.get("file_size") or 0
+            self.file_refs[file_path] -= 1
+            if self.file_refs[file_path] <= 0:
+                del self.file_refs[file_path]
+    
+    def _release_file(self, file_path):
+        """Delete a stored file from disk once no media record references it anymore"""
+        if file_path and file_path not in self.file_refs:
+            self.store.remove(file_path)
+    
+    def resolve_media_id(self, text):
+        """Get the media ID for "media_<n>", a bare media number or a legacy media ID, or None if there's no such media"""
+        if text in self.media:
+            return text
+        number = parse_media_number(text)
+        return self.media_by_seq.get(number) if number is not None else None
+    
+    def find_user_media(self, user_id, file_id):
+        """Get the media ID a user already stored for this file_id, if any"""
+        user_id = str(user_id)
+        for media_id in self.media_by_file_id.get(file_id, ()):
+            if self.media[media_id]["user_id"] == user_id:
                 return media_id
-                
         return None
-        
+    
+    def find_stored_file(self, file_unique_id):
+        """Get (file_path, content_hash) of a downloaded copy of this content, if we already hold one"""
+        if not file_unique_id:
+            return None
+        for media_id in self.media_by_unique_id.get(file_unique_id, ()):
+            media_data = self.media[media_id]
+            file_path = media_data.get("file_path")
+            if not media_data.get("pending_download", False) and file_path and os.path.exists(file_path):
+                return file_path, media_data.get("content_hash")
+        return None
+    
+    def complete_pending_download(self, media_id, file_path, file_size, content_hash=None, phash=None):
+        """Attach the downloaded file to a media entry that was added before its download finished"""
+        if media_id not in self.media:
+            return False
+        media_data = self.media[media_id]
+        self._unindex_media(media_id, media_data)
+        media_data["file_path"] = file_path
+        media_data["file_size"] = file_size
+        media_data["content_hash"] = content_hash
+        media_data["phash"] = format(phash, "016x") if phash is not None else None
+        media_data["pending_download"] = False
+        
+        # Media added ahead of its download skipped the duplicate check, so run it now.
+        # Only earlier uploads count as the original, so two copies whose downloads
+        # finish out of order don't flag each other
+        if not media_data.get("is_duplicate", False):
+            duplicate_media_id = self.check_duplicate_media(
+                media_data["file_id"], media_data["user_id"], media_data.get("file_unique_id"),
+                phash, uploaded_before=media_data["upload_time"], media_type=media_data.get("media_type")
+            )
+            if duplicate_media_id:
+                media_data["is_duplicate"] = True
+                self._record_duplicate(duplicate_media_id, media_data["user_id"], media_data["file_id"])
+        
+        self._index_media(media_id, media_data)
+        self._save_json(self.media_file, self.media)
+        return True
+    
     def get_syncable_media(self, user_id):
         """Get media that can be synced to a user"""
         user_id = str(user_id)
@@ -532,7 +758,7 @@ class Database:
         user_id = str(user_id)
         if user_id in self.users and media_id in self.media:
             if media_id not in self.users[user_id]["synced_media"]:
-                self.users[user_id]["synced_media"].append(media_id)
+                self.users[user_id]["synced_media"].append(sys.intern(media_id))
                 self._save_json(self.users_file, self.users)
                 return True
         return False
@@ -540,37 +766,37 @@ class Database:
     # Access key management
     def create_key(self, key_type="normal", uses=1):
         """Create a new access key"""
-        # Generate a random key
-        key = self._generate_key()
-        
-        # Add key to database
-        self.keys[key] = {
-            "type": key_type,
-            "created": time.time(),
-            "uses": 0,
-            "max_uses": uses,
-            "active": True,
-            "users": []
-        }
+        return self.create_keys(key_type, uses, 1)[0]
+    
+    def create_keys(self, key_type="normal", uses=1, count=1):
+        """Create several access keys, saving them all at once"""
+        keys = []
+        for _ in range(count):
+            # Generate a random key, retrying on the rare collision with an existing one
+            key = self._generate_key()
+            while key in self.keys:
+                key = self._generate_key()
+            
+            # Add key to database
+            self.key_store.add(key, key_type, uses)
+            keys.append(key)
         
         # Update stats
-        self.stats["keys_generated"] += 1
+        self.stats["keys_generated"] += count
         
         # Save changes
-        self._save_json(self.keys_file, self.keys)
+        self.key_store.save()
         self._save_json(self.stats_file, self.stats)
         
-        return key
+        return keys
     
     def get_key(self, key):
         """Get key data"""
-        return self.keys.get(key, None)
+        return self.key_store.get(key)
     
     def get_key_type(self, key):
         """Get key type"""
-        if key in self.keys:
-            return self.keys[key]["type"]
-        return None
+        return self.key_store.get_type(key)
         
     def cleanup_duplicate_media(self):
         """Clean up duplicate media entries and files older than 24 hours"""
@@ -578,11 +804,12 @@ class Database:
         cleanup_threshold = 86400  # 24 hours in seconds
         current_time = time.time()
         
-        # Get duplicates directory path
-        duplicates_dir = os.path.join(MEDIA_DIR, "duplicates")
-        
-        # Iterate through all media entries
-        for media_id, media_data in list(self.media.items()):
+        # Iterate through media flagged as or with duplicates; the rest has nothing to clean up
+        for media_id, summary in list(self.media.summaries()):
+            if not (summary.get("is_duplicate") or summary.get("has_duplicates")) or media_id not in self.media:
+                continue
+            media_data = self.media[media_id]
+            
             # Check if this is a duplicate that needs to be cleaned up
             if media_data.get("is_duplicate", False):
                 # Calculate age of the duplicate
@@ -590,17 +817,10 @@ class Database:
                 
                 # If older than 24 hours, delete it
                 if age >= cleanup_threshold:
-                    # Delete the file if it exists
-                    file_path = media_data.get("file_path")
-                    if file_path and os.path.exists(file_path) and file_path.startswith(duplicates_dir):
-                        try:
-                            os.remove(file_path)
-                            logger.info(f"Deleted duplicate file: {file_path}")
-                        except Exception as e:
-                            logger.error(f"Error deleting duplicate file {file_path}: {str(e)}")
-                    
-                    # Remove the media entry
+                    # Remove the media entry and drop its reference to the stored file
+                    self._unindex_media(media_id, media_data)
                     del self.media[media_id]
+                    self._release_file(media_data.get("file_path"))
                     continue
             
             # Check all media for duplicates
@@ -617,19 +837,13 @@ class Database:
                         # Try to delete the duplicate file if file_id exists
                         if "file_id" in duplicate:
                             # Find any media entries with this file_id
-                            for dup_id, dup_data in list(self.media.items()):
-                                if dup_data.get("file_id") == duplicate["file_id"] and dup_data.get("user_id") == duplicate["user_id"]:
-                                    # Delete the file if it exists and is in duplicates directory
-                                    dup_file_path = dup_data.get("file_path")
-                                    if dup_file_path and os.path.exists(dup_file_path) and dup_file_path.startswith(duplicates_dir):
-                                        try:
-                                            os.remove(dup_file_path)
-                                            logger.info(f"Deleted duplicate file: {dup_file_path}")
-                                        except Exception as e:
-                                            logger.error(f"Error deleting duplicate file {dup_file_path}: {str(e)}")
-                                    
-                                    # Remove the media entry
+                            for dup_id in list(self.media_by_file_id.get(duplicate["file_id"], [])):
+                                dup_data = self.media[dup_id]
+                                if dup_data.get("user_id") == duplicate["user_id"]:
+                                    # Remove the media entry and drop its reference to the stored file
+                                    self._unindex_media(dup_id, dup_data)
                                     del self.media[dup_id]
+                                    self._release_file(dup_data.get("file_path"))
                     else:
                         remaining_duplicates.append(duplicate)
                 
@@ -645,28 +859,20 @@ class Database:
     
     def disable_key(self, key):
         """Disable an access key"""
-        if key in self.keys:
-            self.keys[key]["active"] = False
-            self._save_json(self.keys_file, self.keys)
-            return True
-        return False
+        return self.key_store.disable(key)
     
     def is_key_valid(self, key):
-        """Check if a key is valid"""
-        if key not in self.keys:
-            return False
-        
-        key_data = self.keys[key]
-        
-        # Check if key is active
-        if not key_data["active"]:
-            return False
-        
-        # Check if key has reached max uses
-        if key_data["uses"] >= key_data["max_uses"] and key_data["max_uses"] > 0:
-            return False
-        
-        return True
+        """Check if a key is valid (active, not expired and not used up)"""
+        return self.key_store.is_valid(key)
+    
+    def expire_keys(self):
+        """Disable all access keys past their expiry time"""
+        return self.key_store.sweep_expired()
+    
+    def count_active_keys(self):
+        """Get the number of access keys that can currently be used"""
+        self.key_store.sweep_expired()
+        return self.key_store.active_count
     
     # Activity system
     def check_activity(self, user_id):
@@ -724,6 +930,46 @@ class Database:
             return True
         return False
         
+    # Delivery failures
+    def mark_unreachable(self, user_id, reason):
+        """Record that messages to a user fail permanently (blocked the bot, deleted account, ...)"""
+        user_id = str(user_id)
+        if user_id in self.users and user_id not in self.unreachable_users:
+            self.users[user_id]["unreachable"] = {"reason": reason, "since": time.time()}
+            self.unreachable_users.add(user_id)
+            self.mark_dirty(self.users_file, self.users)
+            return True
+        return False
+    
+    def clear_unreachable(self, user_id):
+        """Make a user a recipient again, e.g. after they contacted the bot"""
+        user_id = str(user_id)
+        if user_id in self.unreachable_users:
+            self.unreachable_users.discard(user_id)
+            self.users[user_id].pop("unreachable", None)
+            self.mark_dirty(self.users_file, self.users)
+            return True
+        return False
+    
+    def is_reachable(self, user_id):
+        """Check if messages can be delivered to a user"""
+        return str(user_id) not in self.unreachable_users
+    
+    def get_unreachable_users(self):
+        """Get (user_id, unreachable info) pairs, most recently failed first"""
+        return sorted(
+            ((user_id, self.users[user_id]["unreachable"]) for user_id in self.unreachable_users if user_id in self.users),
+            key=lambda item: item[1]["since"],
+            reverse=True
+        )
+    
+    def get_fanout_recipients(self, exclude=None):
+        """Get active or premium users that shared content should be delivered to"""
+        exclude = str(exclude) if exclude is not None else None
+        return {uid: user for uid, user in self.users.items()
+                if (user.get("active", False) or user.get("premium", False)) and not user.get("banned", False)
+                and uid != exclude and uid not in self.unreachable_users}
+    
     def update_user_activity(self, user_id):
         """Update a user's last activity timestamp and reset activity timer"""
         user_id = str(user_id)
@@ -841,43 +1087,8 @@ class Database:
     
     # Helper methods
     def _generate_alias(self):
-        """Generate a random alias using procedural generation with emojis"""
-        import secrets
-        
-        # Emoji pool
-        EMOJI_POOL = [
-            "🌀", "💫", "🌌", "🌙", "🧬", "🔥", "🔮", "🎭", "🛡", "📡",
-            "🧊", "🐚", "🕯", "🌿", "🌟", "⚡", "🌪️", "🗝️", "🌑", "🕳️"
-        ]
-        
-        # First word options (nouns and adjectives)
-        FIRST_WORDS = [
-            "Nexus", "Cyber", "Shadow", "Ghost", "Zero", "Neuro", "Crypt", "Xeno", "Synth", "Rust",
-            "Drone", "Hack", "Warp", "Void", "Static", "Quantum", "Iron", "Phantom", "Obsidian", "Cipher",
-            "Lunar", "Nova", "Echo", "Crimson", "Twilight", "Oracle", "Voyager", "Specter", "Drift", "Glyph",
-            "Mystic", "Astral", "Cosmic", "Digital", "Eternal", "Fusion", "Hyper", "Infinite", "Jade", "Kinetic"
-        ]
-        
-        # Second word options (nouns)
-        SECOND_WORDS = [
-            "Vortex", "Lynx", "Phreak", "Droid", "Mancer", "Glitch", "Byte", "Core", "Vault", "Nexus",
-            "Shard", "Wire", "Pulse", "Fang", "Haze", "Thorn", "Blade", "Veil", "Storm", "Raven",
-            "Serpent", "Claw", "Shade", "Infit", "Realm", "Titan", "Vertex", "Whisper", "Zenith", "Abyss",
-            "Beacon", "Cascade", "Destiny", "Echo", "Frontier", "Guardian", "Horizon", "Illusion", "Journey", "Knight"
-        ]
-        
-        # Generate word parts
-        emoji = secrets.choice(EMOJI_POOL)
-        first_word = secrets.choice(FIRST_WORDS).lower()
-        second_word = secrets.choice(SECOND_WORDS).lower()
-        
-        # Capitalize first letters
-        first_word = first_word[0].upper() + first_word[1:]
-        second_word = second_word[0].upper() + second_word[1:]
-        
-        # Create alias with emoji and two words
-        alias = f"{emoji} {first_word} {second_word}"
-        return alias
+        """Allocate a unique random alias using procedural generation with emojis"""
+        return self.alias_allocator.allocate()
     
     def _generate_key(self):
         """Generate a random access key"""
@@ -891,6 +1102,8 @@ class Database:
         user_id = str(user_id)
         if user_id in self.users and not self.users[user_id]["ghosted"]:
             self.users[user_id]["ghosted"] = True
+            for board in self._all_leaderboards():
+                board.hide(user_id)
             self._save_json(self.users_file, self.users)
             return True
         return False
@@ -900,6 +1113,8 @@ class Database:
         user_id = str(user_id)
         if user_id in self.users and self.users[user_id]["ghosted"]:
             self.users[user_id]["ghosted"] = False
+            for board in self._all_leaderboards():
+                board.show(user_id)
             self._save_json(self.users_file, self.users)
             return True
         return False
@@ -922,16 +1137,62 @@ class Database:
             return True
         return False
     
-    def get_top_users(self, limit=5):
-        """Get top users by upload count, excluding ghosted users"""
-        # Filter out ghosted users
-        visible_users = {uid: user for uid, user in self.users.items() if not user.get("ghosted", False)}
-        
-        # Sort by upload count (descending)
-        sorted_users = sorted(visible_users.items(), key=lambda x: x[1]["uploads"], reverse=True)
-        
-        # Return top N users
-        return sorted_users[:limit]
+    def get_top_users(self, limit=5, period=None):
+        """Get top (user_id, user, uploads) entries by upload count, excluding ghosted users
+        period is None for all time, or "today" / "week" for a rolling window of days"""
+        board = self.leaderboard if period is None else self.period_leaderboards[period]
+        return [(uid, self.users[uid], uploads) for uid, uploads in board.top(limit) if uid in self.users]
+    
+    # Alias search
+    def _build_alias_index(self):
+        """Build the n-gram index over user aliases"""
+        self.alias_index = NGramIndex()
+        for user_id, user in self.users.items():
+            self.alias_index.add(user_id, user.get("alias", ""))
+    
+    def search_users_by_alias(self, query):
+        """Get IDs of users whose alias contains the query (case-insensitive)"""
+        return [uid for uid in self.alias_index.search(query) if uid in self.users]
+    
+    # Leaderboards
+    def _build_leaderboards(self, media_summaries):
+        """Build the all-time and windowed upload leaderboards from the loaded data"""
+        self.leaderboard = Leaderboard()
+        self.period_leaderboards = {
+            "today": WindowedLeaderboard(days=1),
+            "week": WindowedLeaderboard(days=7)
+        }
+        for user_id, user in self.users.items():
+            if user.get("ghosted", False):
+                for board in self._all_leaderboards():
+                    board.hide(user_id)
+            self.leaderboard.set(user_id, user.get("uploads", 0))
+        
+        # Only recent uploads matter for the windowed boards
+        week_start = time.time() - 7 * 86400
+        for _, media_data in media_summaries:
+            if media_data.get("upload_time", 0) >= week_start:
+                for board in self.period_leaderboards.values():
+                    board.record(media_data["user_id"], media_data["upload_time"])
+    
+    def _all_leaderboards(self):
+        return [self.leaderboard] + list(self.period_leaderboards.values())
+    
+    def _record_upload(self, user_id, upload_time, delta):
+        """Apply an upload count change to every leaderboard"""
+        self.leaderboard.set(user_id, self.users[user_id]["uploads"])
+        for board in self.period_leaderboards.values():
+            board.record(user_id, upload_time, delta)
+    
+    def _sync_leaderboards(self, user_id):
+        """Bring the leaderboards in line with a user's stored uploads and ghosted flag"""
+        user = self.users[user_id]
+        self.leaderboard.set(user_id, user.get("uploads", 0))
+        for board in self._all_leaderboards():
+            if user.get("ghosted", False):
+                board.hide(user_id)
+            else:
+                board.show(user_id)
     
     # Statistics
     def get_stats(self):
@@ -947,25 +1208,70 @@ class Database:
         
         self.stats["database_size"] = db_size
         
-        # Calculate media directory size
-        media_dir_size = 0
-        if os.path.exists(MEDIA_DIR):
-            for root, dirs, files in os.walk(MEDIA_DIR):
-                for file in files:
-                    try:
-                        file_path = os.path.join(root, file)
-                        media_dir_size += os.path.getsize(file_path)
-                    except OSError:
-                        pass # Ignore files that can't be accessed
-        
-        self.stats["media_size"] = media_dir_size
+        # Media directory size comes from the running storage totals instead of walking the tree
+        self.stats["media_size"] = self.store.usage["bytes"]
         
         return self.stats
+    
+    def count_storage(self):
+        """Count media storage on disk; slow and touches no shared state, so run it in a worker thread"""
+        return self.store.count_usage()
+
+    def reconcile_storage(self, counts):
+        """Correct the storage totals with counts from count_storage()"""
+        self.store.reconcile(counts)
+        self._save_json(self.stats_file, self.stats)
+        return self.store.usage
 
     def get_reported_media_count(self):
         """Get the count of reported media files"""
-        count = 0
-        for media_id, media_data in self.media.items():
-            if media_data.get("reported", False) and media_data.get("reports", []):
-                count += 1
-        return count
\ No newline at end of file
+        return len(self.report_queue)
+    
+    # Report moderation
+    def find_media_by_file_id(self, file_id):
+        """Get the ID of a media record with this file_id, if any"""
+        media_ids = self.media_by_file_id.get(file_id)
+        return media_ids[0] if media_ids else None
+    
+    def report_media(self, media_id, reporter_id, reporter_alias):
+        """
+        Record a report against a media item and return its report count.
+        The media file is only marked dirty; the periodic flush writes a burst of reports at once.
+        """
+        if media_id not in self.media:
+            return 0
+        
+        media_data = self.media[media_id]
+        report_time = time.time()
+        media_data["reported"] = True
+        media_data.setdefault("reports", []).append({
+            "user_id": str(reporter_id),
+            "time": report_time,
+            "alias": reporter_alias
+        })
+        self.report_queue.update(media_id, len(media_data["reports"]), report_time)
+        self.mark_dirty(self.media_file, self.media)
+        return len(media_data["reports"])
+    
+    def set_report_message(self, media_id, message_id):
+        """Remember the admin notification that tracks reports for a media item"""
+        if media_id in self.media:
+            self.media[media_id]["report_message_id"] = message_id
+            self.mark_dirty(self.media_file, self.media)
+    
+    def dismiss_reports(self, media_id):
+        """Clear the reports on a media item and take it out of the moderation queue"""
+        if media_id not in self.media:
+            return False
+        
+        media_data = self.media[media_id]
+        media_data["reported"] = False
+        media_data["reports"] = []
+        media_data.pop("report_message_id", None)
+        self.report_queue.remove(media_id)
+        self.mark_dirty(self.media_file, self.media)
+        return True
+    
+    def get_report_queue(self, offset=0, limit=10):
+        """Get (media_id, report_count, last_report_time) for reported media, most reported first"""
+        return self.report_queue.page(offset, limit)
\ No newline at end of file
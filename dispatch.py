@@ -0,0 +1,63 @@
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Users whose updates are handled at the same time
+DISPATCH_CONCURRENCY = 8
+
+class UserDispatcher:
+    """
+    Runs handlers in order for each user and in parallel across users.
+    Every user with pending updates gets a serial lane that exists only while it has work;
+    a user's next update starts only after the previous one finished, so handlers never race
+    on one user's state, while updates from other users proceed in their own lanes.
+    At most concurrency bounded (bulk) handlers run at once, taken in turn by the busy lanes;
+    unbounded (interactive) handlers keep their place in the lane but don't wait for a slot.
+    Work a handler starts in a separate task is not covered by the lane.
+    """
+    def __init__(self, concurrency=DISPATCH_CONCURRENCY):
+        self.concurrency = concurrency
+        self._lanes = {}
+        self._tasks = set()
+        self._slots = None
+        self._running = 0
+
+    def submit(self, user_id, handler, *args, bounded=True):
+        """Queue handler(*args) behind the user's earlier updates"""
+        lane = self._lanes.get(user_id)
+        if lane is None:
+            lane = self._lanes[user_id] = deque()
+            task = asyncio.create_task(self._drain(user_id, lane))
+            # Keep a reference so the task isn't garbage collected while it runs
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        lane.append((handler, args, bounded))
+
+    async def _drain(self, user_id, lane):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        while lane:
+            handler, args, bounded = lane.popleft()
+            self._running += 1
+            try:
+                # Take a slot per update, so a user with a long backlog doesn't hold one while others wait
+                if bounded:
+                    async with self._slots:
+                        await handler(*args)
+                else:
+                    await handler(*args)
+            except Exception as e:
+                logger.error(f"Error in {handler.__name__} for user {user_id}: {str(e)}")
+            finally:
+                self._running -= 1
+        del self._lanes[user_id]
+
+    def backlog(self):
+        """Number of updates queued or running across all users"""
+        return sum(len(lane) for lane in self._lanes.values()) + self._running
+
+    def busy_users(self):
+        """Number of users with updates in progress"""
+        return len(self._lanes)
@@ -0,0 +1,86 @@
+import time
+import asyncio
+from collections import deque
+
+# Service tiers, highest priority first
+TIERS = ("premium", "active", "inactive")
+
+# Relative share of service each tier gets while several are waiting
+DEFAULT_TIER_WEIGHTS = {
+    "premium": 8,
+    "active": 3,
+    "inactive": 1
+}
+
+# Wait times kept per tier for percentiles
+WAIT_SAMPLES = 1000
+
+def parse_tier_weights(value, default=None):
+    """Parse weights written as "premium=8,active=3,inactive=1"; tiers left out keep their default"""
+    weights = dict(default or DEFAULT_TIER_WEIGHTS)
+    for part in (value or "").split(","):
+        if "=" not in part:
+            continue
+        tier, weight = part.split("=", 1)
+        tier = tier.strip()
+        if tier in weights:
+            weights[tier] = max(1, int(weight))
+    return weights
+
+class WaitStats:
+    """Recent queue wait times per tier"""
+    def __init__(self, samples=WAIT_SAMPLES):
+        self.samples = samples
+        self.waits = {}
+
+    def record(self, tier, seconds):
+        if tier not in self.waits:
+            self.waits[tier] = deque(maxlen=self.samples)
+        self.waits[tier].append(seconds)
+
+    def percentiles(self, tier, points=(50, 90, 99)):
+        """Get wait time percentiles in seconds for a tier, or None if nothing was recorded"""
+        waits = sorted(self.waits.get(tier, ()))
+        if not waits:
+            return None
+        return {point: waits[min(len(waits) - 1, len(waits) * point // 100)] for point in points}
+
+class WeightedFairQueue:
+    """
+    asyncio queue that shares service between tiers in proportion to their weights.
+    Each item is stamped with a virtual finish time (its tier's previous stamp plus 1/weight),
+    and get() always serves the smallest stamp. Under load a premium user with weight 8 gets
+    eight items served for every inactive one, but no tier is ever starved, and a tier that
+    was idle can't build up credit to flood the queue later.
+    """
+    def __init__(self, weights=None, stats=None):
+        self.weights = dict(weights or DEFAULT_TIER_WEIGHTS)
+        self.stats = stats if stats is not None else WaitStats()
+        self._items = {tier: deque() for tier in self.weights}
+        self._last_finish = {tier: 0.0 for tier in self.weights}
+        self._virtual_time = 0.0
+        self._available = asyncio.Semaphore(0)
+
+    def put_nowait(self, tier, item):
+        if tier not in self.weights:
+            tier = TIERS[-1]
+        finish = max(self._virtual_time, self._last_finish[tier]) + 1.0 / self.weights[tier]
+        self._last_finish[tier] = finish
+        self._items[tier].append((finish, time.monotonic(), item))
+        self._available.release()
+
+    async def get(self):
+        """Wait for the next item and return (tier, item)"""
+        await self._available.acquire()
+        tier = min((tier for tier in self._items if self._items[tier]), key=lambda tier: self._items[tier][0][0])
+        finish, queued_at, item = self._items[tier].popleft()
+        self._virtual_time = finish
+        self.stats.record(tier, time.monotonic() - queued_at)
+        return tier, item
+
+    def qsize(self):
+        return sum(len(items) for items in self._items.values())
+
+    def depth(self):
+        """Get the number of queued items in each tier"""
+        return {tier: len(items) for tier, items in self._items.items()}
@@ -0,0 +1,51 @@
+import re
+import sys
+import subprocess
+
+# Cumulative import time allowed per module in a fresh interpreter, in milliseconds.
+# Measured at about 70ms for database and 20ms for utils (810ms while utils imported Pyrogram);
+# CLI tools like check_key.py only import these, so they must stay clear of Pyrogram and Pillow.
+IMPORT_BUDGETS = {
+    "database": 120,
+    "utils": 50
+}
+
+# Modules that must not be imported along with the budgeted ones
+HEAVY_MODULES = ("pyrogram", "PIL")
+
+# One line of -X importtime output: self time, cumulative time, indented module name
+IMPORTTIME_LINE = re.compile(r"import time:\s*(\d+) \|\s*(\d+) \| ( *)(\S+)")
+
+def measure(module):
+    """Get (cumulative milliseconds, imported module names) for a fresh import of a module"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+    total = 0
+    imported = set()
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        imported.add(match.group(4))
+        if match.group(4) == module and not match.group(3):
+            total = int(match.group(2)) / 1000
+    return total, imported
+
+def main():
+    failed = False
+    for module, budget in IMPORT_BUDGETS.items():
+        total, imported = measure(module)
+        heavy = sorted(name for name in imported if name.split(".")[0] in HEAVY_MODULES)
+        status = "ok" if total <= budget and not heavy else "OVER"
+        print(f"{module}: {total:.1f}ms (budget {budget}ms) {status}")
+        if heavy:
+            print(f"  imports {', '.join(heavy[:5])}")
+        failed = failed or status != "ok"
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+
+from fair_queue import TIERS, WaitStats, WeightedFairQueue
+
+logger = logging.getLogger(__name__)
+
+# Largest file size, in bytes, handled by each lane; anything bigger goes to the huge lane
+SMALL_MAX_SIZE = 20 * 1024 * 1024
+MEDIUM_MAX_SIZE = 300 * 1024 * 1024
+
+# Jobs run concurrently in each lane
+LANE_CONCURRENCY = {
+    "small": 4,
+    "medium": 2,
+    "huge": 1
+}
+
+class IngestScheduler:
+    """
+    Runs media ingest jobs in lanes by file size.
+    Each lane has its own queue and worker budget, so a multi-GB video only occupies a huge-lane
+    worker while photos queued behind it keep flowing through the small lane.
+    Within a lane, jobs are served by weighted fair queuing over the uploader's tier.
+    Jobs are counted per user, and on_user_drained is called once a user has nothing left in any lane.
+    """
+    def __init__(self, handler, concurrency=None, on_user_drained=None, tier_weights=None):
+        self.handler = handler
+        self.concurrency = dict(concurrency or LANE_CONCURRENCY)
+        self.on_user_drained = on_user_drained
+        self.tier_weights = tier_weights
+        # Queue wait times by tier, across all lanes
+        self.wait_stats = WaitStats()
+        self.queues = {}
+        self.pending_by_user = {}
+        self.done_by_user = {}
+        self._workers = []
+
+    @staticmethod
+    def lane_for(file_size):
+        """Get the lane for a file of the given size"""
+        if not file_size or file_size <= SMALL_MAX_SIZE:
+            return "small"
+        if file_size <= MEDIUM_MAX_SIZE:
+            return "medium"
+        return "huge"
+
+    def start(self):
+        """Start the lane workers on the running event loop"""
+        if self._workers:
+            return
+        for lane, workers in self.concurrency.items():
+            self.queues[lane] = WeightedFairQueue(self.tier_weights, self.wait_stats)
+            for _ in range(workers):
+                self._workers.append(asyncio.create_task(self._worker(lane)))
+
+    def submit(self, user_id, file_size, job, tier=TIERS[-1], track=True):
+        """Queue a job in the lane matching its file size and return the lane name
+        Untracked jobs don't count towards the user's on_user_drained notification"""
+        self.start()
+        lane = self.lane_for(file_size)
+        user_id = str(user_id) if track else None
+        if track:
+            self.pending_by_user[user_id] = self.pending_by_user.get(user_id, 0) + 1
+        self.queues[lane].put_nowait(tier, (user_id, job))
+        return lane
+
+    async def _worker(self, lane):
+        queue = self.queues[lane]
+        while True:
+            _, (user_id, job) = await queue.get()
+            try:
+                await self.handler(job)
+                if user_id is not None:
+                    self.done_by_user[user_id] = self.done_by_user.get(user_id, 0) + 1
+            except Exception as e:
+                logger.error(f"Error in {lane} ingest lane for user {user_id}: {str(e)}")
+            finally:
+                if user_id is not None:
+                    await self._finish(user_id)
+
+    async def _finish(self, user_id):
+        self.pending_by_user[user_id] -= 1
+        if self.pending_by_user[user_id] > 0:
+            return
+        del self.pending_by_user[user_id]
+        done = self.done_by_user.pop(user_id, 0)
+        if self.on_user_drained is not None and done:
+            try:
+                await self.on_user_drained(user_id, done)
+            except Exception as e:
+                logger.error(f"Error finishing ingest for user {user_id}: {str(e)}")
+
+    def depth(self):
+        """Get the number of queued jobs in each lane"""
+        return {lane: queue.qsize() for lane, queue in self.queues.items()}
+
+    def tier_depth(self):
+        """Get the number of queued jobs for each tier, across all lanes"""
+        depth = {tier: 0 for tier in TIERS}
+        for queue in self.queues.values():
+            for tier, count in queue.depth().items():
+                depth[tier] = depth.get(tier, 0) + count
+        return depth
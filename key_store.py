@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import heapq
+import logging
+import threading
+
+from file_lock import file_lock
+
+logger = logging.getLogger(__name__)
+
+# How long a new access key stays valid, in seconds
+KEY_TTL = 86400
+
+class KeyStore:
+    """
+    Access keys with O(1) validation and append-only usage tracking.
+    keys.json only holds per-key metadata and is rewritten when keys are created or disabled.
+    Registrations are appended to a join log and replayed into in-memory counters at load,
+    so redeeming a key never rewrites the key file.
+    Expiry times are kept in a heap so a sweep only touches keys that have actually expired,
+    and the set of usable keys is maintained as keys change rather than counted on demand.
+    """
+    def __init__(self, keys_file, joins_file, load_json, save_json, ttl=KEY_TTL):
+        self.keys_file = keys_file
+        self.joins_file = joins_file
+        self.ttl = ttl
+        self._save_json = save_json
+
+        self.keys = load_json(keys_file)
+        # key -> uses, counted from the legacy "uses" field plus every logged join
+        self.uses = {}
+        self._expiry_heap = []
+        self._live = set()
+        # Makes the validity check and the join record of a redemption one step
+        self._lock = threading.Lock()
+
+        now = time.time()
+        for key, key_data in self.keys.items():
+            # Keys created before expiry was enforced get the advertised lifetime from their creation time
+            if "expires_at" not in key_data:
+                key_data["expires_at"] = key_data.get("created", now) + self.ttl
+            self.uses[key] = key_data.get("uses", 0)
+
+        self._replay_joins()
+
+        for key, key_data in self.keys.items():
+            if key_data.get("active", False):
+                heapq.heappush(self._expiry_heap, (key_data["expires_at"], key))
+            self._refresh(key)
+
+    def _replay_joins(self):
+        """Count the registrations recorded in the join log"""
+        if not os.path.exists(self.joins_file):
+            return
+
+        try:
+            with file_lock(self.joins_file):
+                with open(self.joins_file, 'r') as f:
+                    for line in f:
+                        try:
+                            key = json.loads(line)["key"]
+                        except (ValueError, KeyError):
+                            continue  # Skip a line torn by a crash mid-append
+                        if key in self.uses:
+                            self.uses[key] += 1
+        except Exception as e:
+            logger.error(f"Error replaying key joins from {self.joins_file}: {str(e)}")
+
+    def _is_usable(self, key):
+        key_data = self.keys[key]
+        if not key_data.get("active", False):
+            return False
+        if key_data["expires_at"] <= time.time():
+            return False
+        max_uses = key_data.get("max_uses", 0)
+        return max_uses <= 0 or self.uses[key] < max_uses
+
+    def _refresh(self, key):
+        """Update the active-key set after a key changed"""
+        if self._is_usable(key):
+            self._live.add(key)
+        else:
+            self._live.discard(key)
+
+    def save(self):
+        self._save_json(self.keys_file, self.keys)
+
+    def add(self, key, key_type, max_uses):
+        """Register a new key; the caller saves"""
+        created = time.time()
+        self.keys[key] = {
+            "type": key_type,
+            "created": created,
+            "expires_at": created + self.ttl,
+            "uses": 0,
+            "max_uses": max_uses,
+            "active": True
+        }
+        self.uses[key] = 0
+        heapq.heappush(self._expiry_heap, (created + self.ttl, key))
+        self._refresh(key)
+
+    def get(self, key):
+        """Get key data with its current use count"""
+        key_data = self.keys.get(key)
+        if key_data is None:
+            return None
+        return dict(key_data, uses=self.uses[key])
+
+    def get_type(self, key):
+        key_data = self.keys.get(key)
+        return key_data["type"] if key_data else None
+
+    def is_valid(self, key):
+        """Check if a key can still be used to register"""
+        return key in self.keys and self._is_usable(key)
+
+    def record_join(self, key, user_id):
+        """Count a registration against a key by appending it to the join log"""
+        if key not in self.keys:
+            return False
+
+        entry = json.dumps({"key": key, "user_id": user_id, "time": time.time()})
+        with file_lock(self.joins_file):
+            with open(self.joins_file, 'a') as f:
+                f.write(entry + "\n")
+
+        self.uses[key] += 1
+        self._refresh(key)
+        return True
+
+    def redeem(self, key, user_id):
+        """
+        Atomically check a key and count a registration against it.
+        Returns False if the key is invalid, expired or used up, so concurrent redemptions
+        of a multi-use key can never exceed max_uses.
+        """
+        with self._lock:
+            if not self.is_valid(key):
+                return False
+            return self.record_join(key, user_id)
+
+    def disable(self, key):
+        """Disable a key"""
+        if key not in self.keys:
+            return False
+        self.keys[key]["active"] = False
+        self._live.discard(key)
+        self.save()
+        return True
+
+    def sweep_expired(self, now=None):
+        """Disable every key past its expiry time with a single write; returns how many were disabled"""
+        now = now if now is not None else time.time()
+        expired = 0
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            expires_at, key = heapq.heappop(self._expiry_heap)
+            key_data = self.keys.get(key)
+            if key_data is None or not key_data.get("active", False) or key_data["expires_at"] != expires_at:
+                continue  # Stale entry for a key that was already disabled
+            key_data["active"] = False
+            self._live.discard(key)
+            expired += 1
+
+        if expired:
+            self.save()
+            logger.info(f"Disabled {expired} expired access keys")
+        return expired
+
+    @property
+    def active_count(self):
+        """Number of keys that can currently be used to register"""
+        return len(self._live)
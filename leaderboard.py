@@ -0,0 +1,125 @@
+import time
+from bisect import bisect_left, insort
+from datetime import datetime
+
+class Leaderboard:
+    """
+    Incrementally maintained ranking of members by score.
+    Members are grouped into buckets by score and the distinct scores are kept sorted,
+    so updates are cheap and top(n) only touches the members it returns.
+    Hidden members keep their score but are left out of the ranking.
+    """
+    def __init__(self):
+        self.scores = {}
+        self.hidden = set()
+        self._buckets = {}  # score -> members with that score, in insertion order
+        self._levels = []   # distinct scores present in the buckets, ascending
+
+    def _link(self, member):
+        score = self.scores[member]
+        bucket = self._buckets.get(score)
+        if bucket is None:
+            bucket = self._buckets[score] = {}
+            insort(self._levels, score)
+        bucket[member] = None
+
+    def _unlink(self, member):
+        score = self.scores[member]
+        bucket = self._buckets.get(score)
+        if bucket is not None and member in bucket:
+            del bucket[member]
+            if not bucket:
+                del self._buckets[score]
+                del self._levels[bisect_left(self._levels, score)]
+
+    def set(self, member, score):
+        """Set a member's score"""
+        visible = member not in self.hidden
+        if member in self.scores and visible:
+            self._unlink(member)
+        self.scores[member] = score
+        if visible:
+            self._link(member)
+
+    def increment(self, member, delta=1):
+        """Add delta to a member's score"""
+        self.set(member, self.scores.get(member, 0) + delta)
+
+    def remove(self, member):
+        """Drop a member from the leaderboard"""
+        if member in self.scores:
+            if member not in self.hidden:
+                self._unlink(member)
+            del self.scores[member]
+        self.hidden.discard(member)
+
+    def hide(self, member):
+        """Leave a member out of the ranking while still tracking their score"""
+        if member in self.scores and member not in self.hidden:
+            self._unlink(member)
+        self.hidden.add(member)
+
+    def show(self, member):
+        """Put a hidden member back into the ranking"""
+        if member in self.hidden:
+            self.hidden.discard(member)
+            if member in self.scores:
+                self._link(member)
+
+    def top(self, n):
+        """Get the n highest (member, score) pairs"""
+        result = []
+        for score in reversed(self._levels):
+            for member in self._buckets[score]:
+                if len(result) >= n:
+                    return result
+                result.append((member, score))
+        return result
+
+class WindowedLeaderboard(Leaderboard):
+    """
+    Leaderboard over a sliding window of calendar days (e.g. today, this week).
+    Per-day counts are kept so that a day leaving the window is subtracted without rescanning anything.
+    """
+    def __init__(self, days):
+        super().__init__()
+        self.days = days
+        self._daily = {}  # day ordinal -> {member: count}
+
+    @staticmethod
+    def _day(timestamp):
+        return datetime.fromtimestamp(timestamp).toordinal()
+
+    def _apply(self, member, delta):
+        score = self.scores.get(member, 0) + delta
+        if score > 0:
+            self.set(member, score)
+        else:
+            hidden = member in self.hidden
+            self.remove(member)
+            if hidden:
+                self.hidden.add(member)
+
+    def expire(self, now=None):
+        """Subtract days that have left the window"""
+        oldest = self._day(now if now is not None else time.time()) - self.days + 1
+        for day in [day for day in self._daily if day < oldest]:
+            for member, count in self._daily.pop(day).items():
+                self._apply(member, -count)
+
+    def record(self, member, timestamp, delta=1):
+        """Count delta uploads for a member at the given time"""
+        self.expire()
+        day = self._day(timestamp)
+        if day < self._day(time.time()) - self.days + 1:
+            return  # Outside the window
+        counts = self._daily.setdefault(day, {})
+        counts[member] = counts.get(member, 0) + delta
+        if counts[member] <= 0:
+            del counts[member]
+        self._apply(member, delta)
+
+    def top(self, n):
+        """Get the n highest (member, score) pairs within the window"""
+        self.expire()
+        return super().top(n)
@@ -0,0 +1,49 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Prefix of the string form of a media ID
+MEDIA_ID_PREFIX = "media_"
+
+def media_id_for(number):
+    """Get the string media ID used in commands, callback data and the JSON files for a media number"""
+    return f"{MEDIA_ID_PREFIX}{number}"
+
+def parse_media_number(text):
+    """Get the media number from "media_<n>" or a bare number, or None for anything else (like legacy IDs)"""
+    text = text.strip()
+    if text.startswith(MEDIA_ID_PREFIX):
+        text = text[len(MEDIA_ID_PREFIX):]
+    return int(text) if text.isdigit() else None
+
+class MediaIdAllocator:
+    """
+    Hands out media numbers from a counter kept in the stats, so IDs only ever grow and can't collide.
+    Every record carries its number in the "seq" field; media from before the counter existed, whose IDs
+    were built from the upload second and a random suffix, is numbered once in upload order and keeps
+    its old string ID. The counter is found from the media summaries, so records still in the snapshot stay undecoded.
+    """
+    def __init__(self, stats, media, summaries):
+        self.stats = stats
+        numbered = [media_data["seq"] for _, media_data in summaries if "seq" in media_data]
+        next_number = max(stats.get("next_media_id", 1), max(numbered, default=0) + 1)
+
+        legacy = sorted(
+            ((media_id, media_data) for media_id, media_data in summaries if "seq" not in media_data),
+            key=lambda entry: entry[1].get("upload_time", 0)
+        )
+        for media_id, _ in legacy:
+            media[media_id]["seq"] = next_number
+            next_number += 1
+        if legacy:
+            logger.info(f"Numbered {len(legacy)} media records from before integer IDs")
+
+        self.stats["next_media_id"] = next_number
+        # Whether records were numbered here and still need saving
+        self.backfilled = bool(legacy)
+
+    def allocate(self):
+        """Get the next media number; persisted with the stats"""
+        number = self.stats["next_media_id"]
+        self.stats["next_media_id"] = number + 1
+        return number
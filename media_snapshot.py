@@ -0,0 +1,250 @@
+import os
+import json
+import mmap
+import struct
+import logging
+from collections.abc import MutableMapping
+
+from records import MediaRecord, to_json
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"MVSNAP1\n"
+# media.json mtime (ns) and size the snapshot was taken from, record count, offsets of the rows and strings
+HEADER = struct.Struct("<qqIQQ")
+# Per record: blob offset and length, seq, upload_time, file_size, phash, flags
+ROW = struct.Struct("<QIQdQQB")
+
+# Row flags
+HAS_SEQ = 1
+HAS_PHASH = 2
+REPORTED = 4
+PENDING_DOWNLOAD = 8
+IS_DUPLICATE = 16
+HAS_DUPLICATES = 32
+
+# Boolean fields kept in the index as flags
+ROW_FLAGS = (
+    ("reported", REPORTED),
+    ("pending_download", PENDING_DOWNLOAD),
+    ("is_duplicate", IS_DUPLICATE),
+    ("has_duplicates", HAS_DUPLICATES)
+)
+
+# Strings kept in the index after each record's ID, all in one NUL-separated block;
+# a missing value is stored empty and reads back as None
+ROW_STRINGS = ("user_id", "file_id", "file_unique_id", "file_path", "alias")
+STRING_SEPARATOR = "\0"
+
+def _stamp(json_path):
+    stat = os.stat(json_path)
+    return stat.st_mtime_ns, stat.st_size
+
+class LazyMedia(MutableMapping):
+    """
+    The media table, backed by a memory-mapped snapshot file.
+    A snapshot holds every record as a compact JSON blob, followed by an index of fixed-size rows and
+    one block of strings with the fields the lookup indexes and leaderboards are built from.
+    Opening it reads only the index; a record is decoded from the mapped file the first time it is
+    accessed and kept as a MediaRecord from then on, as are records added at runtime.
+    """
+    def __init__(self, records=None):
+        self._records = dict(records or {})
+        # Media ID -> (index row, index strings) for records not decoded yet
+        self._rows = {}
+        self._mmap = None
+        self._file = None
+        # media.json mtime and size the mapped snapshot was taken from
+        self.stamp = None
+
+    @classmethod
+    def open(cls, snapshot_path, json_path):
+        """Map a snapshot taken from the current media.json; returns None if there is none or it is out of date"""
+        try:
+            if not os.path.exists(snapshot_path) or not os.path.exists(json_path):
+                return None
+            media = cls()
+            media._map(snapshot_path)
+            mtime_ns, size, count, rows_offset, strings_offset = HEADER.unpack_from(media._mmap, len(MAGIC))
+            if media._mmap[:len(MAGIC)] != MAGIC or (mtime_ns, size) != _stamp(json_path):
+                media.close()
+                return None
+            media._read_index(count, rows_offset, strings_offset)
+            media.stamp = (mtime_ns, size)
+            return media
+        except Exception as e:
+            logger.error(f"Error opening media snapshot {snapshot_path}: {str(e)}")
+            return None
+
+    def _map(self, snapshot_path):
+        self._file = open(snapshot_path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _read_index(self, count, rows_offset, strings_offset):
+        # Each block is decoded in one go; summaries are only built when asked for
+        rows = ROW.iter_unpack(self._mmap[rows_offset:strings_offset])
+        strings = self._mmap[strings_offset:].decode("utf-8").split(STRING_SEPARATOR)
+        width = len(ROW_STRINGS) + 1
+        for index, row in zip(range(count), rows):
+            fields = strings[index * width:(index + 1) * width]
+            self._rows[fields[0]] = (row, fields[1:])
+
+    @staticmethod
+    def _summary(row, fields):
+        _, _, seq, upload_time, file_size, phash, flags = row
+        user_id, file_id, file_unique_id, file_path, alias = fields
+        summary = {
+            "user_id": user_id or None,
+            "file_id": file_id or None,
+            "file_unique_id": file_unique_id or None,
+            "file_path": file_path or None,
+            "alias": alias or None,
+            "upload_time": upload_time,
+            "file_size": file_size,
+            "reported": bool(flags & REPORTED),
+            "pending_download": bool(flags & PENDING_DOWNLOAD),
+            "is_duplicate": bool(flags & IS_DUPLICATE),
+            "has_duplicates": bool(flags & HAS_DUPLICATES)
+        }
+        if flags & HAS_SEQ:
+            summary["seq"] = seq
+        if flags & HAS_PHASH:
+            summary["phash"] = format(phash, "016x")
+        return summary
+
+    def _raw(self, media_id):
+        blob_offset, blob_length = self._rows[media_id][0][:2]
+        return self._mmap[blob_offset:blob_offset + blob_length]
+
+    def __getitem__(self, media_id):
+        record = self._records.get(media_id)
+        if record is not None:
+            return record
+        if media_id not in self._rows:
+            raise KeyError(media_id)
+        record = MediaRecord.from_dict(json.loads(self._raw(media_id)))
+        self._records[media_id] = record
+        del self._rows[media_id]
+        return record
+
+    def __setitem__(self, media_id, record):
+        self._rows.pop(media_id, None)
+        self._records[media_id] = record
+
+    def __delitem__(self, media_id):
+        if media_id in self._records:
+            del self._records[media_id]
+        else:
+            del self._rows[media_id]
+
+    def __contains__(self, media_id):
+        return media_id in self._records or media_id in self._rows
+
+    def __iter__(self):
+        yield from list(self._records)
+        yield from list(self._rows)
+
+    def __len__(self):
+        return len(self._records) + len(self._rows)
+
+    def summaries(self):
+        """
+        Get (media_id, data) for every record without decoding those still in the snapshot.
+        Their data is a dict of the indexed fields only; reported media is always decoded,
+        since the report queue needs its reports.
+        """
+        for media_id, record in list(self._records.items()):
+            yield media_id, record
+        for media_id, (row, fields) in list(self._rows.items()):
+            if row[-1] & REPORTED:
+                yield media_id, self[media_id]
+            else:
+                yield media_id, self._summary(row, fields)
+
+    def materialized_count(self):
+        """Number of records decoded or added since the snapshot was mapped"""
+        return len(self._records)
+
+    def write_json(self, f):
+        """Write the table as media.json, copying records still in the snapshot without decoding them"""
+        f.write("{")
+        first = True
+        for media_id in list(self._records) + list(self._rows):
+            if media_id in self._records:
+                data = json.dumps(self._records[media_id], indent=2, default=to_json)
+            else:
+                data = self._raw(media_id).decode("utf-8")
+            f.write(f"{'' if first else ','}\n  {json.dumps(media_id)}: {data}")
+            first = False
+        f.write("\n}" if not first else "}")
+
+    def is_current(self, json_path):
+        """Whether the mapped snapshot was taken from media.json as it is on disk now"""
+        return self.stamp is not None and os.path.exists(json_path) and self.stamp == _stamp(json_path)
+
+    def write_snapshot(self, snapshot_path, json_path):
+        """
+        Write a snapshot of the table stamped with the current media.json, then map it.
+        The table must match media.json on disk. Records not decoded yet are copied from the old snapshot as they are.
+        """
+        temp_path = f"{snapshot_path}.tmp"
+        rows = []
+        strings = []
+        with open(temp_path, "wb") as f:
+            f.write(MAGIC)
+            f.write(b"\0" * HEADER.size)
+            offset = len(MAGIC) + HEADER.size
+            for media_id in list(self._records) + list(self._rows):
+                if media_id in self._records:
+                    summary = self._records[media_id]
+                    blob = json.dumps(summary, separators=(",", ":"), default=to_json).encode("utf-8")
+                else:
+                    summary = self._summary(*self._rows[media_id])
+                    blob = bytes(self._raw(media_id))
+                f.write(blob)
+
+                flags = 0
+                if summary.get("seq") is not None:
+                    flags |= HAS_SEQ
+                if summary.get("phash"):
+                    flags |= HAS_PHASH
+                for field, flag in ROW_FLAGS:
+                    if summary.get(field):
+                        flags |= flag
+                rows.append(ROW.pack(
+                    offset, len(blob), summary.get("seq") or 0, summary.get("upload_time") or 0,
+                    summary.get("file_size") or 0, int(summary["phash"], 16) if summary.get("phash") else 0, flags
+                ))
+                strings.append(media_id)
+                strings.extend(str(summary.get(field) or "") for field in ROW_STRINGS)
+                offset += len(blob)
+
+            rows_offset = offset
+            f.write(b"".join(rows))
+            strings_offset = rows_offset + ROW.size * len(rows)
+            f.write(STRING_SEPARATOR.join(strings).encode("utf-8"))
+
+            f.seek(len(MAGIC))
+            mtime_ns, size = _stamp(json_path)
+            f.write(HEADER.pack(mtime_ns, size, len(rows), rows_offset, strings_offset))
+            f.flush()
+            os.fsync(f.fileno())
+
+        # Swap in the new file; the old mapping must be closed first on platforms that lock mapped files
+        self.close()
+        os.replace(temp_path, snapshot_path)
+        self._map(snapshot_path)
+        self.stamp = (mtime_ns, size)
+        # Records not decoded yet now point into the new file; decoded ones stay in memory
+        self._rows = {}
+        self._read_index(len(rows), rows_offset, strings_offset)
+        for media_id in self._records:
+            self._rows.pop(media_id, None)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
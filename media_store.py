@@ -0,0 +1,185 @@
+import os
+import time
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Hash algorithm used to address stored media
+HASH_ALGORITHM = "sha256"
+
+class MediaStore:
+    """
+    Content-addressed storage for downloaded media.
+    Every file is stored once under root/ab/cd/<hash>, so reposted content shares the same bytes
+    and no single directory grows large enough to make listings slow.
+    """
+    def __init__(self, root):
+        self.root = root
+        # In-progress downloads are written here before being moved into place
+        self.temp_dir = os.path.join(root, "incoming")
+        os.makedirs(self.temp_dir, exist_ok=True)
+        
+        # Running storage totals, updated on every write and delete and corrected by reconcile()
+        # duplicate_bytes is maintained by the database, which owns the reference counts
+        self.usage = {
+            "files": 0,
+            "bytes": 0,
+            "duplicate_bytes": 0,
+            "temp_bytes": 0
+        }
+
+    def open_sink(self, name):
+        """Open a streaming sink writing to a new temp file"""
+        return DownloadSink(self.temp_path(name), self)
+
+    def path_for(self, digest):
+        """Get the storage path for a content hash"""
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def temp_path(self, name):
+        """Get a temp file path for a download in progress"""
+        return os.path.join(self.temp_dir, f"{name}.temp")
+
+    def put(self, temp_path, digest):
+        """
+        Move a fully written temp file into the store and return its content path.
+        If the content is already stored, the temp file is dropped instead of kept as a second copy.
+        """
+        final_path = self.path_for(digest)
+        size = os.path.getsize(temp_path)
+        self.usage["temp_bytes"] -= size
+        if os.path.exists(final_path):
+            os.remove(temp_path)
+            logger.info(f"Content {digest} already stored, discarded new copy")
+            return final_path
+
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        os.replace(temp_path, final_path)
+        self.usage["files"] += 1
+        self.usage["bytes"] += size
+        return final_path
+
+    def account_file(self, file_path):
+        """Count a file written into the media tree outside of put()"""
+        try:
+            self.usage["files"] += 1
+            self.usage["bytes"] += os.path.getsize(file_path)
+        except OSError:
+            pass
+
+    def discard_temp(self, temp_path):
+        """Delete an unfinished temp file"""
+        try:
+            size = os.path.getsize(temp_path)
+            os.remove(temp_path)
+            self.usage["temp_bytes"] -= size
+        except FileNotFoundError:
+            pass
+
+    def remove(self, file_path):
+        """Delete stored bytes from disk"""
+        try:
+            size = os.path.getsize(file_path)
+            os.remove(file_path)
+            self.usage["files"] -= 1
+            self.usage["bytes"] -= size
+            return True
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logger.error(f"Error deleting file {file_path}: {str(e)}")
+            return False
+
+    def count_usage(self, pause_every=1000, pause=0.01):
+        """
+        Walk the media tree and count the files, bytes and temp bytes actually on disk.
+        Meant to run in a background thread, so it only reads; it pauses every few entries to stay easy on the disk.
+        """
+        files = 0
+        total_bytes = 0
+        temp_bytes = 0
+        seen = 0
+        for root, dirs, names in os.walk(self.root):
+            in_temp_dir = os.path.abspath(root) == os.path.abspath(self.temp_dir)
+            for name in names:
+                try:
+                    size = os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    continue  # Ignore files that disappear or can't be accessed
+                if in_temp_dir:
+                    temp_bytes += size
+                else:
+                    files += 1
+                    total_bytes += size
+                seen += 1
+                if seen % pause_every == 0:
+                    time.sleep(pause)
+        return {"files": files, "bytes": total_bytes, "temp_bytes": temp_bytes}
+
+    def reconcile(self, counts):
+        """Correct the file, byte and temp totals from count_usage(); call it from the thread that updates usage"""
+        drift = counts["bytes"] - self.usage["bytes"]
+        if drift:
+            logger.info(f"Storage accounting drift corrected: {drift:+d} bytes, {counts['files'] - self.usage['files']:+d} files")
+        self.usage.update(counts)
+        return self.usage
+
+class DownloadSink:
+    """
+    Streaming sink for downloads.
+    Writes chunks to a temp file while feeding a hasher and a byte counter, so the digest,
+    true size and throughput are known as soon as the download ends without reading the file again.
+    Usage:
+    with DownloadSink(temp_path) as sink:
+        async for chunk in client.stream_media(message):
+            sink.write(chunk)
+    """
+    def __init__(self, temp_path, store=None):
+        self.temp_path = temp_path
+        self.store = store
+        self.hasher = hashlib.new(HASH_ALGORITHM)
+        self.size = 0
+        self.started_at = None
+        self.finished_at = None
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.temp_path, "wb")
+        self.started_at = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._file.close()
+        self.finished_at = time.monotonic()
+        # A failed download leaves nothing behind, so a retry starts from a clean slate
+        if exc_type is not None:
+            if self.store is not None:
+                self.store.discard_temp(self.temp_path)
+            elif os.path.exists(self.temp_path):
+                os.remove(self.temp_path)
+
+    def write(self, chunk):
+        """Write a chunk to the temp file and account for it"""
+        self._file.write(chunk)
+        self.hasher.update(chunk)
+        self.size += len(chunk)
+        if self.store is not None:
+            self.store.usage["temp_bytes"] += len(chunk)
+
+    @property
+    def digest(self):
+        """Hex content hash of everything written so far"""
+        return self.hasher.hexdigest()
+
+    @property
+    def elapsed(self):
+        """Seconds spent streaming"""
+        if self.started_at is None:
+            return 0
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def throughput(self):
+        """Average bytes per second"""
+        return self.size / self.elapsed if self.elapsed > 0 else 0
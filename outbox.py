@@ -0,0 +1,259 @@
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+from fair_queue import TIERS, WaitStats
+
+logger = logging.getLogger(__name__)
+
+# Delivery states of an outbox message
+PENDING = "pending"
+SENDING = "sending"
+SENT = "sent"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipient INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    batch_id TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    last_error TEXT,
+    failure_reason TEXT,
+    tier TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at);
+CREATE INDEX IF NOT EXISTS outbox_batch ON outbox (batch_id, status);
+"""
+
+def text_payload(text, html=False):
+    """Payload for a text message"""
+    return {"kind": "text", "text": text, "html": html}
+
+def media_payload(file_id, media_type, caption=None, media_id=None, mark_synced=False):
+    """
+    Payload for sending stored media by file_id.
+    mark_synced records the media as synced to the recipient once it is delivered.
+    """
+    return {
+        "kind": "media",
+        "file_id": file_id,
+        "media_type": media_type,
+        "caption": caption,
+        "media_id": media_id,
+        "mark_synced": mark_synced
+    }
+
+def album_payload(items, caption=None, mark_synced=False):
+    """
+    Payload for sending stored media together as one album.
+    Items are dicts with file_id, media_type and media_id; the caption goes on the first item.
+    """
+    return {
+        "kind": "album",
+        "items": [
+            {"file_id": item["file_id"], "media_type": item["media_type"], "media_id": item.get("media_id")}
+            for item in items
+        ],
+        "caption": caption,
+        "mark_synced": mark_synced
+    }
+
+class Outbox:
+    """
+    Durable queue of outgoing messages backed by SQLite.
+    Every send is a row (recipient, payload, status, attempts, next_attempt_at), so a fan-out
+    interrupted by a crash resumes with the recipients that were not reached yet, and retry
+    backoff survives restarts. Payloads only reference content (file_id, media_id, text).
+    The database runs in WAL mode so progress polling never blocks the dispatcher.
+    Each message is tagged with its recipient's tier by tier_for, so claims can be shared between tiers by weight.
+    """
+    def __init__(self, db_path, tier_for=None):
+        self.db_path = db_path
+        self.tier_for = tier_for
+        # How long due messages waited to be sent, by tier
+        self.wait_stats = WaitStats()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+            # Outboxes created before failures were classified lack the reason column
+            columns = [row["name"] for row in self._conn.execute("PRAGMA table_info(outbox)")]
+            if "failure_reason" not in columns:
+                self._conn.execute("ALTER TABLE outbox ADD COLUMN failure_reason TEXT")
+            if "tier" not in columns:
+                self._conn.execute("ALTER TABLE outbox ADD COLUMN tier TEXT")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS outbox_tier_due ON outbox (status, tier, next_attempt_at)")
+            # Rows claimed by a dispatcher that died mid-send go back in the queue
+            recovered = self._conn.execute(
+                "UPDATE outbox SET status = ? WHERE status = ?", (PENDING, SENDING)
+            ).rowcount
+        if recovered:
+            logger.info(f"Requeued {recovered} outbox messages interrupted by a restart")
+
+    def enqueue(self, recipient, payload, batch_id=None, delay=0):
+        """Queue one message and return its row id"""
+        return self.enqueue_many([(recipient, payload)], batch_id, delay)[0]
+
+    def enqueue_many(self, messages, batch_id=None, delay=0):
+        """Queue (recipient, payload) pairs in a single transaction and return their row ids"""
+        now = time.time()
+        ids = []
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for recipient, payload in messages:
+                    tier = self.tier_for(recipient) if self.tier_for else None
+                    cursor = self._conn.execute(
+                        "INSERT INTO outbox (recipient, payload, batch_id, status, next_attempt_at, created_at, updated_at, tier) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (int(recipient), json.dumps(payload), batch_id, PENDING, now + delay, now, now, tier)
+                    )
+                    ids.append(cursor.lastrowid)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return ids
+
+    def claim(self, limit, weights=None):
+        """
+        Claim up to limit due messages for sending, oldest first.
+        With tier weights, each tier first gets a share of the claim in proportion to its weight,
+        and whatever a tier doesn't use goes to the oldest remaining messages of any tier.
+        Returns dicts with id, recipient, payload, batch_id, attempts, tier and next_attempt_at,
+        highest weighted tier first.
+        """
+        now = time.time()
+        columns = "id, recipient, payload, batch_id, attempts, tier, next_attempt_at"
+        rows = []
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if weights:
+                    total_weight = sum(weights.values())
+                    for tier, weight in weights.items():
+                        share = max(1, limit * weight // total_weight)
+                        rows.extend(self._claim_rows(
+                            f"SELECT {columns} FROM outbox WHERE status = ? AND tier = ? AND next_attempt_at <= ? "
+                            "ORDER BY next_attempt_at, id LIMIT ?",
+                            (PENDING, tier, now, min(share, limit - len(rows))), now
+                        ))
+                if len(rows) < limit:
+                    rows.extend(self._claim_rows(
+                        f"SELECT {columns} FROM outbox WHERE status = ? AND next_attempt_at <= ? "
+                        "ORDER BY next_attempt_at, id LIMIT ?",
+                        (PENDING, now, limit - len(rows)), now
+                    ))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        if weights:
+            rows.sort(key=lambda row: (-weights.get(row["tier"], 0), row["next_attempt_at"], row["id"]))
+        return [dict(row, payload=json.loads(row["payload"])) for row in rows]
+
+    def _claim_rows(self, query, params, now):
+        rows = self._conn.execute(query, params).fetchall() if params[-1] > 0 else []
+        self._conn.executemany(
+            "UPDATE outbox SET status = ?, updated_at = ? WHERE id = ?",
+            [(SENDING, now, row["id"]) for row in rows]
+        )
+        return rows
+
+    def _update(self, message_id, status, attempts_delta=0, next_attempt_at=None, error=None):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE outbox SET status = ?, attempts = attempts + ?, next_attempt_at = COALESCE(?, next_attempt_at), "
+                "updated_at = ?, last_error = COALESCE(?, last_error) WHERE id = ?",
+                (status, attempts_delta, next_attempt_at, time.time(), error, message_id)
+            )
+
+    def mark_sent(self, message_id):
+        self._update(message_id, SENT, attempts_delta=1)
+
+    def retry_later(self, message_id, delay, error=None, count_attempt=True):
+        """Put a message back in the queue to be tried again after delay seconds"""
+        self._update(message_id, PENDING, 1 if count_attempt else 0, time.time() + delay, error)
+
+    def mark_failed(self, message_id, error=None, reason="transient"):
+        """Give up on a message, recording why"""
+        self._update(message_id, FAILED, attempts_delta=1, error=error)
+        with self._lock:
+            self._conn.execute("UPDATE outbox SET failure_reason = ? WHERE id = ?", (reason, message_id))
+
+    def fail_recipient(self, recipient, reason, claimed_ids=()):
+        """
+        Give up on every queued message to a recipient that can't be reached; returns how many.
+        claimed_ids are messages to them already claimed for sending, which are given up on too.
+        """
+        now = time.time()
+        with self._lock:
+            dropped = self._conn.execute(
+                "UPDATE outbox SET status = ?, failure_reason = ?, updated_at = ? WHERE recipient = ? AND status = ?",
+                (FAILED, reason, now, int(recipient), PENDING)
+            ).rowcount
+            for message_id in claimed_ids:
+                dropped += self._conn.execute(
+                    "UPDATE outbox SET status = ?, failure_reason = ?, updated_at = ? WHERE id = ? AND status = ?",
+                    (FAILED, reason, now, message_id, SENDING)
+                ).rowcount
+            return dropped
+
+    def failure_counts(self):
+        """Get the number of failed messages for each failure reason"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT COALESCE(failure_reason, 'transient'), COUNT(*) FROM outbox WHERE status = ? GROUP BY 1", (FAILED,)
+            ).fetchall()
+        return {reason: count for reason, count in rows}
+
+    def batch_progress(self, batch_id):
+        """Get the number of messages in each status for a batch"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM outbox WHERE batch_id = ? GROUP BY status", (batch_id,)
+            ).fetchall()
+        progress = {PENDING: 0, SENDING: 0, SENT: 0, FAILED: 0}
+        progress.update({status: count for status, count in rows})
+        return progress
+
+    def pending_count(self):
+        """Number of messages waiting to be sent"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM outbox WHERE status IN (?, ?)", (PENDING, SENDING)
+            ).fetchone()[0]
+
+    def tier_depth(self):
+        """Get the number of messages waiting to be sent for each tier"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT COALESCE(tier, ?), COUNT(*) FROM outbox WHERE status IN (?, ?) GROUP BY 1",
+                (TIERS[-1], PENDING, SENDING)
+            ).fetchall()
+        depth = {tier: 0 for tier in TIERS}
+        depth.update({tier: count for tier, count in rows})
+        return depth
+
+    def purge_sent(self, older_than):
+        """Delete delivered messages older than the given number of seconds"""
+        with self._lock:
+            return self._conn.execute(
+                "DELETE FROM outbox WHERE status = ? AND updated_at < ?", (SENT, time.time() - older_than)
+            ).rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,105 @@
+import io
+import logging
+import importlib.util
+
+logger = logging.getLogger(__name__)
+
+# Pillow is optional; without it near-duplicate detection is simply disabled.
+# It is only imported by the hashing itself, so loading the BK-tree stays cheap.
+PIL_AVAILABLE = importlib.util.find_spec("PIL") is not None
+
+# Width/height of the reduced image; yields a hash_size * hash_size bit hash
+HASH_SIZE = 8
+
+def dhash(source, hash_size=HASH_SIZE):
+    """
+    Compute a difference hash of an image.
+    source can be a file path or the raw image bytes. Returns an int, or None if the image can't be hashed.
+    Visually similar images (re-encoded, recompressed, resized) produce hashes a few bits apart.
+    """
+    if not PIL_AVAILABLE:
+        return None
+    from PIL import Image
+
+    try:
+        if isinstance(source, (bytes, bytearray)):
+            source = io.BytesIO(source)
+        with Image.open(source) as image:
+            # Grayscale and shrink to (hash_size + 1) x hash_size so each row yields hash_size gradients
+            pixels = list(image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS).getdata())
+    except Exception as e:
+        logger.error(f"Error computing perceptual hash: {str(e)}")
+        return None
+
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+def hamming_distance(a, b):
+    """Number of differing bits between two hashes"""
+    return bin(a ^ b).count("1")
+
+class BKTree:
+    """
+    BK-tree over perceptual hashes for sub-linear Hamming-distance search.
+    Each node holds one hash and the items stored under it; children are keyed by their distance to the node.
+    """
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value, item):
+        """Store an item under a hash"""
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    def remove(self, value, item):
+        """Remove an item stored under a hash; the node itself stays as a routing point"""
+        node = self.root
+        while node is not None:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                if item in node[1]:
+                    node[1].remove(item)
+                    self.size -= 1
+                    return True
+                return False
+            node = node[2].get(distance)
+        return False
+
+    def search(self, value, max_distance):
+        """Get (distance, item) pairs within max_distance of a hash, nearest first"""
+        results = []
+        if self.root is None:
+            return results
+
+        candidates = [self.root]
+        while candidates:
+            node = candidates.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                results.extend((distance, item) for item in node[1])
+            # Triangle inequality: only children within [distance - max, distance + max] can match
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    candidates.append(child)
+
+        results.sort(key=lambda result: result[0])
+        return results
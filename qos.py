@@ -0,0 +1,119 @@
+import time
+import asyncio
+import logging
+import functools
+
+from fair_queue import WaitStats
+from dispatch import UserDispatcher
+
+logger = logging.getLogger(__name__)
+
+# Outgoing messages per second shared by all sends, and how many can go out in a burst
+SEND_RATE = 25
+SEND_BURST = 30
+# Share of the burst that bulk sends can't use, kept for interactive replies
+INTERACTIVE_RESERVE = 0.3
+# Bulk handlers running at once
+BULK_CONCURRENCY = 8
+# Longest a bulk batch waits for interactive handlers to finish before going anyway
+MAX_YIELD = 0.2
+# Interactive handler latency above this is logged
+LATENCY_TARGET = 0.5
+
+class QoS:
+    """
+    Keeps interactive commands responsive while bulk work runs.
+    - One token bucket covers the outgoing message rate. Interactive replies may use all of it,
+      while bulk sends stop short of a reserved share, so a reply never queues behind a fan-out.
+    - Interactive handlers are timed. Bulk senders may give way to running ones once per batch
+      (for at most max_yield); individual sends only wait for tokens.
+    - Every handler runs on its user's lane in the dispatcher, so one user's commands, callbacks,
+      uploads and messages are handled in order and never race on that user's state. Bulk handlers
+      also share a bounded number of slots, while interactive ones never wait for a slot.
+    """
+    def __init__(self, rate=SEND_RATE, burst=SEND_BURST, interactive_reserve=INTERACTIVE_RESERVE,
+                 bulk_concurrency=BULK_CONCURRENCY, max_yield=MAX_YIELD, latency_target=LATENCY_TARGET):
+        self.rate = rate
+        self.burst = burst
+        self.reserved = burst * interactive_reserve
+        self.bulk_concurrency = bulk_concurrency
+        self.max_yield = max_yield
+        self.latency_target = latency_target
+        self.latency = WaitStats()
+        self.interactive_running = 0
+        self._tokens = burst
+        self._refilled_at = time.monotonic()
+        self._idle = None
+        self.dispatcher = UserDispatcher(bulk_concurrency)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    async def acquire_send(self, interactive=False):
+        """Wait for a slot in the outgoing rate budget"""
+        floor = 0 if interactive else self.reserved
+        while True:
+            self._refill()
+            if self._tokens - 1 >= floor:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((floor + 1 - self._tokens) / self.rate)
+
+    async def yield_to_interactive(self):
+        """Give running interactive handlers a short head start; call once per bulk batch, not per send"""
+        if not self.interactive_running:
+            return
+        try:
+            await asyncio.wait_for(self._idle_event().wait(), self.max_yield)
+        except asyncio.TimeoutError:
+            pass
+
+    def _idle_event(self):
+        if self._idle is None:
+            self._idle = asyncio.Event()
+            self._idle.set()
+        return self._idle
+
+    def interactive(self, handler):
+        """Decorator for handlers that answer a user directly; they run in order with the user's other updates"""
+        @functools.wraps(handler)
+        async def wrapper(client, update, *args):
+            sender = update.from_user or getattr(update, "chat", None)
+            self.dispatcher.submit(
+                sender.id if sender else None, self._run_interactive, handler, time.monotonic(), client, update, *args,
+                bounded=False
+            )
+        return wrapper
+
+    async def _run_interactive(self, handler, queued_at, client, update, *args):
+        self.interactive_running += 1
+        self._idle_event().clear()
+        try:
+            await self.acquire_send(interactive=True)
+            return await handler(client, update, *args)
+        except Exception as e:
+            logger.error(f"Error in {handler.__name__}: {str(e)}")
+        finally:
+            # Timed from arrival, so waiting behind the user's own earlier updates counts too
+            elapsed = time.monotonic() - queued_at
+            self.latency.record("interactive", elapsed)
+            self.latency.record(handler.__name__, elapsed)
+            if elapsed > self.latency_target:
+                logger.warning(f"{handler.__name__} took {elapsed * 1000:.0f} ms")
+            self.interactive_running -= 1
+            if not self.interactive_running:
+                self._idle.set()
+
+    def bulk(self, handler):
+        """Decorator for handlers that start heavy work; they run on the bulk lane instead of a handler worker"""
+        @functools.wraps(handler)
+        async def wrapper(client, update):
+            sender = update.from_user or update.chat
+            self.dispatcher.submit(sender.id if sender else None, handler, client, update)
+        return wrapper
+
+    def bulk_backlog(self):
+        """Number of bulk handler runs in progress or waiting"""
+        return self.dispatcher.backlog()
@@ -0,0 +1,150 @@
+import sys
+from collections.abc import MutableMapping
+
+# Media record fields stored in slots; anything else goes to the record's extra dict
+MEDIA_FIELDS = (
+    "seq",
+    "user_id",
+    "file_id",
+    "file_unique_id",
+    "file_path",
+    "file_size",
+    "content_hash",
+    "phash",
+    "media_type",
+    "caption",
+    "upload_time",
+    "reported",
+    "reports",
+    "has_duplicates",
+    "is_duplicate",
+    "pending_download"
+)
+
+# Strings repeated across many records, worth sharing one copy of
+INTERNED_FIELDS = ("user_id", "media_type")
+
+class Uploader:
+    """Alias and premium flag of an uploader as recorded on their media, shared between records"""
+    __slots__ = ("alias", "premium")
+
+    _shared = {}
+
+    def __init__(self, alias, premium):
+        self.alias = alias
+        self.premium = premium
+
+    @classmethod
+    def get(cls, alias, premium):
+        """Get the shared instance for an alias and premium flag"""
+        key = (alias, premium)
+        uploader = cls._shared.get(key)
+        if uploader is None:
+            uploader = cls._shared[key] = cls(alias, premium)
+        return uploader
+
+_NO_UPLOADER = Uploader(None, None)
+
+class MediaRecord(MutableMapping):
+    """
+    A media entry with its fields in slots instead of a per-record dict.
+    It reads and writes like the dict it replaces (record["file_id"], record.get("caption"),
+    "duplicates" in record), and fields that were never set count as missing, so to_dict()
+    gives back exactly the JSON entry it was built from. The uploader's alias and premium flag
+    point at a shared Uploader, and repeated strings are interned.
+    """
+    __slots__ = MEDIA_FIELDS + ("uploader", "extra")
+
+    def __init__(self, data=None):
+        self.uploader = _NO_UPLOADER
+        self.extra = None
+        if data:
+            for key, value in data.items():
+                self[key] = value
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data)
+
+    def __getitem__(self, key):
+        if key in MEDIA_FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if key == "alias" or key == "premium":
+            value = getattr(self.uploader, key)
+            if value is None:
+                raise KeyError(key)
+            return value
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key in MEDIA_FIELDS:
+            if key in INTERNED_FIELDS and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(self, key, value)
+        elif key == "alias":
+            self.uploader = Uploader.get(value, self.uploader.premium)
+        elif key == "premium":
+            self.uploader = Uploader.get(self.uploader.alias, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in MEDIA_FIELDS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif key == "alias" or key == "premium":
+            if getattr(self.uploader, key) is None:
+                raise KeyError(key)
+            self.uploader = Uploader.get(
+                None if key == "alias" else self.uploader.alias,
+                None if key == "premium" else self.uploader.premium
+            )
+        else:
+            if self.extra is None:
+                raise KeyError(key)
+            del self.extra[key]
+            if not self.extra:
+                self.extra = None
+
+    def __iter__(self):
+        for key in MEDIA_FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self.uploader.alias is not None:
+            yield "alias"
+        if self.uploader.premium is not None:
+            yield "premium"
+        if self.extra:
+            yield from list(self.extra)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, key):
+        if key in MEDIA_FIELDS:
+            return hasattr(self, key)
+        if key == "alias" or key == "premium":
+            return getattr(self.uploader, key) is not None
+        return self.extra is not None and key in self.extra
+
+    def to_dict(self):
+        """Get the record as the plain dict stored in media.json"""
+        return {key: self[key] for key in self}
+
+    def __repr__(self):
+        return f"MediaRecord({self.to_dict()!r})"
+
+def to_json(value):
+    """json.dump default hook for record objects"""
+    if isinstance(value, MediaRecord):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
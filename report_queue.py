@@ -0,0 +1,45 @@
+from bisect import bisect_left, insort
+
+class ReportQueue:
+    """
+    Moderation queue of reported media, most reported first and most recent first among equals.
+    Entries are kept in a sorted list so counting is O(1), a new report re-positions one entry,
+    and a review page is a slice instead of a scan over all media.
+    """
+    def __init__(self):
+        self._entries = {}  # media_id -> (report_count, last_report_time)
+        self._order = []    # (-report_count, -last_report_time, media_id), ascending
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, media_id):
+        return media_id in self._entries
+
+    def _sort_key(self, media_id):
+        count, last_time = self._entries[media_id]
+        return (-count, -last_time, media_id)
+
+    def update(self, media_id, count, last_time):
+        """Set the report count and latest report time of a media item"""
+        self.remove(media_id)
+        if count <= 0:
+            return
+        self._entries[media_id] = (count, last_time)
+        insort(self._order, self._sort_key(media_id))
+
+    def remove(self, media_id):
+        """Take a media item out of the queue"""
+        if media_id not in self._entries:
+            return
+        sort_key = self._sort_key(media_id)
+        del self._order[bisect_left(self._order, sort_key)]
+        del self._entries[media_id]
+
+    def get(self, media_id):
+        """Get the (report_count, last_report_time) of a queued media item"""
+        return self._entries.get(media_id)
+
+    def page(self, offset, limit):
+        """Get (media_id, report_count, last_report_time) for a slice of the queue"""
+        return [(media_id, -count, -last_time) for count, last_time, media_id in self._order[offset:offset + limit]]
@@ -0,0 +1,110 @@
+import os
+import json
+import asyncio
+import logging
+
+from pyrogram.storage import MemoryStorage
+
+logger = logging.getLogger(__name__)
+
+# Seconds between snapshots of a changed session
+SNAPSHOT_INTERVAL = 60
+
+class SnapshotStorage(MemoryStorage):
+    """
+    Pyrogram session storage kept entirely in memory and snapshotted to a JSON file.
+    Auth state and the peer cache live in an in-memory SQLite database, so peer lookups during
+    fan-out never wait on a session file lock. Changes are written out periodically and on close
+    by replacing the snapshot file atomically, so a crash can't leave a half-written or locked session.
+    Peers for known user IDs can be pre-loaded at startup (access_hash 0, which bots may use for users)
+    so sending to a user doesn't depend on having seen them since the last restart.
+    """
+    def __init__(self, name, snapshot_path, warm_peer_ids=(), snapshot_interval=SNAPSHOT_INTERVAL):
+        super().__init__(name)
+        self.snapshot_path = snapshot_path
+        self.warm_peer_ids = warm_peer_ids
+        self.snapshot_interval = snapshot_interval
+        self._changed = False
+        self._snapshot_task = None
+
+    def _load_snapshot(self):
+        try:
+            with open(self.snapshot_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.error(f"Error loading session snapshot {self.snapshot_path}: {str(e)}. Starting a new session.")
+            return {}
+
+    async def open(self):
+        snapshot = self._load_snapshot()
+        self.session_string = snapshot.get("session_string")
+        await super().open()
+
+        # Known users first, so real access hashes from the snapshot replace the placeholders
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO peers (id, access_hash, type, username, phone_number) VALUES (?, 0, 'user', NULL, NULL)",
+            [(int(peer_id),) for peer_id in self.warm_peer_ids]
+        )
+        await super().update_peers([tuple(peer) for peer in snapshot.get("peers", [])])
+        self.conn.commit()
+
+        self._snapshot_task = asyncio.get_event_loop().create_task(self._snapshot_loop())
+
+    async def _snapshot_loop(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            if self._changed:
+                try:
+                    await self.snapshot()
+                except Exception as e:
+                    logger.error(f"Error writing session snapshot: {str(e)}")
+
+    async def snapshot(self):
+        """Write the session and peer cache to the snapshot file"""
+        if await self.auth_key() is None:
+            return  # Nothing worth keeping before authorization
+
+        self._changed = False
+        data = {
+            "session_string": await self.export_session_string(),
+            "peers": self.conn.execute(
+                "SELECT id, access_hash, type, username, phone_number FROM peers WHERE access_hash != 0"
+            ).fetchall()
+        }
+        await asyncio.get_event_loop().run_in_executor(None, self._write_snapshot, data)
+
+    def _write_snapshot(self, data):
+        temp_path = f"{self.snapshot_path}.tmp"
+        # The snapshot holds the auth key, so keep it private to the bot's user
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.snapshot_path)
+
+    async def update_peers(self, peers):
+        await super().update_peers(peers)
+        self._changed = True
+
+    async def save(self):
+        await super().save()
+        self._changed = True
+
+    async def close(self):
+        if self._snapshot_task is not None:
+            self._snapshot_task.cancel()
+            self._snapshot_task = None
+        try:
+            await self.snapshot()
+        except Exception as e:
+            logger.error(f"Error writing session snapshot on close: {str(e)}")
+        await super().close()
+
+    async def delete(self):
+        try:
+            os.remove(self.snapshot_path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,66 @@
+import os
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+from pyrogram import Client
+
+from session_storage import SnapshotStorage
+
+logger = logging.getLogger(__name__)
+
+class TransferPool:
+    """
+    Dedicated MTProto sessions for downloads.
+    Each transfer client is a separate login of the same bot with its own connections and
+    max_concurrent_transmissions, and receives no updates. Routing downloads here keeps large
+    transfers off the main client's sessions, so commands and relays stay responsive, and total
+    throughput grows with the number of sessions.
+    """
+    def __init__(self, name, api_id, api_hash, bot_token, workdir, snapshot_dir, size=2, max_concurrent_transmissions=4):
+        self.clients = []
+        for index in range(size):
+            client_name = f"{name}_{index}"
+            client = Client(
+                client_name,
+                api_id=api_id,
+                api_hash=api_hash,
+                bot_token=bot_token,
+                workdir=workdir,
+                no_updates=True,
+                max_concurrent_transmissions=max_concurrent_transmissions
+            )
+            client.storage = SnapshotStorage(client_name, os.path.join(snapshot_dir, f"{client_name}.json"))
+            self.clients.append(client)
+        # Jobs currently running on each client
+        self.active = {}
+
+    async def start(self):
+        """Log in all transfer sessions; sessions that fail to start are left out of the pool"""
+        results = await asyncio.gather(*(client.start() for client in self.clients), return_exceptions=True)
+        started = []
+        for client, result in zip(self.clients, results):
+            if isinstance(result, Exception):
+                logger.error(f"Transfer session {client.name} failed to start: {str(result)}")
+            else:
+                started.append(client)
+        self.clients = started
+        self.active = {client.name: 0 for client in self.clients}
+        logger.info(f"Transfer pool started with {len(self.clients)} sessions")
+
+    async def stop(self):
+        await asyncio.gather(*(client.stop() for client in self.clients), return_exceptions=True)
+
+    @asynccontextmanager
+    async def acquire(self, fallback):
+        """Get the least busy transfer client for a job, or the fallback client if the pool is empty"""
+        if not self.clients:
+            yield fallback
+            return
+
+        client = min(self.clients, key=lambda candidate: self.active[candidate.name])
+        self.active[client.name] += 1
+        try:
+            yield client
+        finally:
+            self.active[client.name] -= 1
@@ -2,7 +2,6 @@ import re
 import time
 import math
 from datetime import datetime, timedelta
-from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 # Regular expressions for cleaning captions and messages
 USERNAME_PATTERN = re.compile(r'@[\w_]+')
@@ -99,6 +98,8 @@ def format_uptime(seconds):
 # Keyboard generators
 def get_start_keyboard(user_id, is_admin=False):
     """Generate keyboard for start command"""
+    from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+    
     keyboard = [
         [InlineKeyboardButton("😶‍🌫️ Contact Admin", url=f"https://t.me/eternity_targid")]
     ]
@@ -110,18 +111,24 @@ def get_start_keyboard(user_id, is_admin=False):
 
 def get_access_denied_keyboard():
     """Generate keyboard for access denied message"""
+    from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+    
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("💬 Contact Admin", url=f"https://t.me/eternity_targid")]
     ])
 
 def get_premium_promo_keyboard():
     """Generate keyboard for premium promotion"""
+    from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+    
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("🔱 Get Premium Access", url=f"https://t.me/eternity_targid")]
     ])
 
 def get_admin_keyboard():
     """Generate keyboard for admin panel"""
+    from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+    
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("🔑 Generate Key", callback_data=f"genkey")],
         [InlineKeyboardButton("📊 Status", callback_data=f"status")],
@@ -131,12 +138,36 @@ def get_admin_keyboard():
 
 def get_report_keyboard(media_id, reporter_id):
     """Generate keyboard for report handling"""
+    from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+    
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("🗑️ Remove Content", callback_data=f"remove_{media_id}")],
         [InlineKeyboardButton("🚫 Ban Uploader", callback_data=f"ban_{media_id.split('_')[0]}")],
         [InlineKeyboardButton("❌ Dismiss Report", callback_data=f"dismiss_{media_id}")]
     ])
 
+def get_search_results_keyboard(search_token, page, has_next):
+    """Generate pagination keyboard for alias search results"""
+    from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+    
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("⬅️ Previous", callback_data=f"search_page:{search_token}:{page - 1}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Next Page ➡️", callback_data=f"search_page:{search_token}:{page + 1}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+def get_reports_keyboard(page, has_next):
+    """Generate pagination keyboard for the reported media queue"""
+    from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+    
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("⬅️ Previous", callback_data=f"reports_page:{page - 1}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Next Page ➡️", callback_data=f"reports_page:{page + 1}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
 # Message templates
 def get_welcome_message(user_name, is_premium=False):
     """Generate welcome message"""
@@ -290,6 +321,8 @@ def get_sync_confirmation_message(media_count):
 
 def get_sync_confirmation_keyboard():
     """Generate keyboard for sync confirmation"""
+    from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+    
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("✅ CONFIRM", callback_data=f"confirm_sync"),
          InlineKeyboardButton("❌ REJECT", callback_data=f"reject_sync")]
@@ -297,6 +330,8 @@ def get_sync_confirmation_keyboard():
 
 def get_premium_promo_keyboard():
     """Generate keyboard for premium promotion"""
+    from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+    
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("🧲 Sync Media", callback_data="/syncmedia")],
         [InlineKeyboardButton("🔱 Upgrade to Premium", url="https://t.me/eternity_targid")]
@@ -388,41 +423,35 @@ def get_report_message(media_id):
         f"🛡️ We value your contribution to our safe environment! 🛡️"
     )
 
-def get_admin_report_message(media_id, reporter_id, reporter_alias):
+def get_admin_report_message(media_id, reporter_id, reporter_alias, report_count=1):
     """Generate admin report notification"""
     return (
         f"🚨 **Content Reported** 🚨\n\n"
         f"📂 **Media ID:** {media_id}\n"
-        f"👤 **Reported by:** {reporter_alias} (ID: {reporter_id})\n\n"
+        f"🔢 **Reports:** {report_count}\n"
+        f"👤 **Latest report by:** {reporter_alias} (ID: {reporter_id})\n\n"
         f"⚠️ Please review this content and take appropriate action.\n"
         f"🛡️ Thank you for maintaining our community standards! 🛡️"
     )
 
-def get_top_users_message(top_users):
+def get_top_users_message(top_users, limit=5, period=None):
     """Generate top users message"""
-    message = "🏆 **Top 5 Contributors** 🏆\n\n"
+    period_label = {"today": " Today", "week": " This Week"}.get(period, "")
+    message = f"🏆 **Top {limit} Contributors{period_label}** 🏆\n\n"
     
     if not top_users:
         message += "No users have uploaded content yet.\n"
         return message
     
-    for i, (user_id, user) in enumerate(top_users, 1):
+    for i, (user_id, user, uploads) in enumerate(top_users, 1):
         medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else "🏅"
-        message += f"{medal} **#{i}** {user['alias']} - {user['uploads']} uploads\n"
+        message += f"{medal} **#{i}** {user['alias']} - {uploads} uploads\n"
     
     message += "\n💎 Want to see your name here? Keep uploading!"
     return message
 
-def get_link_message(link_url=None, link_name=None):
+def get_link_message(link_url, link_name=None):
     """Generate community link message"""
-    # If no link is provided, use the default
-    if not link_url:
-        from bot import db
-        link_url = db.get_community_link()
-        # If no custom name is provided, try to get it from the database
-        if not link_name:
-            link_name = db.get_community_link_name()
-    
     # Extract the link text (everything after the last /) if no custom name provided
     if not link_name:
         link_name = link_url.split('/')[-1].replace('_', ' ')